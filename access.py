@@ -0,0 +1,183 @@
+import os
+import time
+from collections import Counter, OrderedDict, deque
+from aiogram import BaseMiddleware
+from metrics import DENIED_UPDATES
+from custom_logging import logger
+
+
+# Commands a stranger may send while connecting an account; other messages are login input
+REGISTRATION_COMMANDS = ("/register", "/cancel")
+
+# Seconds a stranger's registration stays open after their last message
+REGISTRATION_TIMEOUT = 900
+
+UNAUTHORIZED_REPLY = "❌ You are not authorized to use the bot"
+REGISTER_REPLY = "👋 Connect your Telegram account with /register to start sending greetings."
+
+
+def _command(update):
+    """The command of a message update, e.g. "/register" for "/register@SomeBot args"."""
+    text = update.message.text if update.message else None
+    if not text or not text.startswith("/"):
+        return None
+    return text.split(maxsplit=1)[0].split("@")[0]
+
+
+class Allowlist:
+    """The admin (TELEGRAM_ID) and the registered account owners, parsed once."""
+
+    def __init__(self, admin_id, owner_ids=()):
+        self.admin_id = admin_id
+        self.owner_ids = set(owner_ids)
+
+    @classmethod
+    def from_env(cls):
+        return cls(int(os.getenv("TELEGRAM_ID")))
+
+    def __contains__(self, user_id):
+        return user_id == self.admin_id or user_id in self.owner_ids
+
+    def is_admin(self, user_id):
+        return user_id == self.admin_id
+
+    def add(self, user_id):
+        self.owner_ids.add(user_id)
+
+    def update(self, user_ids):
+        self.owner_ids.update(user_ids)
+
+
+class SlidingWindow:
+    """
+    Allows at most `limit` events per user in any `window` seconds. Only the
+    last `max_users` users are tracked, so a flood of strangers can't grow it.
+    """
+
+    def __init__(self, limit, window, max_users=10000):
+        self.limit = limit
+        self.window = window
+        self.max_users = max_users
+        # user_id -> monotonic times of the allowed events, least recently seen user first
+        self._events = OrderedDict()
+
+    def allow(self, user_id, now=None):
+        now = time.monotonic() if now is None else now
+        events = self._events.pop(user_id, None) or deque(maxlen=self.limit)
+        while events and events[0] <= now - self.window:
+            events.popleft()
+        allowed = len(events) < self.limit
+        if allowed:
+            events.append(now)
+        self._events[user_id] = events
+        while len(self._events) > self.max_users:
+            self._events.popitem(last=False)
+        return allowed
+
+
+class DenialLog:
+    """Counts denied updates per user and logs them at most once per `interval` seconds."""
+
+    def __init__(self, interval=60):
+        self.interval = interval
+        self._counts = Counter()
+        self._silent = 0
+        self._flush_at = 0.0
+
+    def record(self, user_id, replied):
+        self._counts[user_id] += 1
+        self._silent += not replied
+        DENIED_UPDATES.labels("replied" if replied else "dropped").inc()
+        now = time.monotonic()
+        if now >= self._flush_at:
+            self.flush()
+            self._flush_at = now + self.interval
+
+    def flush(self):
+        if not self._counts:
+            return
+        top = ", ".join(f"{user_id} x{count}" for user_id, count in self._counts.most_common(5))
+        logger.info(f"Denied {sum(self._counts.values())} updates of {len(self._counts)} "
+                    f"unauthorized users, {self._silent} without a reply. Most active: {top}")
+        self._counts.clear()
+        self._silent = 0
+
+
+class AccessMiddleware(BaseMiddleware):
+    """
+    Outer update middleware in front of the FSM lookup: updates of users that
+    aren't in the allowlist are dropped before any storage access or handler.
+    While registration is open, /register starts a registration and the
+    stranger's login input passes until end_registration() or
+    REGISTRATION_TIMEOUT. Strangers get at most `reply_limit` answers per
+    `reply_window` seconds and their denials are logged in aggregate.
+    """
+
+    def __init__(self, allowlist, registration_open=False,
+                 reply_limit=3, reply_window=60, log_interval=60):
+        self.allowlist = allowlist
+        self.registration_open = registration_open
+        self.replies = SlidingWindow(reply_limit, reply_window)
+        self.denials = DenialLog(log_interval)
+        # user_id -> monotonic time the registration times out
+        self._registrations = {}
+
+    @classmethod
+    def from_env(cls, allowlist, registration_open=False):
+        return cls(
+            allowlist, registration_open,
+            reply_limit=int(os.getenv("ACCESS_REPLY_LIMIT", "3")),
+            reply_window=float(os.getenv("ACCESS_REPLY_WINDOW_SECONDS", "60")),
+            log_interval=float(os.getenv("ACCESS_LOG_SECONDS", "60")),
+        )
+
+    def _registering(self, user_id):
+        now = time.monotonic()
+        expired = [key for key, timeout in self._registrations.items() if timeout <= now]
+        for key in expired:
+            del self._registrations[key]
+        return user_id in self._registrations
+
+    def _touch_registration(self, user_id):
+        self._registrations[user_id] = time.monotonic() + REGISTRATION_TIMEOUT
+
+    def end_registration(self, user_id):
+        self._registrations.pop(user_id, None)
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None or user.id in self.allowlist:
+            return await handler(event, data)
+
+        # Registering strangers are answered by the onboarding handlers
+        if self.registration_open and event.message is not None:
+            command = _command(event)
+            if self._registering(user.id) and (command is None or command in REGISTRATION_COMMANDS):
+                self._touch_registration(user.id)
+                return await handler(event, data)
+            if command == "/register" and self.replies.allow(user.id):
+                self._touch_registration(user.id)
+                return await handler(event, data)
+
+        replied = self.replies.allow(user.id)
+        reply = REGISTER_REPLY if self.registration_open else UNAUTHORIZED_REPLY
+        if replied:
+            if event.message is not None:
+                await event.message.reply(reply)
+            elif event.callback_query is not None:
+                await event.callback_query.answer(reply)
+            else:
+                replied = False
+        self.denials.record(user.id, replied)
+        return None
+
+
+def install_access(dp, middleware):
+    """Register `middleware` as an outer update middleware right before the FSM lookup of `dp`."""
+    registered = list(dp.update.outer_middleware)
+    for existing in registered:
+        dp.update.outer_middleware.unregister(existing)
+    for existing in registered:
+        if existing is dp.fsm:
+            dp.update.outer_middleware.register(middleware)
+        dp.update.outer_middleware.register(existing)
@@ -0,0 +1,377 @@
+"""
+Offline benchmark of the bot and the greeting pipeline.
+
+Drives the aiogram dispatcher with synthetic updates through a fake Bot API
+session and delivers greetings through a fake Pyrogram client with
+configurable latency and FloodWait injection, against a local Postgres
+(DB_* variables) or an embedded one (--embedded, needs `pip install pgserver`).
+Reports handler p50/p99 latency, greetings/sec and DB round trips per operation.
+
+    python benchmark.py --embedded
+    python benchmark.py --reset-db --holidays 500 --recipients 10 --json results.json
+
+The benchmark drops and recreates every table of the database it runs against.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import date, datetime
+
+
+class RoundTrips:
+    """Counts the queries sent by every pooled asyncpg connection."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, record):
+        self.count += 1
+
+
+round_trips = RoundTrips()
+
+
+class FakeUserClient:
+    """
+    Stand-in for UserPyrogram: every send takes `latency` seconds and raises
+    a FloodWait of `flood_wait` seconds with probability `flood_rate`.
+    """
+
+    def __init__(self, user_id, latency=0.02, flood_rate=0.0, flood_wait=0.5):
+        self.user_id = user_id
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.flood_wait = flood_wait
+        self.sent = 0
+        self.flood_waits = 0
+
+    async def load_peers(self, usernames):
+        pass
+
+    async def find_invalid_usernames(self, usernames):
+        await asyncio.sleep(self.latency)
+        return []
+
+    async def send_msg(self, receiver_id, message, random_id=None):
+        from pyrogram.errors import FloodWait
+
+        await asyncio.sleep(self.latency)
+        if random.random() < self.flood_rate:
+            self.flood_waits += 1
+            error = FloodWait(value=1)
+            # FloodWait rounds to whole seconds, keep benchmarks short
+            error.value = self.flood_wait
+            raise error
+        self.sent += 1
+
+
+def fake_session(latency=0.0):
+    """Bot API session that answers every method locally after `latency` seconds."""
+    from aiogram.client.session.base import BaseSession
+    from aiogram.types import Chat, Message
+
+    class FakeSession(BaseSession):
+        def __init__(self):
+            super().__init__()
+            self.requests = Counter()
+            self._message_id = 0
+
+        async def make_request(self, bot, method, timeout=None):
+            self.requests[type(method).__name__] += 1
+            if latency:
+                await asyncio.sleep(latency)
+            if getattr(method, "__returning__", None) is not Message:
+                return True
+            self._message_id += 1
+            return Message.model_validate({
+                "message_id": self._message_id,
+                "date": datetime.now(),
+                "chat": Chat(id=getattr(method, "chat_id", 0), type="private"),
+                "text": getattr(method, "text", None),
+            }, context={"bot": bot})
+
+        async def stream_content(self, url, headers=None, timeout=30,
+                                 chunk_size=65536, raise_for_status=True):
+            yield b""
+
+        async def close(self):
+            pass
+
+    return FakeSession()
+
+
+class UpdateFactory:
+    """Builds synthetic private-chat updates from one user."""
+
+    def __init__(self, bot, user_id):
+        self.bot = bot
+        self.user_id = user_id
+        self.update_id = 0
+
+    def _user(self):
+        return {"id": self.user_id, "is_bot": False, "first_name": "Benchmark"}
+
+    def _message(self, text):
+        message = {
+            "message_id": self.update_id,
+            "date": datetime.now(),
+            "chat": {"id": self.user_id, "type": "private"},
+            "from": self._user(),
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [
+                {"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return message
+
+    def message(self, text):
+        from aiogram.types import Update
+
+        self.update_id += 1
+        return Update.model_validate(
+            {"update_id": self.update_id, "message": self._message(text)},
+            context={"bot": self.bot})
+
+    def callback(self, data):
+        from aiogram.types import Update
+
+        self.update_id += 1
+        return Update.model_validate({
+            "update_id": self.update_id,
+            "callback_query": {
+                "id": str(self.update_id),
+                "from": self._user(),
+                "chat_instance": "benchmark",
+                "data": data,
+                "message": self._message("Select the holidays you want to remove"),
+            },
+        }, context={"bot": self.bot})
+
+
+def percentile(values, share):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * share), len(ordered) - 1)]
+
+
+class Results:
+    def __init__(self):
+        self.operations = {}
+
+    def add(self, name, latency, trips):
+        operation = self.operations.setdefault(name, {"latencies": [], "round_trips": 0})
+        operation["latencies"].append(latency)
+        operation["round_trips"] += trips
+
+    async def measure(self, name, coro):
+        trips = round_trips.count
+        started = time.perf_counter()
+        result = await coro
+        self.add(name, time.perf_counter() - started, round_trips.count - trips)
+        return result
+
+    def summary(self):
+        return {
+            name: {
+                "count": len(operation["latencies"]),
+                "p50_ms": percentile(operation["latencies"], 0.5) * 1000,
+                "p99_ms": percentile(operation["latencies"], 0.99) * 1000,
+                "round_trips_per_op": operation["round_trips"] / len(operation["latencies"]),
+            }
+            for name, operation in self.operations.items()
+        }
+
+
+def synthetic_holidays(count, recipients):
+    today = date.today()
+    return [
+        {
+            "name": f"Holiday {number}",
+            # A third of them today, so the greeting run has work
+            "day": today.day if number % 3 == 0 else number % 28 + 1,
+            "month": today.month if number % 3 == 0 else number % 12 + 1,
+            "greeted_users": [f"@user{number}_{recipient}" for recipient in range(recipients)],
+            "message": f"Happy holiday number {number}! " * 5,
+        }
+        for number in range(count)
+    ]
+
+
+async def bench_handlers(args, results):
+    import bot as bot_module
+
+    bot = bot_module.create_bot()
+    dp = bot_module.dp
+    from tracing import TracingRequestMiddleware
+
+    # Keep the tracing overhead the real session has
+    bot.session = fake_session(args.api_latency)
+    bot.session.middleware(TracingRequestMiddleware())
+    updates = UpdateFactory(bot, int(os.getenv("TELEGRAM_ID")))
+
+    async def feed(name, update):
+        await results.measure(name, dp.feed_update(bot, update))
+
+    for _ in range(args.iterations):
+        await feed("/start", updates.message("/start"))
+        await feed("/current_holidays", updates.message("/current_holidays"))
+
+    for number in range(args.iterations):
+        await feed("/add_holiday", updates.message("/add_holiday"))
+        await feed("add_holiday: name", updates.message(f"Benchmark holiday {number}"))
+        await feed("add_holiday: date", updates.message("24-12 18:00 Europe/Vienna"))
+        await feed("add_holiday: text", updates.message("Merry Christmas!"))
+        await feed("add_holiday: users", updates.message("@alice @bob @carol"))
+
+    for _ in range(args.iterations):
+        await feed("/remove_holiday", updates.message("/remove_holiday"))
+        await feed("remove_holiday: page", updates.callback("holidays_page:1"))
+        await feed("remove_holiday: toggle", updates.callback("toggle_holiday:1"))
+        await feed("/cancel", updates.message("/cancel"))
+
+    with tempfile.TemporaryDirectory() as directory:
+        from holiday_io import export_holidays
+
+        for file_format in ("csv", "ics"):
+            path = os.path.join(directory, f"holidays.{file_format}")
+            await results.measure(f"export {file_format}", export_holidays(path))
+
+    return dict(bot.session.requests)
+
+
+async def bench_greetings(args, results):
+    import outbox
+    from db_interaction import get_pool
+
+    client = FakeUserClient(int(os.getenv("TELEGRAM_ID")), args.send_latency,
+                            args.flood_rate, args.flood_wait)
+    pool = await get_pool()
+    holiday_ids = [row["id"] for row in await pool.fetch("SELECT id FROM holidays")]
+    await results.measure("queue greetings", outbox.queue_greetings(date.today(), holiday_ids))
+
+    started = time.perf_counter()
+    trips = round_trips.count
+    await outbox.drain_outbox(get_client=lambda owner_id: client)
+    elapsed = time.perf_counter() - started
+    results.add("deliver greetings", elapsed, round_trips.count - trips)
+    return {
+        "greetings": client.sent,
+        "flood_waits": client.flood_waits,
+        "seconds": elapsed,
+        "greetings_per_sec": client.sent / elapsed if elapsed else 0.0,
+        "round_trips_per_greeting": (round_trips.count - trips) / max(client.sent, 1),
+    }
+
+
+async def run(args):
+    import db_interaction
+    from custom_logging import attach_db_handler
+
+    # Count the queries of every pooled connection
+    init_connection = db_interaction._init_connection
+
+    async def counting_init(connection):
+        await init_connection(connection)
+        connection.add_query_logger(round_trips)
+
+    db_interaction._init_connection = counting_init
+
+    results = Results()
+    try:
+        await db_interaction.wait_for_DB_async()
+        # Log to the database like the bot does
+        attach_db_handler()
+        await db_interaction.drop_tables_DB_async()
+        await db_interaction.migrate_DB_async()
+        holidays = synthetic_holidays(args.holidays, args.recipients)
+        await results.measure("add_holidays (bulk)", db_interaction.add_holidays_DB_async(holidays))
+        for _ in range(args.iterations):
+            await results.measure("fetch_all_holidays", db_interaction.fetch_all_holidays_DB_async())
+
+        bot_requests = await bench_handlers(args, results)
+        greetings = await bench_greetings(args, results)
+    finally:
+        await db_interaction.close_pool()
+
+    return {
+        "parameters": vars(args),
+        "operations": results.summary(),
+        "greetings": greetings,
+        "bot_api_requests": bot_requests,
+    }
+
+
+def print_report(report):
+    print(f"{'operation':<28}{'count':>7}{'p50 ms':>10}{'p99 ms':>10}{'DB trips/op':>13}")
+    for name, operation in report["operations"].items():
+        print(f"{name:<28}{operation['count']:>7}{operation['p50_ms']:>10.2f}"
+              f"{operation['p99_ms']:>10.2f}{operation['round_trips_per_op']:>13.1f}")
+    greetings = report["greetings"]
+    print(f"\nDelivered {greetings['greetings']} greetings in {greetings['seconds']:.2f}s: "
+          f"{greetings['greetings_per_sec']:.1f} greetings/sec, {greetings['flood_waits']} FloodWaits, "
+          f"{greetings['round_trips_per_greeting']:.2f} DB round trips per greeting.")
+
+
+def use_embedded_postgres():
+    try:
+        import pgserver
+    except ImportError:
+        sys.exit("--embedded needs the pgserver package: pip install pgserver")
+    directory = tempfile.mkdtemp(prefix="greeting-benchmark-")
+    pgserver.get_server(directory, cleanup_mode="delete")
+    os.environ.update(DB_USER="postgres", DB_PASSWORD="", DB_HOST=directory,
+                      DB_PORT="5432", DB_DATABASE="postgres")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmark of the bot and greeting delivery.")
+    parser.add_argument("--embedded", action="store_true", help="run against a throwaway embedded Postgres")
+    parser.add_argument("--reset-db", action="store_true", help="allow dropping the tables of the DB_* database")
+    parser.add_argument("--holidays", type=int, default=300)
+    parser.add_argument("--recipients", type=int, default=5, help="recipients per holiday")
+    parser.add_argument("--iterations", type=int, default=50, help="repetitions of every handler scenario")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="Bot API latency in seconds")
+    parser.add_argument("--send-latency", type=float, default=0.02, help="MTProto send latency in seconds")
+    parser.add_argument("--flood-rate", type=float, default=0.01, help="share of sends answered with FloodWait")
+    parser.add_argument("--flood-wait", type=float, default=0.5, help="FloodWait length in seconds")
+    parser.add_argument("--rate", type=float, default=0, help="GREETING_RATE, 0 for unlimited")
+    parser.add_argument("--concurrency", type=int, default=8, help="GREETING_CONCURRENCY")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    if args.embedded:
+        use_embedded_postgres()
+    elif not args.reset_db:
+        sys.exit("The benchmark drops all tables: pass --embedded or --reset-db")
+
+    random.seed(args.seed)
+    # Configure the modules before they are imported
+    os.environ.setdefault("TELEGRAM_ID", "1")
+    os.environ.setdefault("BOT_TOKEN", "1:benchmark")
+    os.environ.setdefault("API_ID", "1")
+    os.environ.setdefault("API_HASH", "benchmark")
+    os.environ["IS_TEST"] = "0"
+    os.environ["GREETING_RATE"] = str(args.rate)
+    os.environ["GREETING_CONCURRENCY"] = str(args.concurrency)
+    os.environ["GREETING_PACING"] = "none"
+
+    import user_account
+
+    # Recipients are checked through the fake client as well
+    user_account.get_user_client = lambda user_id: FakeUserClient(
+        user_id, args.send_latency)
+
+    report = asyncio.run(run(args))
+    # Flush the log rows while the (embedded) database is still up
+    from custom_logging import close_db_handler
+    close_db_handler()
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(report, file, indent=2)
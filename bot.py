@@ -1,28 +1,46 @@
+# First, so the startup report covers the other imports
+from startup import startup_report, start_health_server
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from aiogram import Bot, Dispatcher
+from aiogram import Bot, Dispatcher, F
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from aiogram.filters import CommandStart, Command
-from aiogram.types import Message, BotCommand, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+from aiogram.types import Message, BotCommand, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, FSInputFile, BufferedInputFile
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from datetime import datetime, timedelta, time
+from datetime import datetime, timedelta, timezone
 import asyncio
 import os
+import tempfile
 import textwrap
+from html import escape
 from db_interaction import *
-from custom_logging import logger
+from custom_logging import logger, attach_db_handler, close_db_handler
 import user_account
-import random
+from greeting_worker import send_holiday_greetings, supervise_workers
+from holiday_cache import holiday_calendar
+from holiday_io import (parse_holiday_date, parse_recipients, format_recipients,
+                        check_template, import_holidays, export_holidays)
+from greeting_templates import TemplateError, compile_template
+from outbox import track_outbox_depth
+from metrics import UpdateMetricsMiddleware, start_metrics_server
+from fsm_storage import PostgresStorage
+from access import Allowlist, AccessMiddleware, install_access
+from webhook import WebhookEndpoint, update_mode, run_webhook
+from tracing import (TracedStorage, TracingRequestMiddleware, install_tracing,
+                     dump_traces, set_profiler, PROFILERS)
 
 
 load_dotenv()
-BOT_TOKEN = os.getenv("BOT_TOKEN")
 
-# Initialize dispatcher and bot
-dp = Dispatcher()
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(
-    parse_mode=ParseMode.HTML))
+# Initialize the dispatcher; the bot is created by main(), see create_bot()
+fsm_storage = PostgresStorage.from_env()
+dp = Dispatcher(storage=TracedStorage(fsm_storage))
+# Time DB, Bot API and FSM calls per update
+install_tracing(dp)
+# Time every handler for the metrics endpoint
+dp.message.middleware(UpdateMetricsMiddleware())
+dp.callback_query.middleware(UpdateMetricsMiddleware())
 
 
 class Form(StatesGroup):
@@ -31,6 +49,53 @@ class Form(StatesGroup):
     holiday_date = State()
     holiday_users = State()
     holiday_text = State()
+    holiday_removal = State()
+    holiday_import = State()
+
+
+# Number of holidays per page of the /remove_holiday keyboard
+HOLIDAYS_PAGE_SIZE = 10
+
+# Telegram's maximum message length
+MESSAGE_LIMIT = 4096
+
+def is_multi_tenant():
+    return bool(int(os.getenv("MULTI_TENANT", "0")))
+
+
+# TELEGRAM_ID and the registered account owners, loaded at startup and
+# extended by the change listener when another replica registers an owner
+allowlist = Allowlist.from_env()
+# The only authorization check: strangers are dropped before the FSM lookup,
+# with MULTI_TENANT they may still register
+access = AccessMiddleware.from_env(allowlist, registration_open=is_multi_tenant())
+install_access(dp, access)
+
+
+async def reload_owners():
+    try:
+        allowlist.update(await fetch_owners_DB_async())
+    except Exception as e:
+        logger.error(f"An error occurred while reloading the account owners: {e}")
+
+
+def owner_added(owner_id):
+    # None when the listener reconnected and may have missed registrations
+    if owner_id is None:
+        asyncio.get_running_loop().create_task(reload_owners())
+    else:
+        allowlist.add(owner_id)
+
+
+on_owner_added(owner_added)
+
+
+def is_authorized(user_id):
+    return user_id in allowlist
+
+
+def is_admin(user_id):
+    return allowlist.is_admin(user_id)
 
 
 # Bot commands setup
@@ -40,84 +105,182 @@ async def set_bot_commands(bot: Bot):
         BotCommand(command="current_holidays", description="Show added holidays"),
         BotCommand(command="add_holiday", description="Add a new holiday"),
         BotCommand(command="remove_holiday", description="Remove a holiday"),
+        BotCommand(command="import_holidays", description="Import holidays from a CSV or .ics file"),
+        BotCommand(command="export_holidays", description="Export holidays as CSV or .ics"),
         BotCommand(command="cancel", description="Cancel the current process"),
     ]
+    if is_multi_tenant():
+        commands.append(BotCommand(command="register", description="Connect your Telegram account"))
     await bot.set_my_commands(commands)
     logger.info("Bot commands have been set successfully.")
 
 
 @dp.message(Command("cancel"))
 async def cancel_process(message: Message, state: FSMContext):
-    if message.from_user.id != int(os.getenv("TELEGRAM_ID")):
-        logger.info(f"Unauthorized user {message.from_user.id} tried to cancel a process.")
-        await message.reply("❌ You are not authorized to use the bot", parse_mode="HTML")
-        return
+    current_state = await state.get_state()
+    if current_state:  # Check if the user is in a state
+        if current_state == Form.tg_credentials:
+            await user_account.cancel_login(message.from_user.id)
+            access.end_registration(message.from_user.id)
+        await state.clear()  # Clear the FSM state
+        await message.reply("❌ <b>Process canceled!</b>", parse_mode="HTML")
     else:
-        if await state.get_state():  # Check if the user is in a state
-            await state.clear()  # Clear the FSM state
-            await message.reply("❌ <b>Process canceled!</b>", parse_mode="HTML")
-        else:
-            await message.reply("ℹ️ No active process to cancel.", parse_mode="HTML")
+        await message.reply("ℹ️ No active process to cancel.", parse_mode="HTML")
+
+
+def tg_len(text):
+    """Length as Telegram counts it, in UTF-16 code units."""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def format_holiday(holiday, limit=MESSAGE_LIMIT):
+    """Render one holiday of the /current_holidays listing, cut to fit in a message."""
+    head = (f"🎉 <b>{escape(holiday['name'])}</b>\n"
+            f"📅 Date: {holiday['day']:02d}-{holiday['month']:02d} "
+            f"{holiday['send_time']:%H:%M} {escape(holiday['time_zone'] or '')}\n📝 Message: ")
+    text = escape(holiday['message'])
+    budget = limit - tg_len(head)
+    if tg_len(text) > budget:
+        # Cut character by character so no HTML entity gets split, leaving room for "…"
+        kept, size = [], 1
+        for char in holiday['message']:
+            size += tg_len(escape(char))
+            if size > budget:
+                break
+            kept.append(escape(char))
+        text = "".join(kept) + "…"
+    return head + text
 
 
 @dp.message(Command("current_holidays"))
 async def current_holidays(message: Message):
-    if message.from_user.id != int(os.getenv("TELEGRAM_ID")):
-        logger.info(f"Unauthorized user {message.from_user.id} tried to use bot")
-        await message.reply("❌ You are not authorized to use the bot", parse_mode="HTML")
+    # Stream holidays from the database, next occurrence first, and send
+    # them in messages that stay under Telegram's length limit
+    today = datetime.now()
+    chunk = "📅 <b>Current Holidays:</b>"
+    sent_any = False
+    count = 0
+    try:
+        async for holiday in iter_holidays_DB_async(
+                today.day, today.month, message.from_user.id):
+            block = format_holiday(holiday)
+            if tg_len(chunk) + 2 + tg_len(block) > MESSAGE_LIMIT:
+                if sent_any:
+                    await message.answer(chunk, parse_mode="HTML")
+                else:
+                    await message.reply(chunk, parse_mode="HTML")
+                sent_any = True
+                chunk = block
+            else:
+                chunk += "\n\n" + block
+            count += 1
+    except Exception as e:
+        logger.error(f"An error occurred while listing holidays: {e}")
+        await message.reply("❌ An error occurred while listing the holidays. Please try again later.")
         return
-    else:
-        # Fetch holidays from the database
-        holidays = fetch_all_holidays_DB()
-        if not holidays:
-            await message.reply("ℹ️ No holidays have been added yet.", parse_mode="HTML")
-            return
 
-        # Construct a message with the list of holidays including text
-        holiday_list = "\n\n".join(
-            [
-                f"🎉 <b>{holiday['name']}</b>\n📅 Date: {holiday['day']:02d}-{holiday['month']:02d}\n📝 Message: {holiday['message']}"
-                for holiday in holidays
-            ]
-        )
-        await message.reply(
-            f"📅 <b>Current Holidays:</b>\n\n{holiday_list}",
-            parse_mode="HTML"
-        )
+    if not count:
+        await message.reply("ℹ️ No holidays have been added yet.", parse_mode="HTML")
+    elif sent_any:
+        await message.answer(chunk, parse_mode="HTML")
+    else:
+        await message.reply(chunk, parse_mode="HTML")
 
 
 # Handler for /start command
 @dp.message(CommandStart())
 async def start(message: Message) -> None:
-    if message.from_user.id != int(os.getenv("TELEGRAM_ID")):
-        logger.info(f"Unauthorized user {message.from_user.id} tried to cancel a process.")
-        await message.reply("❌ You are not authorized to use the bot", parse_mode="HTML")
+    logger.info(f"User triggered /start command.")
+    msg = textwrap.dedent((
+    "🎉 Hi there! I’m your friendly bot 🤖, here to make your life easier by "
+    "sending heartfelt holiday greetings directly from your account. Let me "
+    "help you spread joy and celebrate all the special moments! 🥳🎁\n"
+    "<i>P.S. The mailing is scheduled for 10 AM unless you pick another time</i>"))
+
+    await message.reply(msg)
+
+
+# Start onboarding of a new account owner
+@dp.message(Command("register"))
+async def register_start(message: Message, state: FSMContext):
+    if not is_multi_tenant():
+        await message.reply("ℹ️ Registration is closed.", parse_mode="HTML")
+        return
+    if is_authorized(message.from_user.id):
+        await message.reply("ℹ️ Your account is already connected.", parse_mode="HTML")
+        return
+    await message.reply(
+        "📱 <b>Let's connect your Telegram account!</b>\n\n"
+        "Greetings are sent on your behalf, so the bot needs to log in to your account.\n"
+        "Please enter your <b>phone number</b> in international format (e.g., +43 660 1234567):",
+        parse_mode="HTML"
+    )
+    await state.set_state(Form.tg_credentials)
+    await state.set_data({"login_step": "phone"})
+
+
+# Walk through phone number, login code and two-step password
+@dp.message(Form.tg_credentials)
+async def get_tg_credentials(message: Message, state: FSMContext):
+    user_id = message.from_user.id
+    step = (await state.get_data()).get("login_step", "phone")
+    try:
+        if step == "phone":
+            await user_account.start_login(user_id, message.text.strip())
+            await state.update_data(login_step="code")
+            await message.reply(
+                "🔑 Now enter the <b>login code</b> Telegram sent you.\n\n"
+                "Put spaces between the digits (e.g., <code>1 2 3 4 5</code>), "
+                "otherwise Telegram invalidates the code:",
+                parse_mode="HTML"
+            )
+            return
+
+        if step == "code":
+            code = "".join(char for char in message.text if char.isdigit())
+            if not await user_account.finish_login(user_id, code):
+                await state.update_data(login_step="password")
+                await message.reply(
+                    "🔒 Your account has two-step verification, please enter your <b>password</b>:",
+                    parse_mode="HTML"
+                )
+                return
+        else:
+            password = message.text
+            # Don't leave the password in the chat history
+            try:
+                await message.delete()
+            except Exception:
+                pass
+            await user_account.finish_login_password(user_id, password)
+    except Exception as e:
+        logger.error(f"Login of {user_id} failed at step {step}: {e}")
+        await user_account.cancel_login(user_id)
+        access.end_registration(user_id)
+        await state.clear()
+        await message.answer("❌ Login failed. Please start again with /register.")
         return
-    else:
-        logger.info(f"User triggered /start command.")
-        msg = textwrap.dedent((
-        "🎉 Hi there! I’m your friendly bot 🤖, here to make your life easier by "
-        "sending heartfelt holiday greetings directly from your account. Let me "
-        "help you spread joy and celebrate all the special moments! 🥳🎁\n"
-        "<i>P.S. The mailing will be scheduled for 10 AM</i>"))
 
-        await message.reply(msg)
+    await add_owner_DB_async(user_id)
+    allowlist.add(user_id)
+    access.end_registration(user_id)
+    await state.clear()
+    logger.info(f"New owner {user_id} registered.")
+    await message.answer(
+        "✅ <b>Your account is connected!</b>\n\nUse /add_holiday to schedule your first greeting.",
+        parse_mode="HTML"
+    )
 
 
 # Start the /add_holiday process
 @dp.message(Command("add_holiday"))
 async def add_holiday_start(message: Message, state: FSMContext):
-    if message.from_user.id != int(os.getenv("TELEGRAM_ID")):
-        logger.info(f"Unauthorized user {message.from_user.id} tried to use bot")
-        await message.reply("❌ You are not authorized to use the bot", parse_mode="HTML")
-        return
-    else:
-        await message.reply(
-            "🎉 <b>Let's add a new holiday!</b>\n\n"
-            "Please enter the <b>name of the holiday</b> (e.g., International Friendship Day):",
-            parse_mode="HTML"
-        )
-        await state.set_state(Form.holiday_name)
+    await message.reply(
+        "🎉 <b>Let's add a new holiday!</b>\n\n"
+        "Please enter the <b>name of the holiday</b> (e.g., International Friendship Day):",
+        parse_mode="HTML"
+    )
+    await state.set_state(Form.holiday_name)
 
 
 # Get the holiday name
@@ -125,7 +288,9 @@ async def add_holiday_start(message: Message, state: FSMContext):
 async def get_holiday_name(message: Message, state: FSMContext):
     await state.update_data(holiday_name=message.text)
     await message.reply(
-        "📅 Great! Now enter the <b>date of the holiday</b> in the format <code>DD-MM</code> (e.g., 14-02 for Valentine's Day):",
+        "📅 Great! Now enter the <b>date of the holiday</b> in the format <code>DD-MM</code> (e.g., 14-02 for Valentine's Day).\n\n"
+        "Greetings go out at 10:00 unless you add a time and a time zone, "
+        "e.g. <code>14-02 08:30 Europe/Vienna</code>:",
         parse_mode="HTML"
     )
     await state.set_state(Form.holiday_date)
@@ -134,25 +299,26 @@ async def get_holiday_name(message: Message, state: FSMContext):
 @dp.message(Form.holiday_date)
 async def get_holiday_date(message: Message, state: FSMContext):
     try:
-        # Validate the date format
-        date_parts = message.text.split("-")
-        if len(date_parts) != 2 or not all(part.isdigit() for part in date_parts):
-            raise ValueError
-
-        day, month = map(int, date_parts)
-        if not (1 <= day <= 31 and 1 <= month <= 12):
-            raise ValueError
+        # Validate the date format, optionally followed by a time and a time zone
+        day, month, send_time, time_zone = parse_holiday_date(message.text)
     except ValueError:
         await message.reply(
-            "❌ Invalid date format! Please enter the date in the format <code>DD-MM</code> (e.g., 14-02 for Valentine's Day):",
+            "❌ Invalid date format! Please enter the date in the format <code>DD-MM</code> (e.g., 14-02 for Valentine's Day), "
+            "optionally followed by <code>HH:MM</code> and a time zone like <code>Europe/Vienna</code>:",
             parse_mode="HTML"
         )
         return
 
-    await state.update_data(holiday_date=message.text)
+    await state.update_data(holiday_date=f"{day:02d}-{month:02d}",
+                            holiday_time=send_time and send_time.strftime("%H:%M"),
+                            holiday_time_zone=time_zone)
     await message.reply(
         "📝 Now, please enter a <b>custom holiday message</b> to be sent to the users.\n\n"
-        "For example: <i>Happy Friendship Day! Wishing you joy and happiness!</i>",
+        "For example: <i>Happy Friendship Day! Wishing you joy and happiness!</i>\n\n"
+        "It can greet everyone personally: <code>{name}</code> is the user's name, "
+        "<code>{years}</code> the years since their <code>since</code> year, "
+        "<code>{holiday}</code> the holiday, and any other <code>{field}</code> is "
+        "given per user in the next step.",
         parse_mode="HTML"
     )
     await state.set_state(Form.holiday_text)
@@ -160,11 +326,33 @@ async def get_holiday_date(message: Message, state: FSMContext):
 # Get the custom holiday message
 @dp.message(Form.holiday_text)
 async def get_holiday_text(message: Message, state: FSMContext):
+    if message.text is None:
+        await message.reply("❌ The holiday message has to be text, please send it again:")
+        return
+    # Parse the template now, so mistakes show up here instead of at send time
+    try:
+        template = compile_template(message.text)
+    except TemplateError as e:
+        await message.reply(
+            f"❌ This message can't be used as a template: {escape(str(e))}\n\n"
+            "Please fix it and send it again:",
+            parse_mode="HTML"
+        )
+        return
+
     await state.update_data(holiday_text=message.text)
+    fields_hint = ""
+    if template.custom_fields or "years" in template.fields:
+        needed = sorted(template.custom_fields | ({"since"} if "years" in template.fields else set()))
+        fields_hint = (
+            "\n\nGive every user " + ", ".join(f"<code>{field}</code>" for field in needed)
+            + f" after their username, e.g. <code>@username1 {needed[0]}=\"...\"</code>"
+        )
     await message.reply(
         "👥 Great! Finally, please enter the <b>usernames</b> of the people to greet for this holiday.\n\n"
         "Use the format: <code>@username1 @username2 @username3</code>\n"
-        "Separate each username with a space:",
+        "Separate each username with a space. A user's template fields follow the username, "
+        "e.g. <code>@username1 name=\"Anna Maria\" since=1990</code>" + fields_hint + ":",
         parse_mode="HTML"
     )
     await state.set_state(Form.holiday_users)
@@ -172,28 +360,52 @@ async def get_holiday_text(message: Message, state: FSMContext):
 # Get the users to greet and complete the process
 @dp.message(Form.holiday_users)
 async def get_holiday_users(message: Message, state: FSMContext):
-    greeted_users = message.text.split()
-    invalid_users = [
-        user for user in greeted_users if not user.startswith("@")]
+    if message.text is None:
+        await message.reply("❌ Please send the usernames as text:")
+        return
+    data = await state.get_data()
+    holiday_text = data.get("holiday_text")
+    try:
+        greeted_users, recipient_fields = parse_recipients(message.text)
+        check_template(holiday_text, greeted_users, recipient_fields)
+    except ValueError as e:
+        await message.reply(
+            f"❌ {escape(str(e))}\n\n"
+            "Make sure all usernames start with <code>@</code>, each followed by "
+            "the fields of the message, and try again:",
+            parse_mode="HTML"
+        )
+        return
 
-    if invalid_users:
+    # Resolve the usernames now, so typos are caught here and sends skip resolution
+    try:
+        unknown_users = await user_account.get_user_client(
+            message.from_user.id).find_invalid_usernames(greeted_users)
+    except Exception as e:
+        logger.error(f"Could not check the usernames {greeted_users}: {e}")
+        unknown_users = []
+    if unknown_users:
         await message.reply(
-            f"❌ The following usernames are invalid: {', '.join(invalid_users)}\n\n"
-            "Make sure all usernames start with <code>@</code> and try again:",
+            f"❌ These users don't exist on Telegram: {escape(', '.join(unknown_users))}\n\n"
+            "Please check the usernames and try again:",
             parse_mode="HTML"
         )
         return
 
-    data = await state.get_data()
     holiday_name = data.get("holiday_name")
     holiday_date = data.get("holiday_date")
     day, month = map(int, holiday_date.split("-"))
-    holiday_text = data.get("holiday_text")
+    holiday_time = data.get("holiday_time")
+    holiday_time_zone = data.get("holiday_time_zone")
+    send_time = datetime.strptime(holiday_time, "%H:%M").time() if holiday_time else None
 
     # Register the holiday in the database
     try:
-        add_holiday_DB(holiday_name, day, month,
-                       greeted_users, holiday_text)
+        await add_holiday_DB_async(holiday_name, day, month,
+                                   greeted_users, holiday_text,
+                                   owner_id=message.from_user.id,
+                                   send_time=send_time, time_zone=holiday_time_zone,
+                                   recipient_fields=recipient_fields)
     except Exception as e:
         logger.error(f"An error occurred while adding holiday: {e}")
         await message.reply("❌ An error occurred while adding the holiday. Please try again later.")
@@ -205,192 +417,309 @@ async def get_holiday_users(message: Message, state: FSMContext):
     await message.reply(
         f"✅ <b>New holiday registered!</b>\n\n"
         f"🎉 <b>Holiday Name:</b> {holiday_name}\n"
-        f"📅 <b>Date:</b> {holiday_date}\n"
+        f"📅 <b>Date:</b> {holiday_date} {holiday_time or '10:00'} {holiday_time_zone or ''}\n"
         f"📝 <b>Message:</b> {holiday_text}\n"
-        f"👥 <b>Users to greet:</b> {', '.join(greeted_users)}",
+        f"👥 <b>Users to greet:</b> {escape(format_recipients(greeted_users, recipient_fields))}",
         parse_mode="HTML"
     )
     await state.clear()
 
 
-async def send_holiday_greetings():
-    while True:
-        try:
-            # Get the current time and calculate the next 10:00 AM
-            now = datetime.now()
-            if not int(os.getenv("IS_TEST")):
-                target_time = datetime.combine(now.date(), time(10, 0))
-            else:
-                target_time = now + timedelta(seconds=60)
+@dp.message(Command("import_holidays"))
+async def import_holidays_start(message: Message, state: FSMContext):
+    await message.reply(
+        "📥 <b>Let's import holidays!</b>\n\n"
+        "Send a <b>.csv</b> file with the columns "
+        "<code>name,date,time,time_zone,users,message</code> "
+        "(e.g. <code>Anna's birthday,14-02,08:30,Europe/Vienna,@anna,Happy birthday!</code>; "
+        "time and time_zone may be empty), or an <b>.ics</b> calendar whose events "
+        "list the usernames in <code>X-GREETING-USERS</code>.",
+        parse_mode="HTML"
+    )
+    await state.set_state(Form.holiday_import)
 
-            # If it's already past 10:00 AM, target the next day
-            if now >= target_time:
-                target_time += timedelta(days=1)
 
-            # Calculate the time difference and wait until 10:00 AM
-            wait_time = (target_time - now).total_seconds()
-            logger.info(
-                f"Waiting {wait_time // 60:.2f} minutes until 10:00 AM.")
-            await asyncio.sleep(wait_time)
+@dp.message(Form.holiday_import, F.document)
+async def get_holiday_import(message: Message, state: FSMContext):
+    file_name = message.document.file_name or ""
+    file_format = os.path.splitext(file_name)[1].lstrip(".").lower()
+    if file_format not in ("csv", "ics"):
+        await message.reply("❌ Please send a <b>.csv</b> or <b>.ics</b> file.", parse_mode="HTML")
+        return
 
-            # Fetch holidays scheduled for today
-            today_dd_mm = target_time.strftime("%d-%m")
+    # Download to disk and parse from there, so the file is never held in memory
+    fd, path = tempfile.mkstemp(suffix=f".{file_format}")
+    os.close(fd)
+    try:
+        await message.bot.download(message.document, destination=path)
+        report = await import_holidays(path, message.from_user.id)
+    except Exception as e:
+        logger.error(f"An error occurred while importing {file_name}: {e}")
+        await message.reply(f"❌ The import failed, nothing was added: {escape(str(e))}")
+        await state.clear()
+        return
+    finally:
+        os.remove(path)
+
+    lines = [f"✅ <b>Imported {report['imported']} holidays.</b>"]
+    if report["rejected"]:
+        lines.append(f"\n⚠️ {report['rejected']} rows were skipped:")
+        lines += [f"• line {line}: {escape(error)}" for line, error in report["errors"][:20]]
+        if report["rejected"] > 20:
+            lines.append(f"• … and {report['rejected'] - 20} more")
+    await message.reply("\n".join(lines), parse_mode="HTML")
+    await state.clear()
 
-            # fetch holidays for the current date
-            try:
-                holidays = fetch_holidays_by_date_DB(today_dd_mm)
-            except Exception as e:
-                logger.error(f"Error fetching holidays for {today_dd_mm}: {e}")
-                holidays = []
-
-            if holidays:
-                for holiday in holidays:
-                    holiday_name = holiday['name']
-                    holiday_message = holiday['message']
-                    greeted_users = holiday['greeted_users']
-
-                    for username in greeted_users:
-                        try:
-                            user = user_account.UserPyrogram(
-                                os.getenv("TELEGRAM_ID"))
-                            await user.send_msg(username, holiday_message)
-                        except Exception as e:
-                            logger.error(
-                                f"An error occurred while sending holiday message to {username}: {e}")
-                            continue
-                        
-                        random_number = random.randint(5, 60)  # Includes both 5 and 60
-                        logger.info(
-                            f"Waiting {random_number} seconds before sending the next greeting.")
-                        await asyncio.sleep(random_number)
-
-                    logger.info(
-                        f"Sent holiday message for {holiday_name} to {greeted_users}")
-
-        except Exception as e:
-            logger.error(
-                f"An error occurred in the holiday greeting task: {e}")
-            # Avoid immediate retry to prevent rapid failure loops
-            await asyncio.sleep(60)
 
+@dp.message(Form.holiday_import)
+async def get_holiday_import_text(message: Message, state: FSMContext):
+    await message.reply("📎 Please send the holidays as a <b>.csv</b> or <b>.ics</b> file, "
+                        "or /cancel.", parse_mode="HTML")
 
-@dp.message(Command("remove_holiday"))
-async def remove_holiday_command(message: Message):
-    if message.from_user.id != int(os.getenv("TELEGRAM_ID")):
-        logger.info(f"Unauthorized user {message.from_user.id} tried to use bot")
-        await message.reply("❌ You are not authorized to use the bot", parse_mode="HTML")
-        return
-    else:
-        holidays = fetch_all_holidays_DB()  # Fetch holidays from the database
-        if not holidays:
+
+@dp.message(Command("export_holidays"))
+async def export_holidays_command(message: Message):
+    # /export_holidays or /export_holidays ics
+    file_format = "ics" if "ics" in message.text.split()[1:] else "csv"
+    fd, path = tempfile.mkstemp(suffix=f".{file_format}")
+    os.close(fd)
+    try:
+        exported = await export_holidays(path, message.from_user.id)
+        if not exported:
             await message.answer("No holidays found.")
             return
+        await message.answer_document(
+            FSInputFile(path, filename=f"holidays.{file_format}"),
+            caption=f"📤 {exported} holidays")
+    except Exception as e:
+        logger.error(f"An error occurred while exporting holidays: {e}")
+        await message.reply("❌ An error occurred while exporting the holidays. Please try again later.")
+    finally:
+        os.remove(path)
+
+
+# Dump the slow-update ring buffer
+@dp.message(Command("traces"))
+async def traces_command(message: Message):
+    if not is_admin(message.from_user.id):
+        logger.info(f"Unauthorized user {message.from_user.id} tried to dump traces")
+        await message.reply("❌ You are not authorized to use this command", parse_mode="HTML")
+        return
+    traces = dump_traces()
+    if not traces:
+        await message.answer("No slow updates recorded.")
+        return
+    if tg_len(traces) + 11 <= MESSAGE_LIMIT:
+        await message.answer(f"<pre>{escape(traces)}</pre>", parse_mode="HTML")
+    else:
+        await message.answer_document(
+            BufferedInputFile(traces.encode("utf-8"), filename="traces.txt"))
 
-        # Create an inline keyboard with holiday IDs in callback data
-        builder = InlineKeyboardBuilder()
-        for holiday in holidays:
-            builder.button(
-                text=f"❌ {holiday['name']} ({holiday['day']}/{holiday['month']})",
-                callback_data=f"toggle_holiday:{holiday['id']}"  # Use holiday ID
-            )
-        builder.button(text="✅ Confirm Deletion", callback_data="confirm_deletion:")
-        builder.adjust(1)  # One button per row
 
-        # Attach a temporary storage attribute to the message for selections
-        await message.answer(
-            "Select the holidays you want to remove (toggle with buttons):",
-            reply_markup=builder.as_markup()
+# Switch the per-update profiler at runtime
+@dp.message(Command("trace_profile"))
+async def trace_profile_command(message: Message):
+    if not is_admin(message.from_user.id):
+        logger.info(f"Unauthorized user {message.from_user.id} tried to switch the profiler")
+        await message.reply("❌ You are not authorized to use this command", parse_mode="HTML")
+        return
+    args = message.text.split()[1:]
+    mode = args[0] if args else "off"
+    try:
+        set_profiler(mode)
+    except (ValueError, ImportError) as e:
+        await message.reply(f"❌ {escape(str(e))}. Use one of: {', '.join(PROFILERS)}")
+        return
+    await message.reply(f"🔬 Update profiler: <b>{mode}</b>", parse_mode="HTML")
+
+
+def build_removal_keyboard(holidays, selected_ids, page):
+    """
+    Build one page of the removal keyboard.
+    Callback data only carries a holiday id or a page number, the selection lives in FSM data.
+    """
+    pages = max((len(holidays) - 1) // HOLIDAYS_PAGE_SIZE + 1, 1)
+    page = min(max(page, 0), pages - 1)
+
+    builder = InlineKeyboardBuilder()
+    for holiday in holidays[page * HOLIDAYS_PAGE_SIZE:(page + 1) * HOLIDAYS_PAGE_SIZE]:
+        prefix = "✅" if holiday['id'] in selected_ids else "❌"
+        builder.row(InlineKeyboardButton(
+            text=f"{prefix} {holiday['name']} ({holiday['day']}/{holiday['month']})",
+            callback_data=f"toggle_holiday:{holiday['id']}"  # Use holiday ID
+        ))
+
+    if pages > 1:
+        builder.row(
+            InlineKeyboardButton(text="⬅️", callback_data=f"holidays_page:{page - 1}"),
+            InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data=f"holidays_page:{page}"),
+            InlineKeyboardButton(text="➡️", callback_data=f"holidays_page:{page + 1}"),
         )
+    builder.row(InlineKeyboardButton(
+        text=f"✅ Confirm Deletion ({len(selected_ids)})",
+        callback_data="confirm_deletion"
+    ))
+    return builder.as_markup(), page
+
+
+@dp.message(Command("remove_holiday"))
+async def remove_holiday_command(message: Message, state: FSMContext):
+    # Fetch holidays from the calendar cache
+    holidays = await holiday_calendar.all(message.from_user.id)
+    if not holidays:
+        await message.answer("No holidays found.")
+        return
+
+    # Keep the selection server-side instead of in the keyboard
+    await state.set_state(Form.holiday_removal)
+    await state.set_data({"removal_selection": [], "removal_page": 0})
+    keyboard, _ = build_removal_keyboard(holidays, set(), 0)
+    await message.answer(
+        "Select the holidays you want to remove (toggle with buttons):",
+        reply_markup=keyboard
+    )
 
 
 @dp.callback_query()
-async def handle_holiday_deletion(callback: CallbackQuery):
-    if callback.data.startswith("toggle_holiday:"):
-        # Extract holiday ID from callback data
-        holiday_id = int(callback.data.split(":")[1])
-
-        # Fetch holidays to rebuild the state
-        holidays = fetch_all_holidays_DB()
-
-        # Reconstruct the current selection based on IDs in the button text
-        selected_ids = set()
-        for button in callback.message.reply_markup.inline_keyboard:
-            if button[0].text.startswith("✅") and button[0].callback_data.startswith("toggle_holiday:"):
-                selected_ids.add(int(button[0].callback_data.split(":")[1]))
-
-        # Toggle the current holiday's selection state
-        if holiday_id in selected_ids:
-            selected_ids.remove(holiday_id)
+async def handle_holiday_deletion(callback: CallbackQuery, state: FSMContext):
+    if await state.get_state() != Form.holiday_removal:
+        await callback.answer("This selection has expired, use /remove_holiday again.")
+        return
+
+    data = await state.get_data()
+    selected_ids = set(data.get("removal_selection", []))
+    page = data.get("removal_page", 0)
+
+    if callback.data.startswith("toggle_holiday:") or callback.data.startswith("holidays_page:"):
+        if callback.data.startswith("toggle_holiday:"):
+            # Toggle the current holiday's selection state
+            holiday_id = int(callback.data.split(":")[1])
+            selected_ids ^= {holiday_id}
+            answer = "Toggled holiday selection."
         else:
-            selected_ids.add(holiday_id)
-
-        # Build the updated inline keyboard
-        builder = InlineKeyboardBuilder()
-        for holiday in holidays:
-            is_selected = holiday['id'] in selected_ids
-            prefix = "✅" if is_selected else "❌"
-            builder.button(
-                text=f"{prefix} {holiday['name']} ({holiday['day']}/{holiday['month']})",
-                callback_data=f"toggle_holiday:{holiday['id']}"
-            )
-        builder.button(
-            text="✅ Confirm Deletion",
-            callback_data=f"confirm_deletion:{','.join(map(str, selected_ids))}"
-        )
-        builder.adjust(1)
+            page = int(callback.data.split(":")[1])
+            answer = None
+
+        holidays = await holiday_calendar.all(callback.from_user.id)
+        # Drop holidays that were removed in the meantime
+        selected_ids &= {holiday['id'] for holiday in holidays}
+        keyboard, page = build_removal_keyboard(holidays, selected_ids, page)
+        await state.update_data(removal_selection=sorted(selected_ids), removal_page=page)
 
-        # Update the reply markup
-        await callback.message.edit_reply_markup(reply_markup=builder.as_markup())
-        await callback.answer(f"Toggled holiday selection.")
+        # Update the reply markup unless nothing visible changed
+        if keyboard != callback.message.reply_markup:
+            await callback.message.edit_reply_markup(reply_markup=keyboard)
+        await callback.answer(answer)
 
-    elif callback.data.startswith("confirm_deletion:"):
-        # Extract selected IDs from callback data
-        selected_ids = callback.data[len("confirm_deletion:"):].split(",")
-        selected_ids = list(map(int, selected_ids)) if selected_ids != [""] else []
+    elif callback.data == "confirm_deletion":
         if not selected_ids:
             await callback.answer("No holidays selected to delete.")
             return
-        holiday_rows = fetch_all_holidays_DB()
-        holiday_names = [row['name'] for row in holiday_rows if row['id'] in selected_ids]
-        # Perform deletion for each selected holiday
-        for holiday_id in selected_ids:
-            remove_holiday_DB(holiday_id)
+        # Delete all selected holidays in one statement
+        removed = await remove_holidays_DB_async(sorted(selected_ids), callback.from_user.id)
+        holiday_names = [row['name'] for row in removed]
+        await state.clear()
         await callback.message.edit_text(
             f"Successfully removed the selected holidays: {', '.join(holiday_names)}"
         )
         await callback.answer("Holidays removed.")
 
 
+async def seed_test_data():
+    """Drop and recreate tables and add test holidays for today."""
+    await drop_tables_DB_async()
+    await create_tables_DB_async()
+
+    # Add test holidays sent a minute from now
+    send_at = datetime.now(timezone.utc) + timedelta(minutes=1)
+    day, month, send_time = send_at.day, send_at.month, send_at.time()
+    await add_holiday_DB_async("Test Holiday",
+                               day, month, ['@TrackFoodExpensesBot'],
+                               "How you been?", send_time=send_time, time_zone="UTC")
+    await add_holiday_DB_async("Test TESTfasdfadf",
+                               day, month, ['@JKUClassNotifierBOT'],
+                               "Damn bro, whassup?", send_time=send_time, time_zone="UTC")
+    await add_holiday_DB_async("afdaff",
+                               day, month, ['@JKUClassNotifierBOT'],
+                               "Damn bro, whassup?", send_time=send_time, time_zone="UTC")
+
+    logger.info("Test mode enabled. Dropping and recreating tables.")
+
+
+def create_bot():
+    """Create the bot; its HTTP session is only opened by the first request."""
+    bot = Bot(token=os.getenv("BOT_TOKEN"), default=DefaultBotProperties(
+        parse_mode=ParseMode.HTML))
+    bot.session.middleware(TracingRequestMiddleware())
+    return bot
+
+
+@dp.startup()
+async def on_startup():
+    # Polling is about to begin or the webhook is set, the bot accepts updates from now on
+    startup_report.set_ready()
+
+
+@dp.shutdown()
+async def on_shutdown():
+    startup_report.set_not_ready()
+    access.denials.flush()
+
+
 # Main function
 async def main() -> None:
-    await set_bot_commands(bot)
-    logger.info("Bot polling started.")
-    asyncio.create_task(send_holiday_greetings())
-    logger.info("Holiday greeting task started.")
-    await dp.start_polling(bot)
+    startup_report.mark("imports")
+    health_server = None
+    mode = update_mode()
+    webhook = WebhookEndpoint() if mode == "webhook" else None
+    try:
+        with startup_report.step("health server"):
+            health_server = await start_health_server(webhook=webhook)
+        with startup_report.step("database"):
+            await wait_for_DB_async()
+        # Records logged so far are replayed into the logs table
+        attach_db_handler()
+        with startup_report.step("migrations"):
+            if int(os.getenv("IS_TEST")):
+                await seed_test_data()
+            await migrate_DB_async()
+            allowlist.update(await fetch_owners_DB_async())
+        with startup_report.step("bot"):
+            bot = create_bot()
+            await set_bot_commands(bot)
+        with startup_report.step("background tasks"):
+            start_metrics_server()
+            asyncio.create_task(track_outbox_depth())
+            asyncio.create_task(fsm_storage.prune_forever())
+            asyncio.create_task(maintain_log_partitions())
+            workers = int(os.getenv("GREETING_WORKERS", "0"))
+            if workers:
+                # Shard the owners over separate worker processes
+                asyncio.create_task(supervise_workers(workers))
+                logger.info(f"{workers} holiday greeting workers started.")
+            else:
+                asyncio.create_task(send_holiday_greetings())
+                logger.info("Holiday greeting task started.")
+            # Webhook replicas share users, keep their calendars and FSM caches coherent
+            if int(os.getenv("HOLIDAY_CACHE_LISTEN", "0")) or mode == "webhook":
+                asyncio.create_task(listen_changes_DB_async())
+        if mode == "webhook":
+            await run_webhook(dp, bot, webhook)
+        else:
+            # A webhook left by an earlier deployment would make getUpdates fail
+            await bot.delete_webhook()
+            logger.info("Bot polling started.")
+            await dp.start_polling(bot)
+    finally:
+        await user_account.stop_all_clients()
+        await close_pool()
+        if health_server is not None:
+            await health_server.cleanup()
+        close_db_handler()
 
 if __name__ == "__main__":
     is_test = int(os.getenv("IS_TEST"))
     print(f"Test state {is_test}")
-    if is_test:
-        # Drop and recreate tables in test mode
-        drop_tables_DB()
-        create_tables_DB()
-
-        # Add a test holiday for today
-        today = datetime.now().strftime("%d-%m")
-        day, month = map(int, today.split("-"))
-        add_holiday_DB("Test Holiday",
-                       day, month, ['@TrackFoodExpensesBot'],
-                       "How you been?")
-        add_holiday_DB("Test TESTfasdfadf",
-                       day, month, ['@JKUClassNotifierBOT'],
-                       "Damn bro, whassup?")
-        add_holiday_DB("afdaff",
-                       day, month, ['@JKUClassNotifierBOT'],
-                       "Damn bro, whassup?")
-
-        logger.info("Test mode enabled. Dropping and recreating tables.")
 
     logger.info("Starting bot...")
     asyncio.run(main())
@@ -1,16 +1,78 @@
 import logging
 import psycopg2
+from psycopg2.extras import execute_values
 import os
+import queue
+import threading
+import time
+from collections import deque
+from datetime import datetime
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Marker that tells the writer thread to flush what is left and exit
+_STOP = object()
+
 
 # Custom PostgreSQL Logging Handler
 class PostgresHandler(logging.Handler):
-    def __init__(self):
+    """
+    Queue-backed handler: emit() only enqueues the record, a background
+    thread writes the queue to the logs table in multi-row INSERTs.
+    """
+
+    def __init__(self, capacity=10000, batch_size=500, flush_interval=2.0,
+                 overflow_policy="drop_oldest"):
         super().__init__()
-        # Establish the connection
+        if overflow_policy not in ("drop_oldest", "drop_newest"):
+            raise ValueError(f"Unknown overflow policy: {overflow_policy}")
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow_policy = overflow_policy
+        self.queue = queue.Queue(maxsize=capacity)
+        self.dropped = 0
+        self.connection = None
+
+        self._closed = False
+        self._stopping = threading.Event()
+        self._worker = threading.Thread(
+            target=self._run, name="postgres-log-writer", daemon=True)
+        self._worker.start()
+
+    def emit(self, record):
+        try:
+            entry = (datetime.fromtimestamp(record.created),
+                     record.levelname, self.format(record))
+        except Exception:
+            self.handleError(record)
+            return
+        self._enqueue(entry)
+
+    def _enqueue(self, item):
+        try:
+            self.queue.put_nowait(item)
+            return
+        except queue.Full:
+            pass
+
+        # Queue is full, apply the overflow policy (the stop marker is never dropped)
+        if self.overflow_policy == "drop_newest" and item is not _STOP:
+            self.dropped += 1
+            return
+        while True:
+            try:
+                self.queue.get_nowait()
+                self.dropped += 1
+            except queue.Empty:
+                pass
+            try:
+                self.queue.put_nowait(item)
+                return
+            except queue.Full:
+                continue
+
+    def _connect(self):
         self.connection = psycopg2.connect(
             user=os.getenv("DB_USER"),
             password=os.getenv("DB_PASSWORD"),
@@ -20,32 +82,142 @@ class PostgresHandler(logging.Handler):
         )
         self.connection.autocommit = True
 
-    def emit(self, record):
-        log_message = self.format(record)
+    def _disconnect(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+            self.connection = None
+
+    def _write(self, batch):
+        """Write a batch in one statement, reconnecting if the connection died."""
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            batch = batch + [(datetime.now(), "WARNING",
+                              f"Dropped {dropped} log records: queue was full")]
         try:
-            cursor = self.connection.cursor()
-            cursor.execute(
-                "INSERT INTO logs (level, message) VALUES (%s, %s)",
-                (record.levelname, log_message),
-            )
-            cursor.close()
+            if self.connection is None or self.connection.closed:
+                self._connect()
+            with self.connection.cursor() as cursor:
+                execute_values(
+                    cursor,
+                    "INSERT INTO logs (timestamp, level, message) VALUES %s",
+                    batch,
+                    page_size=len(batch),
+                )
+            return True
         except Exception as e:
-            print(f"Failed to log message to PostgreSQL: {e}")
+            print(f"Failed to log {len(batch)} messages to PostgreSQL: {e}")
+            self._disconnect()
+            return False
+
+    def _run(self):
+        batch = []
+        failures = 0
+        stopping = False
+        while not stopping:
+            # Collect records until the batch is full or the flush interval passes
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            if not batch:
+                continue
+            if self._write(batch):
+                batch = []
+                failures = 0
+            elif not stopping:
+                # Keep the batch and back off before reconnecting
+                failures += 1
+                self._stopping.wait(min(2 ** failures, 60))
+
+        # Flush everything still queued on shutdown
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                batch.append(item)
+        for start in range(0, len(batch), self.batch_size):
+            self._write(batch[start:start + self.batch_size])
+        self._disconnect()
 
     def close(self):
-        logger.info("Bot stopped")
-        if self.connection:
-            self.connection.close()
+        if not self._closed:
+            logger.info("Bot stopped")
+            self._closed = True
+            self._stopping.set()
+            self._enqueue(_STOP)
+            self._worker.join(timeout=10)
         super().close()
 
 
-# Initialize logging
-db_handler = PostgresHandler()
-db_handler.setLevel(logging.INFO)
+class StartupBuffer(logging.Handler):
+    """
+    Keeps the records logged before the database is reachable, up to
+    `capacity` (the oldest are dropped), until attach_db_handler() replays them.
+    """
+
+    def __init__(self, capacity):
+        super().__init__()
+        self.records = deque(maxlen=capacity)
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+# Initialize logging; nothing connects to the database until attach_db_handler()
 formatter = logging.Formatter(
     "%(asctime)s - %(message)s")  # Customize log format
-db_handler.setFormatter(formatter)
+startup_buffer = StartupBuffer(int(os.getenv("LOG_QUEUE_SIZE", "10000")))
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
-logger.addHandler(db_handler)
+logger.addHandler(startup_buffer)
+
+db_handler = None
+
+
+def attach_db_handler():
+    """
+    Start writing logs to the logs table, beginning with the buffered startup
+    records. Call it once the database is reachable; later calls are no-ops.
+    """
+    global db_handler
+    if db_handler is not None:
+        return db_handler
+    handler = PostgresHandler(
+        capacity=int(os.getenv("LOG_QUEUE_SIZE", "10000")),
+        batch_size=int(os.getenv("LOG_BATCH_SIZE", "500")),
+        flush_interval=float(os.getenv("LOG_FLUSH_INTERVAL", "2")),
+        overflow_policy=os.getenv("LOG_OVERFLOW_POLICY", "drop_oldest"),
+    )
+    handler.setLevel(logging.INFO)
+    handler.setFormatter(formatter)
+    with startup_buffer.lock:
+        logger.removeHandler(startup_buffer)
+        logger.addHandler(handler)
+        records = list(startup_buffer.records)
+        startup_buffer.records.clear()
+    for record in records:
+        handler.handle(record)
+    db_handler = handler
+    return handler
+
+
+def close_db_handler():
+    """Flush the queued log records and stop the writer thread, if it runs."""
+    if db_handler is not None:
+        db_handler.close()
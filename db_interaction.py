@@ -1,221 +1,626 @@
-import psycopg2 as pg2
-from psycopg2 import errors
+import asyncio
+import inspect
+import threading
+import asyncpg
 import os
 import json
+import uuid
+from datetime import date, datetime, timedelta
 from custom_logging import logger
+from migrations import apply_migrations
+from metrics import observe_db
 from dotenv import load_dotenv
 
 load_dotenv()
 
 
-def create_tables_DB():
-    connection = pg2.connect(
+# Statements are kept as module constants so asyncpg can reuse the prepared
+# statement it caches per pooled connection instead of re-parsing the query.
+
+# Triggers on HOLIDAYS notify this channel with the owner_id of the changed rows
+# (empty for rows without one) so every process can refresh its calendar and schedule
+HOLIDAYS_CHANNEL = "holidays_changed"
+# FSM writes notify this channel with "<process token> <key>" so other processes evict the key
+FSM_CHANNEL = "fsm_changed"
+# Registering an owner notifies this channel with their Telegram id so every replica lets them in
+OWNERS_CHANNEL = "owners_changed"
+
+# Holiday columns with the recipients aggregated back into an ordered list
+# and the template fields of those that have any into an object
+HOLIDAY_COLUMNS_SQL = """
+    h.id, h.name, h.day, h.month, h.text, h.send_time, h.time_zone,
+    COALESCE(array_agg(r.username ORDER BY hr.position)
+             FILTER (WHERE r.id IS NOT NULL), '{}') AS users,
+    COALESCE(jsonb_object_agg(r.username, hr.fields)
+             FILTER (WHERE r.id IS NOT NULL AND hr.fields <> '{}'), '{}') AS recipient_fields
+"""
+HOLIDAY_RECIPIENTS_JOIN_SQL = """
+    LEFT JOIN holiday_recipients hr ON hr.holiday_id = h.id
+    LEFT JOIN recipients r ON r.id = hr.recipient_id
+"""
+SELECT_HOLIDAYS_BY_DATE_SQL = f"""
+    SELECT {HOLIDAY_COLUMNS_SQL}
+    FROM holidays h {HOLIDAY_RECIPIENTS_JOIN_SQL}
+    WHERE h.owner_id = $3 AND h.month = $2 AND h.day = $1
+    GROUP BY h.id;
+"""
+SELECT_ALL_HOLIDAYS_SQL = f"""
+    SELECT {HOLIDAY_COLUMNS_SQL}
+    FROM holidays h {HOLIDAY_RECIPIENTS_JOIN_SQL}
+    WHERE h.owner_id = $1
+    GROUP BY h.id
+    ORDER BY h.id;
+"""
+# Holidays from (day, month) on come first, the ones earlier in the year wrap around
+SELECT_HOLIDAYS_BY_NEXT_OCCURRENCE_SQL = f"""
+    SELECT {HOLIDAY_COLUMNS_SQL}
+    FROM holidays h {HOLIDAY_RECIPIENTS_JOIN_SQL}
+    WHERE h.owner_id = $3
+    GROUP BY h.id
+    ORDER BY (h.month, h.day) < ($2, $1), h.month, h.day, h.id;
+"""
+ALLOCATE_HOLIDAY_IDS_SQL = """
+    SELECT nextval(pg_get_serial_sequence('holidays', 'id')) FROM generate_series(1, $1);
+"""
+# A holiday id that belongs to another owner is left untouched
+UPSERT_HOLIDAYS_SQL = """
+    INSERT INTO holidays (id, name, day, month, text, owner_id, send_time, time_zone)
+    SELECT id, name, day, month, text, $6::bigint, COALESCE(send_time, '10:00'), time_zone
+    FROM unnest($1::int[], $2::text[], $3::int[], $4::int[], $5::text[], $7::time[], $8::text[])
+        AS input (id, name, day, month, text, send_time, time_zone)
+    ON CONFLICT (id) DO UPDATE
+    SET name = EXCLUDED.name, day = EXCLUDED.day, month = EXCLUDED.month, text = EXCLUDED.text,
+        send_time = EXCLUDED.send_time, time_zone = EXCLUDED.time_zone
+    WHERE holidays.owner_id = EXCLUDED.owner_id
+    RETURNING id;
+"""
+UNLINK_RECIPIENTS_SQL = "DELETE FROM holiday_recipients WHERE holiday_id = ANY($1::int[]);"
+INSERT_RECIPIENTS_SQL = """
+    INSERT INTO recipients (username)
+    SELECT DISTINCT username FROM unnest($1::text[]) AS input (username)
+    ON CONFLICT (username) DO NOTHING;
+"""
+LINK_RECIPIENTS_SQL = """
+    INSERT INTO holiday_recipients (holiday_id, recipient_id, position, fields)
+    SELECT input.holiday_id, r.id, min(input.position),
+           (array_agg(input.fields ORDER BY input.position))[1]::jsonb
+    FROM unnest($1::int[], $2::text[], $3::int[], $4::text[])
+        AS input (holiday_id, username, position, fields)
+    JOIN recipients r ON r.username = input.username
+    GROUP BY input.holiday_id, r.id;
+"""
+# The CTE's snapshot still sees the recipient links its DELETE cascades away
+DELETE_HOLIDAYS_SQL = """
+    WITH h AS (
+        DELETE FROM holidays WHERE id = ANY($1::int[]) AND owner_id = $2
+        RETURNING id, name, day, month, text, send_time, time_zone
+    )
+    SELECT """ + HOLIDAY_COLUMNS_SQL + """
+    FROM h """ + HOLIDAY_RECIPIENTS_JOIN_SQL + """
+    GROUP BY h.id, h.name, h.day, h.month, h.text, h.send_time, h.time_zone;
+"""
+# Imported rows are COPYed into a staging table that draws ids from the HOLIDAYS sequence
+CREATE_IMPORT_TABLE_SQL = """
+    CREATE TEMP TABLE holiday_import (
+        id INT NOT NULL DEFAULT nextval(pg_get_serial_sequence('holidays', 'id')),
+        line INT NOT NULL,
+        name TEXT NOT NULL,
+        day INT NOT NULL,
+        month INT NOT NULL,
+        send_time TIME,
+        time_zone TEXT,
+        users TEXT[] NOT NULL,
+        fields TEXT NOT NULL,
+        text TEXT NOT NULL
+    ) ON COMMIT DROP;
+"""
+# fields is a JSON object of the template fields per username
+IMPORT_COLUMNS = ("line", "name", "day", "month", "send_time", "time_zone", "users", "fields", "text")
+INSERT_IMPORTED_HOLIDAYS_SQL = """
+    INSERT INTO holidays (id, name, day, month, text, owner_id, send_time, time_zone)
+    SELECT id, name, day, month, text, $1::bigint, COALESCE(send_time, '10:00'), time_zone
+    FROM holiday_import ORDER BY line;
+"""
+INSERT_IMPORTED_RECIPIENTS_SQL = """
+    INSERT INTO recipients (username)
+    SELECT DISTINCT unnest(users) FROM holiday_import
+    ON CONFLICT (username) DO NOTHING;
+"""
+LINK_IMPORTED_RECIPIENTS_SQL = """
+    INSERT INTO holiday_recipients (holiday_id, recipient_id, position, fields)
+    SELECT i.id, r.id, min(u.position), COALESCE(i.fields::jsonb -> r.username, '{}')
+    FROM holiday_import i
+    CROSS JOIN LATERAL unnest(i.users) WITH ORDINALITY AS u (username, position)
+    JOIN recipients r ON r.username = u.username
+    GROUP BY i.id, r.id, i.fields, r.username;
+"""
+# What the scheduler needs to know about the holidays of one shard
+SELECT_SCHEDULE_SQL = """
+    SELECT id, day, month, send_time, time_zone FROM holidays WHERE owner_id % $1 = $2;
+"""
+# The send list of due holidays, grouped by holiday, for rendering their templates
+SELECT_GREETINGS_SQL = """
+    SELECT h.id AS holiday_id, h.owner_id, h.name, h.text, r.username, hr.fields
+    FROM holidays h
+    JOIN holiday_recipients hr ON hr.holiday_id = h.id
+    JOIN recipients r ON r.id = hr.recipient_id
+    WHERE h.id = ANY($1::int[])
+    ORDER BY h.id, hr.position;
+"""
+# Every holiday with its number of recipients, for capacity planning
+SELECT_CALENDAR_SQL = """
+    SELECT h.id, h.owner_id, h.day, h.month, h.send_time, h.time_zone,
+           count(hr.recipient_id) AS recipients
+    FROM holidays h
+    LEFT JOIN holiday_recipients hr ON hr.holiday_id = h.id
+    GROUP BY h.id
+    ORDER BY h.id;
+"""
+MATERIALIZE_OUTBOX_SQL = """
+    INSERT INTO greeting_outbox (holiday_id, owner_id, send_date, recipient, message, random_id)
+    SELECT holiday_id, owner_id, $1::date, recipient, message, floor(random() * 9.2e18)::bigint
+    FROM unnest($2::int[], $3::bigint[], $4::text[], $5::text[])
+        AS input (holiday_id, owner_id, recipient, message)
+    ON CONFLICT (holiday_id, send_date, recipient) DO NOTHING;
+"""
+CLAIM_OUTBOX_SQL = """
+    UPDATE greeting_outbox
+    SET status = 'sending', claimed_at = CURRENT_TIMESTAMP, attempts = attempts + 1
+    WHERE id IN (
+        SELECT id FROM greeting_outbox
+        WHERE ((status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP)
+               OR (status = 'sending'
+                   AND claimed_at < CURRENT_TIMESTAMP - make_interval(secs => $2::float8)))
+          AND owner_id % $3 = $4 AND owner_id <> ALL($5::bigint[])
+        ORDER BY id
+        LIMIT $1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, owner_id, recipient, message, random_id, attempts;
+"""
+MARK_OUTBOX_SENT_SQL = """
+    UPDATE greeting_outbox
+    SET status = 'sent', sent_at = CURRENT_TIMESTAMP, last_error = NULL
+    WHERE id = $1;
+"""
+MARK_OUTBOX_FAILED_SQL = """
+    UPDATE greeting_outbox
+    SET status = CASE WHEN attempts >= $3 THEN 'dead' ELSE 'pending' END,
+        last_error = $2,
+        next_attempt_at = CURRENT_TIMESTAMP
+            + make_interval(secs => $4::float8 * power(2, attempts - 1))
+    WHERE id = $1
+    RETURNING status;
+"""
+NEXT_OUTBOX_ATTEMPT_SQL = """
+    SELECT EXTRACT(EPOCH FROM min(due_at) - CURRENT_TIMESTAMP::timestamp)::float8
+    FROM (
+        SELECT next_attempt_at AS due_at FROM greeting_outbox
+        WHERE status = 'pending' AND owner_id % $2 = $3
+        UNION ALL
+        SELECT claimed_at + make_interval(secs => $1::float8) FROM greeting_outbox
+        WHERE status = 'sending' AND owner_id % $2 = $3
+    ) AS due;
+"""
+RELEASE_OUTBOX_CLAIMS_SQL = """
+    UPDATE greeting_outbox
+    SET status = 'pending', next_attempt_at = CURRENT_TIMESTAMP
+    WHERE status = 'sending' AND owner_id % $1 = $2;
+"""
+COUNT_PENDING_OUTBOX_SQL = """
+    SELECT count(*) FROM greeting_outbox WHERE status IN ('pending', 'sending');
+"""
+INSERT_OWNER_SQL = f"""
+    WITH inserted AS (
+        INSERT INTO owners (telegram_id) VALUES ($1::bigint)
+        ON CONFLICT (telegram_id) DO NOTHING
+    )
+    SELECT pg_notify('{OWNERS_CHANNEL}', $1::bigint::text);
+"""
+SELECT_OWNERS_SQL = "SELECT telegram_id FROM owners ORDER BY telegram_id;"
+SELECT_PEERS_SQL = """
+    SELECT username, peer_type, peer_id, access_hash,
+           EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - resolved_at)::float8 AS age
+    FROM resolved_peers
+    WHERE owner_id = $1 AND username = ANY($2::text[])
+      AND resolved_at > CURRENT_TIMESTAMP - make_interval(secs => $3::float8);
+"""
+UPSERT_PEERS_SQL = """
+    INSERT INTO resolved_peers (owner_id, username, peer_type, peer_id, access_hash)
+    SELECT $1::bigint, * FROM unnest($2::text[], $3::text[], $4::bigint[], $5::bigint[])
+    ON CONFLICT (owner_id, username) DO UPDATE
+    SET peer_type = EXCLUDED.peer_type, peer_id = EXCLUDED.peer_id,
+        access_hash = EXCLUDED.access_hash, resolved_at = CURRENT_TIMESTAMP;
+"""
+DELETE_PEER_SQL = "DELETE FROM resolved_peers WHERE owner_id = $1 AND username = $2;"
+# Rows from before multi-tenancy belong to the default owner (TELEGRAM_ID)
+# Rows untouched for longer than the TTL ($2 / $3 seconds) count as empty
+SELECT_FSM_SQL = """
+    SELECT state, data,
+           EXTRACT(EPOCH FROM updated_at + make_interval(secs => $2::float8)
+                   - CURRENT_TIMESTAMP::timestamp)::float8 AS expires_in
+    FROM fsm_states
+    WHERE key = $1 AND updated_at > CURRENT_TIMESTAMP - make_interval(secs => $2::float8);
+"""
+SET_FSM_STATE_SQL = f"""
+    WITH upsert AS (
+        INSERT INTO fsm_states AS f (key, state) VALUES ($1, $2)
+        ON CONFLICT (key) DO UPDATE
+        SET state = EXCLUDED.state, updated_at = CURRENT_TIMESTAMP,
+            data = CASE WHEN f.updated_at > CURRENT_TIMESTAMP - make_interval(secs => $3::float8)
+                        THEN f.data ELSE '{{}}'::jsonb END
+    )
+    SELECT pg_notify('{FSM_CHANNEL}', $4);
+"""
+SET_FSM_DATA_SQL = f"""
+    WITH upsert AS (
+        INSERT INTO fsm_states AS f (key, data) VALUES ($1, $2)
+        ON CONFLICT (key) DO UPDATE
+        SET data = EXCLUDED.data, updated_at = CURRENT_TIMESTAMP,
+            state = CASE WHEN f.updated_at > CURRENT_TIMESTAMP - make_interval(secs => $3::float8)
+                         THEN f.state END
+    )
+    SELECT pg_notify('{FSM_CHANNEL}', $4);
+"""
+DELETE_FSM_SQL = f"""
+    WITH deleted AS (DELETE FROM fsm_states WHERE key = $1)
+    SELECT pg_notify('{FSM_CHANNEL}', $2);
+"""
+PRUNE_FSM_SQL = """
+    DELETE FROM fsm_states WHERE updated_at < CURRENT_TIMESTAMP - make_interval(secs => $1::float8);
+"""
+CREATE_LOG_PARTITION_SQL = "SELECT create_log_partition($1::date);"
+SELECT_LOG_PARTITIONS_SQL = """
+    SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'logs'::regclass AND c.relname ~ '^logs_[0-9]{8}$'
+    ORDER BY c.relname;
+"""
+PRUNE_DEFAULT_LOGS_SQL = "DELETE FROM logs_default WHERE timestamp < $1::date;"
+ADOPT_LEGACY_ROWS_SQL = """
+    WITH adopted AS (
+        UPDATE holidays SET owner_id = $1 WHERE owner_id IS NULL RETURNING id
+    )
+    UPDATE greeting_outbox SET owner_id = $1 WHERE owner_id IS NULL;
+"""
+
+# One pool per event loop: asyncpg connections are bound to the loop that created them
+_pools = {}
+
+# Callbacks run with the owner_id after HOLIDAYS changes, in this process or
+# (while listening) elsewhere, or with None when any owner's may have changed
+_holiday_change_callbacks = []
+
+# Callbacks run with the key of FSM writes of other processes, while listening
+_fsm_change_callbacks = []
+
+# Callbacks run with the Telegram id of every registered owner, while listening
+_owner_callbacks = []
+
+# Tells this process's FSM notifications apart from those of other processes
+_process_token = uuid.uuid4().hex
+
+
+def on_holidays_changed(callback):
+    """
+    Register a callback called with the owner_id after every holiday write,
+    or with None when any owner's holidays may have changed.
+    """
+    _holiday_change_callbacks.append(callback)
+
+
+def off_holidays_changed(callback):
+    """Unregister a callback registered with on_holidays_changed, if it still is."""
+    if callback in _holiday_change_callbacks:
+        _holiday_change_callbacks.remove(callback)
+
+
+def _holidays_changed(owner_id=None):
+    for callback in list(_holiday_change_callbacks):
+        callback(owner_id)
+
+
+def on_fsm_changed(callback):
+    """
+    Register a callback called with the key of every FSM write of another
+    process, or with None when any key may have changed.
+    """
+    _fsm_change_callbacks.append(callback)
+
+
+def _fsm_changed(payload=None):
+    token, _, key = (payload or "").partition(" ")
+    if token != _process_token:
+        for callback in _fsm_change_callbacks:
+            callback(key or None)
+
+
+def on_owner_added(callback):
+    """
+    Register a callback called with the Telegram id of every owner registered
+    by any process, or with None when owners may have been missed.
+    """
+    _owner_callbacks.append(callback)
+
+
+def _owner_added(payload=None):
+    owner_id = int(payload) if payload else None
+    for callback in _owner_callbacks:
+        callback(owner_id)
+
+
+async def _init_connection(connection):
+    """Decode JSONB columns to Python objects on every pooled connection."""
+    await connection.set_type_codec(
+        "jsonb",
+        encoder=lambda value: json.dumps(value, ensure_ascii=False),
+        decoder=json.loads,
+        schema="pg_catalog",
+    )
+
+
+def _connection_params():
+    return dict(
         user=os.getenv("DB_USER"),
         password=os.getenv("DB_PASSWORD"),
         host=os.getenv("DB_HOST"),
         port=os.getenv("DB_PORT"),
-        database=os.getenv("DB_DATABASE")
+        database=os.getenv("DB_DATABASE"),
+    )
+
+
+async def connect_DB_async(server_settings=None):
+    """
+    Open a standalone connection outside the pool, e.g. for LISTEN.
+    """
+    connection = await asyncpg.connect(**_connection_params(), server_settings=server_settings)
+    await _init_connection(connection)
+    return connection
+
+
+async def _create_pool():
+    pool = await asyncpg.create_pool(
+        **_connection_params(),
+        min_size=int(os.getenv("DB_POOL_MIN_SIZE", "1")),
+        max_size=int(os.getenv("DB_POOL_MAX_SIZE", "10")),
+        init=_init_connection,
     )
+    logger.info("Database connection pool created.")
+    return pool
+
+
+async def get_pool():
+    """
+    Return the connection pool of the running event loop, creating it on first use.
+    """
+    loop = asyncio.get_running_loop()
+    task = _pools.get(loop)
+    if task is None:
+        task = _pools[loop] = loop.create_task(_create_pool())
+    try:
+        return await asyncio.shield(task)
+    except Exception:
+        # Don't cache a failed pool creation, the next call will retry
+        if _pools.get(loop) is task:
+            del _pools[loop]
+        raise
 
+
+async def close_pool():
+    """
+    Close the connection pool of the running event loop, if any.
+    """
+    task = _pools.pop(asyncio.get_running_loop(), None)
+    if task is None:
+        return
     try:
-        cursor = connection.cursor()
-
-        # Create logs table
-        cursor.execute("""
-            CREATE TABLE logs (
-                id SERIAL PRIMARY KEY,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                level TEXT NOT NULL,
-                message TEXT NOT NULL
-            );
-        """)
-        connection.commit()
-        logger.info("Table logs created successfully.")
-
-        # Create HOLIDAYS table
-        logger.info("Creating table HOLIDAYS...")
-        cursor.execute("""
-            CREATE TABLE holidays (
-                id SERIAL PRIMARY KEY,
-                name TEXT NOT NULL,
-                day INT NOT NULL CHECK (day BETWEEN 1 AND 31),
-                month INT NOT NULL CHECK (month BETWEEN 1 AND 12),
-                users JSONB,
-                text TEXT NOT NULL
-            );
-        """)
-        logger.info("Table HOLIDAYS created successfully.")
-        connection.commit()
+        pool = await task
+    except Exception:
+        return
+    await pool.close()
+    logger.info("Database connection pool closed.")
+
+
+async def wait_for_DB_async(max_delay=30):
+    """
+    Wait until the database accepts connections, retrying with exponential backoff.
+    """
+    delay = 1
+    while True:
+        try:
+            await get_pool()
+            return
+        except (OSError, asyncpg.PostgresError) as e:
+            # Not logged: the log handler itself needs the database
+            print(f"Database not reachable, retrying in {delay}s: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_delay)
+
+
+def default_owner_id():
+    """Owner of the single-tenant setup: the TELEGRAM_ID account."""
+    return int(os.getenv("TELEGRAM_ID"))
+
+
+async def migrate_DB_async():
+    """
+    Create or upgrade the schema by applying pending migrations.
+    """
+    pool = await get_pool()
+    async with pool.acquire() as connection:
+        applied = await apply_migrations(connection)
+        # Rows without an owner predate multi-tenancy, hand them to the default owner
+        async with connection.transaction():
+            await connection.execute(INSERT_OWNER_SQL, default_owner_id())
+            await connection.execute(ADOPT_LEGACY_ROWS_SQL, default_owner_id())
+    if applied:
+        logger.info(f"Database migrated to version {applied[-1]}.")
+    return applied
+
 
+async def create_tables_DB_async():
+    try:
+        await migrate_DB_async()
     except Exception as error:
         logger.error(f"An error occurred while creating tables: {error}")
-        if connection:
-            connection.rollback()
 
-    finally:
-        cursor.close()
-        connection.close()
-        logger.info("Database connection closed after table creation.")
 
-
-def drop_tables_DB():
-    connection = pg2.connect(
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD"),
-        host=os.getenv("DB_HOST"),
-        port=os.getenv("DB_PORT"),
-        database=os.getenv("DB_DATABASE")
-    )
+async def drop_tables_DB_async():
+    pool = await get_pool()
 
     try:
-        cursor = connection.cursor()
-        cursor.execute("""
-            SELECT tablename FROM pg_tables WHERE schemaname = 'public'
-        """)
-        tables = cursor.fetchall()
+        async with pool.acquire() as connection:
+            async with connection.transaction():
+                tables = await connection.fetch("""
+                    SELECT tablename FROM pg_tables WHERE schemaname = 'public'
+                """)
 
-        for table_name, in tables:
-            cursor.execute(f"DROP TABLE IF EXISTS {table_name} CASCADE;")
-        connection.commit()
+                for table in tables:
+                    await connection.execute(
+                        f"DROP TABLE IF EXISTS {table['tablename']} CASCADE;")
 
     except Exception as error:
         print(f"An error occurred while dropping tables: {error}")
-        if connection:
-            connection.rollback()
 
-    finally:
-        cursor.close()
-        connection.close()
 
+def _holiday_from_row(row):
+    return {
+        'id': row['id'],
+        "name": row['name'],
+        "day": row['day'],
+        "month": row['month'],
+        "greeted_users": list(row['users']),
+        "message": row['text'],
+        "send_time": row['send_time'],
+        "time_zone": row['time_zone'],
+        "recipient_fields": row['recipient_fields'],
+    }
 
-def add_holiday_DB(name, day, month, users, text):
-    # Serialize the list of users to JSON format
-    users_json = json.dumps(users, ensure_ascii=False)
 
-    logger.info(f"Adding holiday '{name}' to HOLIDAYS table...")
-    connection = pg2.connect(
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD"),
-        host=os.getenv("DB_HOST"),
-        port=os.getenv("DB_PORT"),
-        database=os.getenv("DB_DATABASE")
+async def _write_holidays(connection, holidays, owner_id, replace_recipients):
+    """
+    Insert or update holidays that already have ids, then link their recipients.
+    Runs a fixed number of statements however many holidays are written.
+    Returns the holidays that were written; ids owned by someone else are skipped.
+    """
+    rows = await connection.fetch(
+        UPSERT_HOLIDAYS_SQL,
+        [holiday['id'] for holiday in holidays],
+        [holiday['name'] for holiday in holidays],
+        [holiday['day'] for holiday in holidays],
+        [holiday['month'] for holiday in holidays],
+        [holiday['message'] for holiday in holidays],
+        owner_id,
+        [holiday.get('send_time') for holiday in holidays],
+        [holiday.get('time_zone') for holiday in holidays],
     )
-    logger.info("Database connection established for adding holiday.")
+    written_ids = {row['id'] for row in rows}
+    holidays = [holiday for holiday in holidays if holiday['id'] in written_ids]
+    ids = [holiday['id'] for holiday in holidays]
+    if replace_recipients:
+        await connection.execute(UNLINK_RECIPIENTS_SQL, ids)
+
+    links = [
+        (holiday['id'], username, position,
+         json.dumps(holiday.get('recipient_fields', {}).get(username, {}), ensure_ascii=False))
+        for holiday in holidays
+        for position, username in enumerate(holiday['greeted_users'])
+    ]
+    if links:
+        holiday_ids, usernames, positions, fields = map(list, zip(*links))
+        await connection.execute(INSERT_RECIPIENTS_SQL, usernames)
+        await connection.execute(LINK_RECIPIENTS_SQL, holiday_ids, usernames, positions, fields)
+    return holidays
 
-    try:
-        cursor = connection.cursor()
 
-        # Insert holiday into the table
-        cursor.execute(f"""
-            INSERT INTO holidays (name, day, month, users, text)
-            VALUES (%s, %s, %s, %s, %s);
-        """, (name, day, month, users_json, text))
+async def _allocate_holiday_ids(connection, holidays):
+    """Give every holiday without an id a fresh one from the HOLIDAYS sequence."""
+    missing = [holiday for holiday in holidays if holiday.get('id') is None]
+    if missing:
+        ids = await connection.fetch(ALLOCATE_HOLIDAY_IDS_SQL, len(missing))
+        for holiday, row in zip(missing, ids):
+            holiday['id'] = row[0]
 
-        connection.commit()
+
+async def add_holiday_DB_async(name, day, month, users, text, owner_id=None,
+                               send_time=None, time_zone=None, recipient_fields=None):
+    """
+    Add a holiday. It is sent at send_time (default 10:00) in time_zone
+    (an IANA name, default DEFAULT_TIME_ZONE). recipient_fields maps usernames
+    to the values of their custom template placeholders.
+    """
+    logger.info(f"Adding holiday '{name}' to HOLIDAYS table...")
+    owner_id = owner_id or default_owner_id()
+    pool = await get_pool()
+
+    try:
+        holiday = {"name": name, "day": day, "month": month,
+                   "greeted_users": list(users), "message": text,
+                   "send_time": send_time, "time_zone": time_zone,
+                   "recipient_fields": recipient_fields or {}}
+        async with pool.acquire() as connection:
+            async with connection.transaction():
+                # Insert holiday and its recipients into the tables
+                await _allocate_holiday_ids(connection, [holiday])
+                await _write_holidays(connection, [holiday], owner_id,
+                                      replace_recipients=False)
+        _holidays_changed(owner_id)
         logger.info(f"Holiday '{name}' added successfully")
 
     except Exception as e:
         # Handle specific errors
-        if isinstance(e, errors.UniqueViolation):
+        if isinstance(e, asyncpg.UniqueViolationError):
             logger.error("UniqueViolation: The holiday already exists.")
         else:
             logger.error(f"An error occurred: {e}")
-        if connection:
-            connection.rollback()  # Rollback transaction in case of an error
         raise e
 
-    finally:
-        cursor.close()
-        connection.close()
-        logger.info("Database connection closed after adding holiday.")
 
-
-def remove_holiday_DB(holiday_id):
+async def remove_holiday_DB_async(holiday_id, owner_id=None):
     """
-    Remove a holiday from the HOLIDAYS table by its name.
+    Remove a holiday from the HOLIDAYS table by its id.
     """
     logger.info(f"Removing holiday '{holiday_id}' from HOLIDAYS table...")
-    connection = pg2.connect(
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD"),
-        host=os.getenv("DB_HOST"),
-        port=os.getenv("DB_PORT"),
-        database=os.getenv("DB_DATABASE")
-    )
-    logger.info("Database connection established for removing holiday.")
+    owner_id = owner_id or default_owner_id()
+    pool = await get_pool()
 
     try:
-        cursor = connection.cursor()
-
-        # Delete the holiday by name
-        cursor.execute(f"""
-            DELETE FROM holidays WHERE id = %s;
-        """, (holiday_id,))
-
-        connection.commit()
+        # Delete the holiday by id, its recipient links cascade
+        await pool.execute(DELETE_HOLIDAYS_SQL, [holiday_id], owner_id)
+        _holidays_changed(owner_id)
         logger.info(f"Holiday '{holiday_id}' removed successfully.")
 
     except Exception as e:
         # Handle specific errors
-        if isinstance(e, errors.ForeignKeyViolation):
+        if isinstance(e, asyncpg.ForeignKeyViolationError):
             logger.error(
                 "ForeignKeyViolation: Cannot delete holiday due to dependent records.")
         else:
             logger.error(f"An error occurred: {e}")
-        if connection:
-            connection.rollback()  # Rollback transaction in case of an error
         raise e
 
-    finally:
-        cursor.close()
-        connection.close()
-        logger.info("Database connection closed after removing holiday.")
 
-
-def fetch_holidays_by_date_DB(dd_mm):
+async def fetch_holidays_by_date_DB_async(dd_mm, owner_id=None):
     """
     Fetch holidays for a specific date (dd-mm format) from the HOLIDAYS table.
     """
     day, month = map(int, dd_mm.split("-"))
-
-    connection = pg2.connect(
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD"),
-        host=os.getenv("DB_HOST"),
-        port=os.getenv("DB_PORT"),
-        database=os.getenv("DB_DATABASE")
-    )
-    logger.info(
-        f"Database connection established for fetching holidays on {dd_mm}.")
+    owner_id = owner_id or default_owner_id()
 
     try:
-        cursor = connection.cursor()
+        pool = await get_pool()
 
         # Query to fetch holidays matching the given day and month
-        cursor.execute("""
-            SELECT id, name, text, users
-            FROM holidays
-            WHERE day = %s AND month = %s;
-        """, (day, month))
-
-        # Fetch all matching rows
-        rows = cursor.fetchall()
-
-        holidays = []
-        for row in rows:
-            holiday_id, name, text, users = row
-
-            # If 'users' is already a list (deserialized), no need to use json.loads
-            if isinstance(users, str):
-                # Deserialize only if it's a JSON string
-                users = json.loads(users)
-
-            holidays.append({
-                'id': holiday_id,
-                "name": name,
-                "message": text,
-                "greeted_users": users
-            })
+        rows = await pool.fetch(SELECT_HOLIDAYS_BY_DATE_SQL, day, month, owner_id)
+
+        holidays = [
+            {
+                'id': row['id'],
+                "name": row['name'],
+                "message": row['text'],
+                "greeted_users": list(row['users'])
+            }
+            for row in rows
+        ]
 
         logger.info(f"Fetched {len(holidays)} holidays for {dd_mm}.")
         return holidays
@@ -223,64 +628,480 @@ def fetch_holidays_by_date_DB(dd_mm):
     except Exception as e:
         logger.error(
             f"An error occurred while fetching holidays for {dd_mm}: {e}")
-        if connection:
-            connection.rollback()
         return []
 
-    finally:
-        cursor.close()
-        connection.close()
-        logger.info("Database connection closed after fetching holidays.")
 
-
-def fetch_all_holidays_DB():
+async def fetch_all_holidays_DB_async(owner_id=None, raise_errors=False):
     """
-    Fetch all holidays from the HOLIDAYS table.
+    Fetch all holidays of an owner from the HOLIDAYS table.
+    Errors are logged and an empty list is returned unless raise_errors is set.
     """
-    connection = pg2.connect(
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD"),
-        host=os.getenv("DB_HOST"),
-        port=os.getenv("DB_PORT"),
-        database=os.getenv("DB_DATABASE")
-    )
-    logger.info("Database connection established for fetching all holidays.")
-
+    owner_id = owner_id or default_owner_id()
     try:
-        cursor = connection.cursor()
+        pool = await get_pool()
 
         # Query to fetch all holidays
-        cursor.execute("""
-            SELECT id, name, day, month, users, text
-            FROM holidays;
-        """)
-
-        # Fetch all rows
-        rows = cursor.fetchall()
-
-        holidays = []
-        for holiday_id, name, day, month, users, text in rows:
-            # Deserialize 'users' JSON if needed
-            users = json.loads(users) if isinstance(users, str) else users
-            holidays.append({
-                'id': holiday_id,
-                "name": name,
-                "day": day,
-                "month": month,
-                "greeted_users": users,
-                "message": text
-            })
+        rows = await pool.fetch(SELECT_ALL_HOLIDAYS_SQL, owner_id)
+
+        holidays = [_holiday_from_row(row) for row in rows]
 
         logger.info(f"Fetched {len(holidays)} holidays from the database.")
         return holidays
 
     except Exception as e:
         logger.error(f"An error occurred while fetching all holidays: {e}")
-        if connection:
-            connection.rollback()
+        if raise_errors:
+            raise
+        return []
+
+
+async def _iter_holidays(query, *args, prefetch):
+    pool = await get_pool()
+    async with pool.acquire() as connection:
+        async with connection.transaction():
+            async for row in connection.cursor(query, *args, prefetch=prefetch):
+                yield _holiday_from_row(row)
+
+
+async def iter_holidays_DB_async(day, month, owner_id=None, prefetch=100):
+    """
+    Stream all holidays of an owner through a server-side cursor, ordered by their
+    next occurrence counting from (day, month). Only `prefetch` rows are held in memory.
+    """
+    owner_id = owner_id or default_owner_id()
+    async for holiday in _iter_holidays(SELECT_HOLIDAYS_BY_NEXT_OCCURRENCE_SQL,
+                                        day, month, owner_id, prefetch=prefetch):
+        yield holiday
+
+
+async def iter_all_holidays_DB_async(owner_id=None, prefetch=100):
+    """Stream all holidays of an owner ordered by id through a server-side cursor."""
+    owner_id = owner_id or default_owner_id()
+    async for holiday in _iter_holidays(SELECT_ALL_HOLIDAYS_SQL, owner_id, prefetch=prefetch):
+        yield holiday
+
+
+async def remove_holidays_DB_async(holiday_ids, owner_id=None):
+    """
+    Remove many holidays of an owner by id in one statement.
+    Returns the removed holidays.
+    """
+    holiday_ids = list(holiday_ids)
+    if not holiday_ids:
+        return []
+    logger.info(f"Removing holidays {holiday_ids} from HOLIDAYS table...")
+    owner_id = owner_id or default_owner_id()
+    pool = await get_pool()
+
+    try:
+        rows = await pool.fetch(DELETE_HOLIDAYS_SQL, holiday_ids, owner_id)
+    except Exception as e:
+        logger.error(f"An error occurred while removing holidays: {e}")
+        raise e
+
+    _holidays_changed(owner_id)
+    logger.info(f"Removed {len(rows)} holidays.")
+    return [_holiday_from_row(row) for row in rows]
+
+
+async def add_holidays_DB_async(holidays, owner_id=None):
+    """
+    Insert many holidays (dicts with name, day, month, greeted_users and
+    message keys, optionally send_time, time_zone and recipient_fields) in one transaction. Returns the inserted holidays with their ids.
+    """
+    holidays = [dict(holiday, id=None) for holiday in holidays]
+    if not holidays:
         return []
+    logger.info(f"Adding {len(holidays)} holidays to HOLIDAYS table...")
+    owner_id = owner_id or default_owner_id()
+    pool = await get_pool()
+
+    try:
+        async with pool.acquire() as connection:
+            async with connection.transaction():
+                await _allocate_holiday_ids(connection, holidays)
+                await _write_holidays(connection, holidays, owner_id,
+                                      replace_recipients=False)
+    except Exception as e:
+        logger.error(f"An error occurred while adding holidays: {e}")
+        raise e
+
+    _holidays_changed(owner_id)
+    logger.info(f"Added {len(holidays)} holidays.")
+    return holidays
+
+
+async def upsert_holidays_DB_async(holidays, owner_id=None):
+    """
+    Insert or update many holidays of an owner in one transaction: holidays
+    with an existing 'id' are updated (recipients included), the others are
+    inserted. Returns the written holidays.
+    """
+    holidays = [dict(holiday) for holiday in holidays]
+    if not holidays:
+        return []
+    logger.info(f"Upserting {len(holidays)} holidays into HOLIDAYS table...")
+    owner_id = owner_id or default_owner_id()
+    pool = await get_pool()
+
+    try:
+        async with pool.acquire() as connection:
+            async with connection.transaction():
+                await _allocate_holiday_ids(connection, holidays)
+                holidays = await _write_holidays(connection, holidays, owner_id,
+                                                 replace_recipients=True)
+    except Exception as e:
+        logger.error(f"An error occurred while upserting holidays: {e}")
+        raise e
+
+    _holidays_changed(owner_id)
+    logger.info(f"Upserted {len(holidays)} holidays.")
+    return holidays
+
+
+async def import_holidays_DB_async(records, owner_id=None):
+    """
+    Load holidays with COPY in one transaction. `records` is an iterable or
+    async iterable of (line, name, day, month, send_time, time_zone, users,
+    fields, text) tuples, consumed as it is sent so it never has to fit in
+    memory; fields is the JSON of the template fields per username.
+    Returns the number of imported holidays.
+    """
+    owner_id = owner_id or default_owner_id()
+    pool = await get_pool()
+
+    try:
+        async with pool.acquire() as connection:
+            async with connection.transaction():
+                await connection.execute(CREATE_IMPORT_TABLE_SQL)
+                result = await connection.copy_records_to_table(
+                    "holiday_import", records=records, columns=IMPORT_COLUMNS)
+                await connection.execute(INSERT_IMPORTED_HOLIDAYS_SQL, owner_id)
+                await connection.execute(INSERT_IMPORTED_RECIPIENTS_SQL)
+                await connection.execute(LINK_IMPORTED_RECIPIENTS_SQL)
+    except Exception as e:
+        logger.error(f"An error occurred while importing holidays: {e}")
+        raise e
+
+    imported = int(result.split()[-1])
+    _holidays_changed(owner_id)
+    logger.info(f"Imported {imported} holidays.")
+    return imported
+
+
+async def fetch_schedule_DB_async(shard=0, shards=1):
+    """
+    Fetch id, day, month, send_time and time_zone of the holidays of the owners
+    of one shard (owner_id % shards == shard).
+    """
+    pool = await get_pool()
+    return [dict(row) for row in await pool.fetch(SELECT_SCHEDULE_SQL, shards, shard)]
+
+
+async def fetch_calendar_DB_async():
+    """
+    Fetch id, owner_id, day, month, send_time, time_zone and the number of
+    recipients of every holiday of every owner.
+    """
+    pool = await get_pool()
+    return [dict(row) for row in await pool.fetch(SELECT_CALENDAR_SQL)]
+
+
+async def fetch_greetings_DB_async(holiday_ids):
+    """
+    Fetch holiday_id, owner_id, name, text, username and fields of every
+    recipient of the given holidays, grouped by holiday.
+    """
+    pool = await get_pool()
+    return [dict(row) for row in await pool.fetch(SELECT_GREETINGS_SQL, list(holiday_ids))]
+
+
+async def materialize_outbox_DB_async(send_date, greetings):
+    """
+    Insert one pending outbox row per rendered (holiday_id, owner_id, recipient,
+    message) greeting for send_date. Rows that already exist are left
+    untouched, so this is safe to rerun.
+    """
+    pool = await get_pool()
+    holiday_ids, owner_ids, recipients, messages = (map(list, zip(*greetings))
+                                                    if greetings else ([], [], [], []))
+    result = await pool.execute(MATERIALIZE_OUTBOX_SQL, send_date, holiday_ids, owner_ids,
+                                recipients, messages)
+    inserted = int(result.split()[-1])
+    logger.info(f"Queued {inserted} greetings for {send_date:%d-%m} in the outbox.")
+    return inserted
+
+
+async def claim_outbox_DB_async(limit, lease_seconds, shard=0, shards=1, skip_owners=()):
+    """
+    Claim up to `limit` due outbox rows of a shard for sending, except those of skip_owners.
+    Rows stuck in 'sending' longer than the lease (e.g. after a crash) are claimed again.
+    """
+    pool = await get_pool()
+    rows = await pool.fetch(
+        CLAIM_OUTBOX_SQL, limit, float(lease_seconds), shards, shard, list(skip_owners))
+    return [dict(row) for row in rows]
+
+
+async def release_outbox_claims_DB_async(shard=0, shards=1):
+    """
+    Hand the rows a shard's previous scheduler left in 'sending' back to 'pending'
+    without waiting for their lease. Returns the number of released rows.
+    """
+    pool = await get_pool()
+    result = await pool.execute(RELEASE_OUTBOX_CLAIMS_SQL, shards, shard)
+    return int(result.split()[-1])
+
+
+async def mark_outbox_sent_DB_async(outbox_id):
+    pool = await get_pool()
+    await pool.execute(MARK_OUTBOX_SENT_SQL, outbox_id)
+
+
+async def mark_outbox_failed_DB_async(outbox_id, error, max_attempts, backoff_seconds):
+    """
+    Record a failed attempt: retry with exponential backoff or move the row to 'dead'.
+    Returns the new status.
+    """
+    pool = await get_pool()
+    status = await pool.fetchval(
+        MARK_OUTBOX_FAILED_SQL, outbox_id, str(error), max_attempts, float(backoff_seconds))
+    if status == "dead":
+        logger.error(f"Outbox row {outbox_id} moved to dead-letter: {error}")
+    return status
+
+
+async def next_outbox_attempt_DB_async(lease_seconds, shard=0, shards=1):
+    """
+    Return the seconds until the next unfinished outbox row of a shard becomes
+    claimable (negative if one is already due), or None when nothing is left to send.
+    """
+    pool = await get_pool()
+    return await pool.fetchval(
+        NEXT_OUTBOX_ATTEMPT_SQL, float(lease_seconds), shards, shard)
+
+
+async def count_pending_outbox_DB_async():
+    """Number of greetings that are not yet sent or dead-lettered."""
+    pool = await get_pool()
+    return await pool.fetchval(COUNT_PENDING_OUTBOX_SQL)
+
+
+async def add_owner_DB_async(telegram_id):
+    """Register an account owner, a no-op if it already exists."""
+    pool = await get_pool()
+    await pool.execute(INSERT_OWNER_SQL, telegram_id)
+    logger.info(f"Owner {telegram_id} registered.")
+
+
+async def fetch_owners_DB_async():
+    pool = await get_pool()
+    return [row['telegram_id'] for row in await pool.fetch(SELECT_OWNERS_SQL)]
+
+
+async def fetch_peers_DB_async(owner_id, usernames, ttl_seconds):
+    """
+    Fetch the peers an owner resolved for the given usernames within the last
+    ttl_seconds, with their age in seconds.
+    """
+    pool = await get_pool()
+    rows = await pool.fetch(SELECT_PEERS_SQL, owner_id, list(usernames), float(ttl_seconds))
+    return [dict(row) for row in rows]
+
+
+async def save_peers_DB_async(owner_id, peers):
+    """Store resolved peers, (username, peer_type, peer_id, access_hash) tuples, of an owner."""
+    if not peers:
+        return
+    usernames, peer_types, peer_ids, access_hashes = map(list, zip(*peers))
+    pool = await get_pool()
+    await pool.execute(UPSERT_PEERS_SQL, owner_id, usernames, peer_types, peer_ids, access_hashes)
+
+
+async def delete_peer_DB_async(owner_id, username):
+    pool = await get_pool()
+    await pool.execute(DELETE_PEER_SQL, owner_id, username)
+
+
+async def fetch_fsm_DB_async(key, ttl_seconds):
+    """
+    Return the state, data and seconds until expiry of an FSM key, or None
+    when it has no row younger than the TTL.
+    """
+    pool = await get_pool()
+    row = await pool.fetchrow(SELECT_FSM_SQL, key, float(ttl_seconds))
+    return dict(row) if row is not None else None
+
+
+async def set_fsm_state_DB_async(key, state, ttl_seconds):
+    pool = await get_pool()
+    await pool.execute(SET_FSM_STATE_SQL, key, state, float(ttl_seconds), f"{_process_token} {key}")
+
+
+async def set_fsm_data_DB_async(key, data, ttl_seconds):
+    pool = await get_pool()
+    await pool.execute(SET_FSM_DATA_SQL, key, data, float(ttl_seconds), f"{_process_token} {key}")
+
+
+async def delete_fsm_DB_async(key):
+    pool = await get_pool()
+    await pool.execute(DELETE_FSM_SQL, key, f"{_process_token} {key}")
+
+
+async def prune_fsm_DB_async(ttl_seconds):
+    """Delete the FSM rows untouched for longer than the TTL. Returns their number."""
+    pool = await get_pool()
+    result = await pool.execute(PRUNE_FSM_SQL, float(ttl_seconds))
+    return int(result.split()[-1])
+
+
+async def create_log_partitions_DB_async(first_day, days):
+    """
+    Make sure the logs table has the partitions of `days` days from first_day on.
+    Returns the days whose partition was created.
+    """
+    pool = await get_pool()
+    created = []
+    for offset in range(days):
+        day = first_day + timedelta(days=offset)
+        if await pool.fetchval(CREATE_LOG_PARTITION_SQL, day):
+            created.append(day)
+    return created
+
+
+async def drop_log_partitions_DB_async(before):
+    """
+    Drop the logs partitions of the days before `before` and delete the older
+    rows of logs_default. Returns the names of the dropped partitions.
+    """
+    pool = await get_pool()
+    dropped = []
+    for row in await pool.fetch(SELECT_LOG_PARTITIONS_SQL):
+        name = row['relname']
+        if datetime.strptime(name[len("logs_"):], "%Y%m%d").date() >= before:
+            break
+        # The name matched logs_YYYYMMDD, so it's safe to interpolate
+        await pool.execute(f"DROP TABLE IF EXISTS {name};")
+        dropped.append(name)
+    await pool.execute(PRUNE_DEFAULT_LOGS_SQL, before)
+    return dropped
+
+
+async def maintain_log_partitions(interval=3600):
+    """
+    Create the logs partitions of today and the next LOG_PARTITIONS_AHEAD days
+    and drop those older than LOG_RETENTION_DAYS (0 keeps everything), every
+    `interval` seconds.
+    """
+    ahead = int(os.getenv("LOG_PARTITIONS_AHEAD", "3"))
+    retention_days = int(os.getenv("LOG_RETENTION_DAYS", "30"))
+    while True:
+        try:
+            today = date.today()
+            created = await create_log_partitions_DB_async(today, ahead + 1)
+            if created:
+                logger.info(f"Created logs partitions for {', '.join(f'{day:%d-%m}' for day in created)}.")
+            if retention_days:
+                dropped = await drop_log_partitions_DB_async(today - timedelta(days=retention_days))
+                if dropped:
+                    logger.info(f"Dropped {len(dropped)} logs partitions older than {retention_days} days.")
+        except Exception as e:
+            logger.error(f"An error occurred while maintaining the logs partitions: {e}")
+        await asyncio.sleep(interval)
+
+
+async def listen_changes_DB_async():
+    """
+    Run the holiday, FSM and owner callbacks on NOTIFYs from other processes.
+    Runs forever, reconnecting when the listening connection drops.
+    """
+    while True:
+        connection = None
+        try:
+            connection = await connect_DB_async()
+            closed = asyncio.Event()
+            connection.add_termination_listener(lambda _: closed.set())
+            await connection.add_listener(
+                HOLIDAYS_CHANNEL,
+                lambda connection, pid, channel, payload: _holidays_changed(int(payload) if payload else None))
+            await connection.add_listener(
+                FSM_CHANNEL, lambda connection, pid, channel, payload: _fsm_changed(payload))
+            await connection.add_listener(
+                OWNERS_CHANNEL, lambda connection, pid, channel, payload: _owner_added(payload))
+            # Changes may have been missed while disconnected
+            _holidays_changed()
+            _fsm_changed()
+            _owner_added()
+            logger.info("Listening for holiday and FSM changes.")
+            await closed.wait()
+            logger.error("Change listener disconnected.")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"An error occurred in the change listener: {e}")
+        finally:
+            if connection is not None and not connection.is_closed():
+                await connection.close()
+        await asyncio.sleep(5)
+
+
+# Time every DB call; the listener runs forever and isn't a call
+for _name, _function in list(globals().items()):
+    if (_name.endswith("_DB_async") and _name != "listen_changes_DB_async"
+            and (inspect.iscoroutinefunction(_function) or inspect.isasyncgenfunction(_function))):
+        globals()[_name] = observe_db(_function)
+
+
+# Synchronous compatibility shim.
+# Scripts and notebooks can keep calling the old blocking functions; they are
+# executed on a private event loop thread that owns its own pool.
+_sync_loop = None
+_sync_loop_lock = threading.Lock()
+
+
+def _run_sync(coro):
+    global _sync_loop
+    with _sync_loop_lock:
+        if _sync_loop is None:
+            _sync_loop = asyncio.new_event_loop()
+            threading.Thread(target=_sync_loop.run_forever,
+                             name="db-sync-shim", daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coro, _sync_loop).result()
+
+
+def create_tables_DB():
+    return _run_sync(create_tables_DB_async())
+
+
+def drop_tables_DB():
+    return _run_sync(drop_tables_DB_async())
+
+
+def add_holiday_DB(name, day, month, users, text, owner_id=None,
+                  send_time=None, time_zone=None, recipient_fields=None):
+    return _run_sync(add_holiday_DB_async(name, day, month, users, text, owner_id,
+                                          send_time, time_zone, recipient_fields))
+
+
+def remove_holiday_DB(holiday_id, owner_id=None):
+    return _run_sync(remove_holiday_DB_async(holiday_id, owner_id))
+
+
+def fetch_holidays_by_date_DB(dd_mm, owner_id=None):
+    return _run_sync(fetch_holidays_by_date_DB_async(dd_mm, owner_id))
+
+
+def fetch_all_holidays_DB(owner_id=None):
+    return _run_sync(fetch_all_holidays_DB_async(owner_id))
+
+
+def remove_holidays_DB(holiday_ids, owner_id=None):
+    return _run_sync(remove_holidays_DB_async(holiday_ids, owner_id))
+
+
+def add_holidays_DB(holidays, owner_id=None):
+    return _run_sync(add_holidays_DB_async(holidays, owner_id))
+
 
-    finally:
-        cursor.close()
-        connection.close()
-        logger.info("Database connection closed after fetching all holidays.")
+def upsert_holidays_DB(holidays, owner_id=None):
+    return _run_sync(upsert_holidays_DB_async(holidays, owner_id))
@@ -0,0 +1,118 @@
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+from db_interaction import (fetch_fsm_DB_async, set_fsm_state_DB_async, set_fsm_data_DB_async,
+                            delete_fsm_DB_async, prune_fsm_DB_async, on_fsm_changed)
+from custom_logging import logger
+
+
+EMPTY_DATA = "{}"
+
+
+def _dump(data):
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+class PostgresStorage(BaseStorage):
+    """
+    FSM storage in the fsm_states table, so unfinished conversations survive
+    restarts and are shared by replicas. Keys untouched for `ttl_seconds` count
+    as empty and their rows are pruned.
+
+    The last `cache_size` keys, including those without a state, are kept in
+    an LRU front cache with their data as JSON text. Writes of other processes
+    evict the key while listen_changes_DB_async runs.
+    """
+
+    def __init__(self, ttl_seconds=86400, cache_size=1000):
+        self.ttl_seconds = ttl_seconds
+        self.cache_size = cache_size
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        # key -> (state, data as JSON, monotonic expiry), least recently used first
+        self._cache = OrderedDict()
+        on_fsm_changed(self.invalidate)
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            ttl_seconds=float(os.getenv("FSM_TTL_HOURS", "24")) * 3600,
+            cache_size=int(os.getenv("FSM_CACHE_SIZE", "1000")),
+        )
+
+    def invalidate(self, key=None):
+        """Drop a key, or every key, from the front cache."""
+        if key is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(key, None)
+
+    def _remember(self, key, state, data, expires_in):
+        if not self.cache_size:
+            return
+        self._cache[key] = (state, data, time.monotonic() + expires_in)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _load(self, key):
+        """(state, data as JSON) of a key, from the front cache or the table."""
+        entry = self._cache.get(key)
+        if entry is not None and entry[2] > time.monotonic():
+            self._cache.move_to_end(key)
+            return entry[0], entry[1]
+        row = await fetch_fsm_DB_async(key, self.ttl_seconds)
+        if row is None:
+            state, data, expires_in = None, EMPTY_DATA, self.ttl_seconds
+        else:
+            state, data, expires_in = row['state'], _dump(row['data']), row['expires_in']
+        self._remember(key, state, data, expires_in)
+        return state, data
+
+    async def set_state(self, key, state=None):
+        key = self.key_builder.build(key)
+        state = state.state if isinstance(state, State) else state
+        _, data = await self._load(key)
+        if state is None and data == EMPTY_DATA:
+            await delete_fsm_DB_async(key)
+        else:
+            await set_fsm_state_DB_async(key, state, self.ttl_seconds)
+        self._remember(key, state, data, self.ttl_seconds)
+
+    async def get_state(self, key):
+        state, _ = await self._load(self.key_builder.build(key))
+        return state
+
+    async def set_data(self, key, data):
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(
+                f"Data must be a dict or dict-like object, got {type(data).__name__}")
+        key = self.key_builder.build(key)
+        state, _ = await self._load(key)
+        if state is None and not data:
+            await delete_fsm_DB_async(key)
+        else:
+            await set_fsm_data_DB_async(key, data, self.ttl_seconds)
+        self._remember(key, state, _dump(data), self.ttl_seconds)
+
+    async def get_data(self, key):
+        _, data = await self._load(self.key_builder.build(key))
+        return json.loads(data)
+
+    async def close(self):
+        pass
+
+    async def prune_forever(self, interval=3600):
+        """Delete the rows of abandoned conversations every `interval` seconds."""
+        while True:
+            try:
+                pruned = await prune_fsm_DB_async(self.ttl_seconds)
+                if pruned:
+                    logger.info(f"Pruned {pruned} abandoned FSM states.")
+            except Exception as e:
+                logger.error(f"An error occurred while pruning FSM states: {e}")
+            await asyncio.sleep(interval)
@@ -0,0 +1,161 @@
+import asyncio
+import os
+import random
+from pyrogram.errors import FloodWait
+from metrics import FLOOD_WAITS, SEND_FAILURES
+from custom_logging import logger
+
+
+def _now():
+    # The event loop's clock, so the dispatcher also runs on simulation.py's virtual one
+    return asyncio.get_running_loop().time()
+
+
+class TokenBucket:
+    """
+    Async token bucket: `rate` tokens per second with bursts up to `capacity`.
+    A rate of 0 disables limiting.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = self.capacity
+        self.updated = None
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = _now()
+                if self.updated is None:
+                    self.updated = now
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class HumanLikePacing:
+    """Random pause after every send, like a person typing greetings one by one."""
+
+    def __init__(self, min_delay=5, max_delay=60):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+
+    async def wait(self):
+        delay = random.uniform(self.min_delay, self.max_delay)
+        logger.info(f"Waiting {delay:.0f} seconds before sending the next greeting.")
+        await asyncio.sleep(delay)
+
+
+class NoPacing:
+    async def wait(self):
+        pass
+
+
+class GreetingDispatcher:
+    """
+    Sends greetings with bounded concurrency under a token bucket and pauses
+    all workers for as long as Telegram asks when a FloodWait is raised.
+    """
+
+    def __init__(self, concurrency=4, rate=1.0, burst=5, pacing=None,
+                 max_flood_retries=3):
+        self.concurrency = max(concurrency, 1)
+        self.bucket = TokenBucket(rate, burst)
+        self.pacing = pacing or NoPacing()
+        self.max_flood_retries = max_flood_retries
+        self._resume_at = 0.0
+
+    @classmethod
+    def from_env(cls):
+        if os.getenv("GREETING_PACING", "none") == "human":
+            pacing = HumanLikePacing(
+                float(os.getenv("GREETING_JITTER_MIN", "5")),
+                float(os.getenv("GREETING_JITTER_MAX", "60")))
+        else:
+            pacing = NoPacing()
+        return cls(
+            concurrency=int(os.getenv("GREETING_CONCURRENCY", "4")),
+            rate=float(os.getenv("GREETING_RATE", "1")),
+            burst=int(os.getenv("GREETING_BURST", "5")),
+            pacing=pacing,
+        )
+
+    async def _wait_flood(self):
+        delay = self._resume_at - _now()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _send_one(self, send, job, report, on_failure):
+        username = job[0]
+        error = None
+        for attempt in range(self.max_flood_retries + 1):
+            await self._wait_flood()
+            await self.bucket.acquire()
+            try:
+                await send(*job)
+                report["sent"] += 1
+                return
+            except FloodWait as e:
+                error = e
+                report["flood_waits"] += 1
+                FLOOD_WAITS.inc()
+                self._resume_at = max(self._resume_at, _now() + e.value)
+                logger.info(
+                    f"FloodWait while greeting {username}: pausing sends for {e.value} seconds.")
+            except Exception as e:
+                error = e
+                logger.error(
+                    f"An error occurred while sending holiday message to {username}: {e}")
+                break
+        else:
+            logger.error(
+                f"Giving up on {username} after {self.max_flood_retries} FloodWait retries.")
+
+        report["failed"] += 1
+        SEND_FAILURES.inc()
+        if on_failure is not None:
+            try:
+                await on_failure(job, error)
+            except Exception as e:
+                logger.error(f"Failure callback for {username} raised: {e}")
+
+    async def run(self, jobs, send, on_failure=None):
+        """
+        Call `send(*job)` for every job, a tuple starting with (username, message),
+        and `on_failure(job, error)` for jobs that could not be sent.
+        Returns a report with sent/failed/flood_waits counts, elapsed seconds
+        and throughput.
+        """
+        queue = asyncio.Queue()
+        for job in jobs:
+            queue.put_nowait(job)
+        report = {"sent": 0, "failed": 0, "flood_waits": 0}
+
+        async def worker():
+            while True:
+                try:
+                    job = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                await self._send_one(send, job, report, on_failure)
+                if not queue.empty():
+                    await self.pacing.wait()
+
+        started = _now()
+        workers = min(self.concurrency, queue.qsize())
+        await asyncio.gather(*(worker() for _ in range(workers)))
+        report["elapsed"] = _now() - started
+        report["rate"] = report["sent"] / report["elapsed"] if report["elapsed"] else 0.0
+        logger.info(
+            f"Dispatched {report['sent']} greetings ({report['failed']} failed, "
+            f"{report['flood_waits']} FloodWaits) in {report['elapsed']:.1f}s, "
+            f"{report['rate']:.2f} msg/s.")
+        return report
@@ -0,0 +1,122 @@
+import re
+import string
+from functools import lru_cache
+from itertools import groupby
+from operator import itemgetter
+from custom_logging import logger
+
+
+# Placeholders every recipient has a value for; any other one is a custom
+# field that has to be given per recipient, e.g. @anna nickname=Annie
+BUILTIN_FIELDS = frozenset({"name", "username", "holiday", "years"})
+
+FIELD_NAME = re.compile(r"[A-Za-z_][A-Za-z0-9_]*\Z")
+
+# Compiled templates kept in memory; a day's send list rarely uses more
+TEMPLATE_CACHE_SIZE = 1024
+
+
+class TemplateError(ValueError):
+    pass
+
+
+class GreetingTemplate:
+    """A greeting text split into literal text and placeholders once, rendered many times."""
+
+    __slots__ = ("text", "fields", "_segments")
+
+    def __init__(self, text, segments):
+        self.text = text
+        # (literal text, placeholder or None) pairs in order
+        self._segments = tuple(segments)
+        self.fields = frozenset(field for _, field in self._segments if field is not None)
+
+    @property
+    def custom_fields(self):
+        return self.fields - BUILTIN_FIELDS
+
+    def render(self, values):
+        return "".join([literal + values[field] if field is not None else literal
+                        for literal, field in self._segments])
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def compile_template(text):
+    """
+    Parse a greeting text: {field} is a placeholder, {{ and }} are literal braces.
+    Raises TemplateError for unbalanced braces and placeholders that aren't plain names.
+    """
+    try:
+        parsed = list(string.Formatter().parse(text))
+    except ValueError as e:
+        raise TemplateError(f"{e}; write {{{{ and }}}} for literal braces") from None
+
+    segments = []
+    for literal, field, spec, conversion in parsed:
+        if field is not None and (spec or conversion or not FIELD_NAME.match(field)):
+            placeholder = field + (f"!{conversion}" if conversion else "") + (f":{spec}" if spec else "")
+            raise TemplateError(f"invalid placeholder {{{placeholder}}}, use names like {{name}}")
+        segments.append((literal, field))
+    return GreetingTemplate(text, segments)
+
+
+class _Values(dict):
+    # A field missing at send time is left as its placeholder instead of failing the batch
+    def __missing__(self, field):
+        return "{" + field + "}"
+
+
+def recipient_values(username, fields, holiday, send_date):
+    """Values of the placeholders for one recipient of a holiday sent on send_date."""
+    values = _Values(name=username.lstrip("@"), username=username, holiday=holiday)
+    if str(fields.get("since", "")).isdigit():
+        values["years"] = str(send_date.year - int(fields["since"]))
+    values.update(fields)
+    return values
+
+
+def missing_fields(template, users, recipient_fields):
+    """Map each username to the placeholders of `template` it has no value for."""
+    needed = template.fields - {"name", "username", "holiday"}
+    missing = {}
+    for user in users:
+        fields = recipient_fields.get(user, {})
+        lacking = sorted(field for field in needed
+                         if field not in fields and not (field == "years" and "since" in fields))
+        if lacking:
+            missing[user] = lacking
+    return missing
+
+
+def render_batch(text, recipients, holiday, send_date):
+    """
+    Render one holiday's greeting for every (username, fields) recipient,
+    parsing the text at most once. A text that isn't a valid template, e.g.
+    one saved before templates existed, is sent verbatim.
+    """
+    try:
+        template = compile_template(text)
+    except TemplateError as e:
+        logger.warning(f"The greeting of '{holiday}' is sent verbatim: {e}")
+        return [text] * len(recipients)
+    if not template.fields:
+        return [template.render({})] * len(recipients)
+    return [template.render(recipient_values(username, fields, holiday, send_date))
+            for username, fields in recipients]
+
+
+def render_greetings(rows, send_date):
+    """
+    Render the send list of a day before dispatch: `rows` have holiday_id,
+    owner_id, name, text, username and fields, grouped by holiday. Returns
+    (holiday_id, owner_id, recipient, message) tuples.
+    """
+    greetings = []
+    for holiday_id, group in groupby(rows, key=itemgetter('holiday_id')):
+        group = list(group)
+        first = group[0]
+        messages = render_batch(first['text'], [(row['username'], row['fields']) for row in group],
+                                first['name'], send_date)
+        greetings.extend((holiday_id, first['owner_id'], row['username'], message)
+                         for row, message in zip(group, messages))
+    return greetings
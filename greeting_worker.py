@@ -0,0 +1,85 @@
+import asyncio
+import multiprocessing
+import os
+import sys
+from db_interaction import (close_pool, listen_changes_DB_async, wait_for_DB_async,
+                            release_outbox_claims_DB_async)
+from scheduler import GreetingScheduler
+from leader import LeaderElection
+from metrics import start_metrics_server
+from custom_logging import logger, attach_db_handler, close_db_handler
+import user_account
+
+
+async def send_holiday_greetings(shard=0, shards=1):
+    """
+    Greeting scheduler for the owners of one shard (owner_id % shards == shard),
+    run by whichever replica currently leads the shard.
+    """
+    async def lead():
+        # Whatever the previous leader was sending is sent again right away;
+        # the outbox random_id makes Telegram drop the ones that did go out
+        released = await release_outbox_claims_DB_async(shard, shards)
+        if released:
+            logger.info(f"Resuming {released} greetings left by the previous leader of shard {shard}.")
+        # The catch-up policy requeues today's windows that passed without a leader
+        await GreetingScheduler.from_env(shard, shards).run()
+
+    await LeaderElection.from_env(shard, shards).run(lead)
+
+
+def run_worker(shard, shards):
+    """Entry point of a greeting worker process: owns the Pyrogram clients of its shard."""
+    # The bot process keeps the session files open, work on copies of them
+    user_account.use_session_copies(f"worker{shard}")
+
+    async def main():
+        await wait_for_DB_async()
+        attach_db_handler()
+        logger.info(f"Greeting worker {shard}/{shards} started.")
+        # Each worker serves its own metrics on the port after the bot's
+        port = int(os.getenv("METRICS_PORT", "8000"))
+        if port:
+            start_metrics_server(port + 1 + shard)
+        # Holidays are edited by the bot process, follow its changes
+        listener = asyncio.create_task(listen_changes_DB_async())
+        try:
+            await send_holiday_greetings(shard, shards)
+        finally:
+            listener.cancel()
+            await user_account.stop_all_clients()
+            await close_pool()
+            close_db_handler()
+
+    asyncio.run(main())
+
+
+def start_worker(shard, shards):
+    process = multiprocessing.get_context("spawn").Process(
+        target=run_worker, args=(shard, shards),
+        name=f"greeting-worker-{shard}", daemon=True)
+    process.start()
+    return process
+
+
+async def supervise_workers(shards, check_interval=30):
+    """
+    Run one worker process per shard and restart the ones that die.
+    """
+    processes = [start_worker(shard, shards) for shard in range(shards)]
+    try:
+        while True:
+            await asyncio.sleep(check_interval)
+            for shard, process in enumerate(processes):
+                if not process.is_alive():
+                    logger.error(
+                        f"Greeting worker {shard} exited with code {process.exitcode}, restarting.")
+                    processes[shard] = start_worker(shard, shards)
+    finally:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == "__main__":
+    # Run a single shard, e.g. as its own container: python greeting_worker.py 0 4
+    run_worker(int(sys.argv[1]), int(sys.argv[2]))
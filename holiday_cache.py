@@ -0,0 +1,58 @@
+import asyncio
+from db_interaction import fetch_all_holidays_DB_async, on_holidays_changed
+from custom_logging import logger
+
+
+class HolidayCalendar:
+    """
+    In-memory copy of every owner's holidays.
+    An owner's calendar is loaded on first read and dropped whenever that
+    owner's holidays change, either by this process or, with
+    listen_changes_DB_async running, by any other replica.
+    """
+
+    def __init__(self):
+        # owner_id -> holidays
+        self._calendars = {}
+        # owner_id -> invalidations of that owner, None -> of every owner
+        self._generations = {}
+        self._lock = asyncio.Lock()
+
+    def _generation(self, owner_id):
+        return self._generations.get(None, 0), self._generations.get(owner_id, 0)
+
+    def invalidate(self, owner_id=None):
+        """Drop the calendar of `owner_id`, or of every owner if it is None."""
+        self._generations[owner_id] = self._generations.get(owner_id, 0) + 1
+        if owner_id is None:
+            self._calendars = {}
+        else:
+            self._calendars.pop(owner_id, None)
+
+    async def _load(self, owner_id):
+        calendar = self._calendars.get(owner_id)
+        if calendar is not None:
+            return calendar
+        async with self._lock:
+            calendar = self._calendars.get(owner_id)
+            if calendar is not None:
+                return calendar
+            generation = self._generation(owner_id)
+            calendar = await fetch_all_holidays_DB_async(owner_id, raise_errors=True)
+            # Don't publish a snapshot that was invalidated while loading
+            if generation == self._generation(owner_id):
+                self._calendars[owner_id] = calendar
+            return calendar
+
+    async def all(self, owner_id):
+        """Return every holiday of an owner, in the shape of fetch_all_holidays_DB_async."""
+        try:
+            holidays = await self._load(owner_id)
+        except Exception as e:
+            logger.error(f"An error occurred while loading the holiday calendar: {e}")
+            return []
+        return list(holidays)
+
+
+holiday_calendar = HolidayCalendar()
+on_holidays_changed(holiday_calendar.invalidate)
@@ -0,0 +1,362 @@
+import argparse
+import asyncio
+import csv
+import json
+import os
+import shlex
+from datetime import date, datetime, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from db_interaction import import_holidays_DB_async, iter_all_holidays_DB_async, close_pool
+from greeting_templates import FIELD_NAME, compile_template, missing_fields
+from custom_logging import logger, attach_db_handler, close_db_handler
+
+
+# CSV layout of import and export; time and time_zone may be left empty
+CSV_FIELDS = ["name", "date", "time", "time_zone", "users", "message"]
+
+# Only the first errors are kept in the report, the rest are just counted
+MAX_REPORTED_ERRORS = 50
+
+# Yield to the event loop every this many parsed rows
+ROWS_PER_YIELD = 500
+
+# Exported events repeat yearly from a leap year, so 29-02 is valid
+ICS_BASE_YEAR = 2000
+
+
+def parse_date(text):
+    """Parse DD-MM into (day, month), rejecting dates that never occur."""
+    date_parts = text.split("-")
+    if len(date_parts) != 2 or not all(part.isdigit() for part in date_parts):
+        raise ValueError(f"invalid date '{text}', expected DD-MM")
+    day, month = map(int, date_parts)
+    try:
+        date(ICS_BASE_YEAR, month, day)
+    except ValueError:
+        raise ValueError(f"date '{text}' doesn't exist")
+    return day, month
+
+
+def parse_time(text):
+    try:
+        return datetime.strptime(text, "%H:%M").time()
+    except ValueError:
+        raise ValueError(f"invalid time '{text}', expected HH:MM")
+
+
+def check_time_zone(name):
+    try:
+        ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"unknown time zone '{name}'")
+    return name
+
+
+def parse_holiday_date(text):
+    """
+    Parse 'DD-MM [HH:MM [Area/City]]' into (day, month, send_time, time_zone);
+    the missing parts are None.
+    """
+    fields = text.split()
+    if not 1 <= len(fields) <= 3:
+        raise ValueError("expected DD-MM, optionally followed by HH:MM and a time zone")
+    day, month = parse_date(fields[0])
+    send_time = parse_time(fields[1]) if len(fields) > 1 else None
+    time_zone = check_time_zone(fields[2]) if len(fields) > 2 else None
+    return day, month, send_time, time_zone
+
+
+def parse_recipients(text, required=True):
+    """
+    Parse usernames, each optionally followed by its template fields, e.g.
+    `@anna name="Anna Maria" since=1990 @bob`. Returns the usernames and a
+    dict of the fields of the users that have any. An empty list is only
+    accepted when not `required`.
+    """
+    try:
+        tokens = shlex.split(text)
+    except ValueError as e:
+        raise ValueError(f"can't read the users: {e}") from None
+    users, recipient_fields, invalid_users = [], {}, []
+    for token in tokens:
+        key, is_field, value = token.partition("=")
+        if token.startswith("@") and len(token) > 1:
+            users.append(token)
+        elif is_field and users and not token.startswith("@"):
+            if not FIELD_NAME.match(key) or key == "username":
+                raise ValueError(f"invalid field name: {key}")
+            if key == "since" and not value.isdigit():
+                raise ValueError(f"since must be a year: {users[-1]} since={value}")
+            recipient_fields.setdefault(users[-1], {})[key] = value
+        else:
+            invalid_users.append(token)
+    if invalid_users:
+        raise ValueError(f"usernames must start with @: {', '.join(invalid_users)}")
+    if required and not users:
+        raise ValueError("no users to greet")
+    return users, recipient_fields
+
+
+def format_recipients(users, recipient_fields):
+    """The inverse of parse_recipients."""
+    return " ".join(
+        user + "".join(f" {key}={shlex.quote(value)}"
+                       for key, value in recipient_fields.get(user, {}).items())
+        for user in users)
+
+
+def check_template(text, users, recipient_fields):
+    """Raise ValueError if a greeting text is no valid template for these recipients."""
+    template = compile_template(text)
+    missing = missing_fields(template, users, recipient_fields)
+    if missing:
+        raise ValueError("missing template fields: " + ", ".join(
+            f"{user} ({', '.join(fields)})" for user, fields in missing.items()))
+
+
+def _new_report():
+    return {"imported": 0, "rejected": 0, "errors": []}
+
+
+def _reject(report, line, error):
+    report["rejected"] += 1
+    if len(report["errors"]) < MAX_REPORTED_ERRORS:
+        report["errors"].append((line, str(error)))
+
+
+def _record(line, name, day, month, send_time, time_zone, recipients, message):
+    if not name:
+        raise ValueError("missing name")
+    if not message:
+        raise ValueError("missing message")
+    users, recipient_fields = recipients
+    check_template(message, users, recipient_fields)
+    return (line, name, day, month, send_time, time_zone, users,
+            json.dumps(recipient_fields, ensure_ascii=False), message)
+
+
+def iter_csv_records(file, report):
+    """Yield import records from a CSV file with a CSV_FIELDS header, reporting bad rows."""
+    reader = csv.DictReader(file)
+    missing = {"name", "date", "users", "message"} - set(reader.fieldnames or [])
+    if missing:
+        raise ValueError(f"CSV header lacks the columns {', '.join(sorted(missing))}")
+    for row in reader:
+        line = reader.line_num
+        try:
+            day, month = parse_date((row["date"] or "").strip())
+            send_time = parse_time(row["time"].strip()) if (row.get("time") or "").strip() else None
+            time_zone = (row.get("time_zone") or "").strip() or None
+            if time_zone is not None:
+                check_time_zone(time_zone)
+            yield _record(line, (row["name"] or "").strip(), day, month, send_time, time_zone,
+                          parse_recipients(row["users"] or "", required=False), row["message"] or "")
+        except ValueError as error:
+            _reject(report, line, error)
+
+
+def _ics_unescape(value):
+    result, chars = [], iter(value)
+    for char in chars:
+        if char == "\\":
+            char = next(chars, "")
+            result.append("\n" if char in "nN" else char)
+        else:
+            result.append(char)
+    return "".join(result)
+
+
+def _ics_lines(file):
+    """Unfold iCalendar content lines, yielding (line number, line)."""
+    pending, start = None, 0
+    for number, line in enumerate(file, 1):
+        line = line.rstrip("\r\n")
+        if line[:1] in (" ", "\t") and pending is not None:
+            pending += line[1:]
+            continue
+        if pending is not None:
+            yield start, pending
+        pending, start = line, number
+    if pending is not None:
+        yield start, pending
+
+
+def _ics_dtstart(params, value):
+    """Return (day, month, send_time, time_zone) of a DTSTART property."""
+    day, month = parse_date(f"{value[6:8]}-{value[4:6]}")
+    if "T" not in value:
+        return day, month, None, None
+    send_time = parse_time(f"{value[9:11]}:{value[11:13]}")
+    if value.endswith("Z"):
+        return day, month, send_time, "UTC"
+    time_zone = params.get("TZID")
+    if time_zone is not None:
+        check_time_zone(time_zone)
+    return day, month, send_time, time_zone
+
+
+def iter_ics_records(file, report):
+    """
+    Yield import records from the VEVENTs of an iCalendar file: SUMMARY is the
+    name, DTSTART the date (and time), DESCRIPTION the message and
+    X-GREETING-USERS the usernames to greet with their template fields.
+    """
+    event, line = None, 0
+    for number, content in _ics_lines(file):
+        name, _, value = content.partition(":")
+        name, *param_list = name.split(";")
+        name = name.upper()
+        params = dict(param.partition("=")[::2] for param in param_list)
+        if name == "BEGIN" and value.upper() == "VEVENT":
+            event, line = {}, number
+        elif event is None:
+            continue
+        elif name == "END" and value.upper() == "VEVENT":
+            try:
+                if "DTSTART" not in event:
+                    raise ValueError("missing DTSTART")
+                day, month, send_time, time_zone = _ics_dtstart(*event["DTSTART"])
+                recipients = parse_recipients(event.get("X-GREETING-USERS", ""), required=False)
+                yield _record(line, event.get("SUMMARY", "").strip(), day, month, send_time,
+                              time_zone, recipients, event.get("DESCRIPTION", ""))
+            except ValueError as error:
+                _reject(report, line, error)
+            event = None
+        elif name == "DTSTART":
+            event[name] = (params, value.strip())
+        elif name in ("SUMMARY", "DESCRIPTION", "X-GREETING-USERS"):
+            event[name] = _ics_unescape(value)
+
+
+async def _paced(records):
+    # Keep the event loop responsive while a large file is parsed
+    for count, record in enumerate(records, 1):
+        if count % ROWS_PER_YIELD == 0:
+            await asyncio.sleep(0)
+        yield record
+
+
+def _format_of(path, file_format):
+    file_format = file_format or os.path.splitext(path)[1].lstrip(".").lower()
+    if file_format not in ("csv", "ics"):
+        raise ValueError("Only .csv and .ics files are supported")
+    return file_format
+
+
+async def import_holidays(path, owner_id=None, file_format=None):
+    """
+    Stream a CSV or .ics file into the HOLIDAYS table in one transaction.
+    Returns a report with the imported and rejected counts and the errors
+    of the rejected rows as (line, error) pairs.
+    """
+    file_format = _format_of(path, file_format)
+    report = _new_report()
+    with open(path, newline="", encoding="utf-8-sig") as file:
+        if file_format == "csv":
+            records = iter_csv_records(file, report)
+        else:
+            records = iter_ics_records(file, report)
+        report["imported"] = await import_holidays_DB_async(
+            _paced(records), owner_id)
+    logger.info(f"Imported {report['imported']} holidays from {path}, "
+                f"rejected {report['rejected']} rows.")
+    return report
+
+
+def _ics_escape(value):
+    return (value.replace("\\", "\\\\").replace(";", "\\;")
+            .replace(",", "\\,").replace("\n", "\\n"))
+
+
+def _ics_fold(line):
+    """Fold a content line into chunks of at most 75 octets."""
+    encoded = line.encode("utf-8")
+    chunks, limit = [], 75
+    while len(encoded) > limit:
+        cut = limit
+        # Don't split a multi-byte character
+        while encoded[cut] & 0xC0 == 0x80:
+            cut -= 1
+        chunks.append(encoded[:cut].decode("utf-8"))
+        encoded, limit = encoded[cut:], 74
+    chunks.append(encoded.decode("utf-8"))
+    return "\r\n ".join(chunks) + "\r\n"
+
+
+def _ics_event(holiday, stamp):
+    start = f"{ICS_BASE_YEAR}{holiday['month']:02d}{holiday['day']:02d}T{holiday['send_time']:%H%M%S}"
+    dtstart = (f"DTSTART;TZID={holiday['time_zone']}:{start}" if holiday['time_zone']
+               else f"DTSTART:{start}")
+    lines = [
+        "BEGIN:VEVENT",
+        f"UID:holiday-{holiday['id']}@greetinghelperbot",
+        f"DTSTAMP:{stamp}",
+        dtstart,
+        "RRULE:FREQ=YEARLY",
+        f"SUMMARY:{_ics_escape(holiday['name'])}",
+        f"DESCRIPTION:{_ics_escape(holiday['message'])}",
+        f"X-GREETING-USERS:{_ics_escape(format_recipients(holiday['greeted_users'], holiday['recipient_fields']))}",
+        "END:VEVENT",
+    ]
+    return "".join(_ics_fold(line) for line in lines)
+
+
+async def export_holidays(path, owner_id=None, file_format=None):
+    """
+    Write all holidays of an owner to a CSV or .ics file, streaming them from
+    a server-side cursor. Returns the number of exported holidays.
+    """
+    file_format = _format_of(path, file_format)
+    exported = 0
+    with open(path, "w", newline="", encoding="utf-8") as file:
+        if file_format == "csv":
+            writer = csv.writer(file)
+            writer.writerow(CSV_FIELDS)
+        else:
+            file.write("BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//GreetingHelperBOT//EN\r\n")
+            stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        async for holiday in iter_all_holidays_DB_async(owner_id):
+            if file_format == "csv":
+                writer.writerow([
+                    holiday['name'],
+                    f"{holiday['day']:02d}-{holiday['month']:02d}",
+                    f"{holiday['send_time']:%H:%M}",
+                    holiday['time_zone'] or "",
+                    format_recipients(holiday['greeted_users'], holiday['recipient_fields']),
+                    holiday['message'],
+                ])
+            else:
+                file.write(_ics_event(holiday, stamp))
+            exported += 1
+        if file_format == "ics":
+            file.write("END:VCALENDAR\r\n")
+    logger.info(f"Exported {exported} holidays to {path}.")
+    return exported
+
+
+if __name__ == "__main__":
+    # python holiday_io.py import birthdays.csv [--owner 123]
+    # python holiday_io.py export holidays.ics [--owner 123]
+    parser = argparse.ArgumentParser(description="Bulk import or export holidays.")
+    parser.add_argument("action", choices=["import", "export"])
+    parser.add_argument("path", help="a .csv or .ics file")
+    parser.add_argument("--owner", type=int, help="Telegram id of the owner, default TELEGRAM_ID")
+    parser.add_argument("--format", choices=["csv", "ics"], help="default: from the file extension")
+    args = parser.parse_args()
+
+    async def run():
+        attach_db_handler()
+        try:
+            if args.action == "import":
+                report = await import_holidays(args.path, args.owner, args.format)
+                print(f"Imported {report['imported']} holidays, rejected {report['rejected']} rows.")
+                for line, error in report["errors"]:
+                    print(f"  line {line}: {error}")
+            else:
+                exported = await export_holidays(args.path, args.owner, args.format)
+                print(f"Exported {exported} holidays to {args.path}.")
+        finally:
+            await close_pool()
+            close_db_handler()
+
+    asyncio.run(run())
@@ -0,0 +1,119 @@
+import asyncio
+import os
+from db_interaction import connect_DB_async
+from metrics import GREETING_LEADER
+from custom_logging import logger
+
+
+# Advisory lock class of the greeting scheduler election; the second key is the shard
+SCHEDULER_LOCK_CLASS = 530396549
+TRY_LOCK_SQL = "SELECT pg_try_advisory_lock($1, $2);"
+
+# Every candidate holds a shared lock of this class keyed by its number of shards,
+# so replicas sharding differently (e.g. shard 0 of 2 and 0 of 4) never both lead
+SHARD_COUNT_LOCK_CLASS = 530396550
+LOCK_SHARED_SQL = "SELECT pg_advisory_lock_shared($1, $2);"
+OTHER_SHARD_COUNTS_SQL = """
+    SELECT array_agg(DISTINCT objid::bigint ORDER BY objid::bigint) FROM pg_locks
+    WHERE locktype = 'advisory' AND granted AND objsubid = 2
+      AND classid = $1::bigint::oid AND objid <> $2::bigint::oid;
+"""
+
+# Let Postgres notice a vanished leader host within ~20s and free its lock
+KEEPALIVE_SETTINGS = {
+    "tcp_keepalives_idle": "10",
+    "tcp_keepalives_interval": "5",
+    "tcp_keepalives_count": "2",
+}
+
+
+class LeaderElection:
+    """
+    Runs the greeting scheduler of a shard in only one replica at a time.
+    The leader holds a session-level advisory lock on a dedicated connection,
+    which Postgres frees as soon as that connection ends; followers try to
+    take it every retry_seconds. The leader checks its connection every
+    heartbeat_seconds and steps down when it stops answering. Candidates
+    don't take part while replicas with a different number of shards run.
+    """
+
+    def __init__(self, shard=0, shards=1, heartbeat_seconds=5, retry_seconds=5):
+        self.shard = shard
+        self.shards = shards
+        self.heartbeat_seconds = heartbeat_seconds
+        self.retry_seconds = retry_seconds
+
+    @classmethod
+    def from_env(cls, shard=0, shards=1):
+        return cls(
+            shard, shards,
+            heartbeat_seconds=float(os.getenv("LEADER_HEARTBEAT_SECONDS", "5")),
+            retry_seconds=float(os.getenv("LEADER_RETRY_SECONDS", "5")),
+        )
+
+    async def _acquire(self):
+        """Return a connection holding the shard's lock, waiting until it is free."""
+        while True:
+            connection = None
+            acquired = False
+            try:
+                connection = await connect_DB_async(server_settings=KEEPALIVE_SETTINGS)
+                await connection.fetchval(LOCK_SHARED_SQL, SHARD_COUNT_LOCK_CLASS, self.shards)
+                others = await connection.fetchval(
+                    OTHER_SHARD_COUNTS_SQL, SHARD_COUNT_LOCK_CLASS, self.shards)
+                if not others:
+                    while not await connection.fetchval(TRY_LOCK_SQL, SCHEDULER_LOCK_CLASS, self.shard):
+                        await asyncio.sleep(self.retry_seconds)
+                    acquired = True
+                    return connection
+                logger.error(
+                    f"Not electing a leader of shard {self.shard}/{self.shards}: other replicas "
+                    f"run with {', '.join(map(str, others))} shards, set the same GREETING_WORKERS")
+            except Exception as e:
+                logger.error(f"An error occurred in the leader election of shard {self.shard}: {e}")
+            finally:
+                if connection is not None and not acquired:
+                    connection.terminate()
+            await asyncio.sleep(self.retry_seconds)
+
+    async def _heartbeat(self, connection):
+        """Return once the lock connection is closed or stops answering."""
+        closed = asyncio.Event()
+        connection.add_termination_listener(lambda _: closed.set())
+        while True:
+            try:
+                await asyncio.wait_for(closed.wait(), self.heartbeat_seconds)
+                logger.error(f"Lost the leader lock of shard {self.shard}: connection closed")
+                return
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await connection.fetchval("SELECT 1", timeout=self.heartbeat_seconds)
+            except Exception as e:
+                logger.error(f"Lost the leader lock of shard {self.shard}: {e}")
+                return
+
+    async def run(self, lead):
+        """
+        Take part in the election forever and await `lead()` during every term
+        won; it is cancelled when the term ends.
+        """
+        while True:
+            connection = await self._acquire()
+            logger.info(f"Became the greeting leader of shard {self.shard}.")
+            GREETING_LEADER.labels(self.shard).set(1)
+            term = asyncio.create_task(lead())
+            heartbeat = asyncio.create_task(self._heartbeat(connection))
+            try:
+                await asyncio.wait({term, heartbeat}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                term.cancel()
+                heartbeat.cancel()
+                await asyncio.gather(term, heartbeat, return_exceptions=True)
+                GREETING_LEADER.labels(self.shard).set(0)
+                # Frees the lock for the followers
+                connection.terminate()
+            if not term.cancelled() and term.exception() is not None:
+                logger.error(f"The greeting leader of shard {self.shard} failed: {term.exception()}")
+            logger.info(f"Stepped down as the greeting leader of shard {self.shard}.")
+            await asyncio.sleep(self.retry_seconds)
@@ -0,0 +1,97 @@
+import functools
+import inspect
+import os
+import time
+from aiohttp import web
+from aiogram import BaseMiddleware
+from prometheus_client import (CONTENT_TYPE_LATEST, Counter, Gauge, Histogram,
+                               generate_latest, start_http_server)
+from tracing import span
+from custom_logging import logger
+
+
+DB_CALL_SECONDS = Histogram(
+    "greetingbot_db_call_seconds", "Duration of db_interaction calls", ["function"])
+SEND_SECONDS = Histogram(
+    "greetingbot_send_seconds", "Duration of UserPyrogram.send_msg", ["outcome"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+UPDATE_SECONDS = Histogram(
+    "greetingbot_update_seconds", "Time spent handling an update", ["handler"])
+FLOOD_WAITS = Counter(
+    "greetingbot_flood_waits_total", "FloodWaits raised while sending greetings")
+SEND_FAILURES = Counter(
+    "greetingbot_send_failures_total", "Greetings that could not be sent")
+DEAD_LETTERS = Counter(
+    "greetingbot_dead_letters_total", "Outbox rows moved to dead-letter")
+OUTBOX_PENDING = Gauge(
+    "greetingbot_outbox_pending", "Greetings waiting in the outbox (pending or sending)")
+GREETING_LEADER = Gauge(
+    "greetingbot_greeting_leader", "1 while this process schedules the greetings of the shard", ["shard"])
+DENIED_UPDATES = Counter(
+    "greetingbot_denied_updates_total", "Updates of unauthorized users dropped before the handlers",
+    ["outcome"])
+NEXT_GREETING_SECONDS = Gauge(
+    "greetingbot_next_greeting_seconds", "Seconds until the next scheduled greetings")
+
+# Next scheduled greetings of every scheduler in this process, as epoch seconds
+_next_greeting_at = {}
+NEXT_GREETING_SECONDS.set_function(
+    lambda: min(_next_greeting_at.values()) - time.time() if _next_greeting_at else float("nan"))
+
+
+def set_next_greeting(shard, at):
+    """Record when the scheduler of a shard wakes up next (epoch seconds or None)."""
+    if at is None:
+        _next_greeting_at.pop(shard, None)
+    else:
+        _next_greeting_at[shard] = at
+
+
+def observe_db(function):
+    """
+    Time a db_interaction coroutine or async generator in DB_CALL_SECONDS
+    and as a span of the current update.
+    """
+    name = function.__name__
+    histogram = DB_CALL_SECONDS.labels(name)
+
+    if inspect.isasyncgenfunction(function):
+        @functools.wraps(function)
+        async def stream(*args, **kwargs):
+            with histogram.time(), span("db", name):
+                async for item in function(*args, **kwargs):
+                    yield item
+        return stream
+
+    @functools.wraps(function)
+    async def call(*args, **kwargs):
+        with histogram.time(), span("db", name):
+            return await function(*args, **kwargs)
+    return call
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Time every handled message or callback by the name of its handler."""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+        with UPDATE_SECONDS.labels(name).time():
+            return await handler(event, data)
+
+
+def start_metrics_server(port=None):
+    """
+    Serve /metrics on METRICS_PORT (default 8000) in a background thread;
+    a port of 0 disables it.
+    """
+    port = int(os.getenv("METRICS_PORT", "8000")) if port is None else port
+    if not port:
+        return
+    start_http_server(port)
+    logger.info(f"Metrics served on port {port}.")
+
+
+async def metrics_view(request):
+    """/metrics of the aiohttp server, so webhook replicas expose it on the same port."""
+    return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
@@ -0,0 +1,297 @@
+from custom_logging import logger
+
+
+# Key of the advisory lock that serialises migrations between replicas
+MIGRATIONS_LOCK_KEY = 5303965494
+
+# (version, name, SQL). Append new migrations, never edit applied ones.
+MIGRATIONS = [
+    (1, "baseline", """
+        CREATE TABLE IF NOT EXISTS logs (
+            id SERIAL PRIMARY KEY,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            level TEXT NOT NULL,
+            message TEXT NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS holidays (
+            id SERIAL PRIMARY KEY,
+            name TEXT NOT NULL,
+            day INT NOT NULL CHECK (day BETWEEN 1 AND 31),
+            month INT NOT NULL CHECK (month BETWEEN 1 AND 12),
+            users JSONB,
+            text TEXT NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS greeting_outbox (
+            id SERIAL PRIMARY KEY,
+            holiday_id INT NOT NULL REFERENCES holidays (id) ON DELETE CASCADE,
+            send_date DATE NOT NULL,
+            recipient TEXT NOT NULL,
+            message TEXT NOT NULL,
+            random_id BIGINT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending'
+                CHECK (status IN ('pending', 'sending', 'sent', 'dead')),
+            attempts INT NOT NULL DEFAULT 0,
+            last_error TEXT,
+            next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            claimed_at TIMESTAMP,
+            sent_at TIMESTAMP,
+            UNIQUE (holiday_id, send_date, recipient)
+        );
+        CREATE INDEX IF NOT EXISTS greeting_outbox_pending_idx
+            ON greeting_outbox (next_attempt_at) WHERE status IN ('pending', 'sending');
+    """),
+    (2, "normalized_recipients", """
+        CREATE TABLE recipients (
+            id SERIAL PRIMARY KEY,
+            username TEXT NOT NULL UNIQUE
+        );
+
+        CREATE TABLE holiday_recipients (
+            holiday_id INT NOT NULL REFERENCES holidays (id) ON DELETE CASCADE,
+            recipient_id INT NOT NULL REFERENCES recipients (id) ON DELETE CASCADE,
+            position INT NOT NULL,
+            PRIMARY KEY (holiday_id, recipient_id)
+        );
+        CREATE INDEX holiday_recipients_recipient_idx ON holiday_recipients (recipient_id);
+        CREATE INDEX holidays_month_day_idx ON holidays (month, day);
+
+        -- Move the JSONB recipient lists into the new tables
+        INSERT INTO recipients (username)
+        SELECT DISTINCT u.username
+        FROM holidays h
+        CROSS JOIN LATERAL jsonb_array_elements_text(COALESCE(h.users, '[]'::jsonb)) AS u (username)
+        ON CONFLICT (username) DO NOTHING;
+
+        INSERT INTO holiday_recipients (holiday_id, recipient_id, position)
+        SELECT h.id, r.id, min(u.position)
+        FROM holidays h
+        CROSS JOIN LATERAL jsonb_array_elements_text(COALESCE(h.users, '[]'::jsonb))
+            WITH ORDINALITY AS u (username, position)
+        JOIN recipients r ON r.username = u.username
+        GROUP BY h.id, r.id;
+
+        ALTER TABLE holidays DROP COLUMN users;
+
+        -- Every write to the calendar notifies listeners once per statement
+        CREATE OR REPLACE FUNCTION notify_holidays_changed() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('holidays_changed', '');
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER holidays_changed
+            AFTER INSERT OR UPDATE OR DELETE ON holidays
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_holidays_changed();
+        CREATE TRIGGER holiday_recipients_changed
+            AFTER INSERT OR UPDATE OR DELETE ON holiday_recipients
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_holidays_changed();
+    """),
+    (3, "owners", """
+        CREATE TABLE owners (
+            telegram_id BIGINT PRIMARY KEY,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+
+        -- Rows created before multi-tenancy have no owner until adopted at startup
+        ALTER TABLE holidays
+            ADD COLUMN owner_id BIGINT REFERENCES owners (telegram_id) ON DELETE CASCADE;
+        CREATE INDEX holidays_owner_month_day_idx ON holidays (owner_id, month, day);
+
+        ALTER TABLE greeting_outbox ADD COLUMN owner_id BIGINT;
+    """),
+    (4, "send_times", """
+        -- A NULL time zone means DEFAULT_TIME_ZONE
+        ALTER TABLE holidays
+            ADD COLUMN send_time TIME NOT NULL DEFAULT '10:00',
+            ADD COLUMN time_zone TEXT;
+    """),
+    (5, "resolved_peers", """
+        -- Access hashes are only valid for the account that resolved them
+        CREATE TABLE resolved_peers (
+            owner_id BIGINT NOT NULL REFERENCES owners (telegram_id) ON DELETE CASCADE,
+            username TEXT NOT NULL,
+            peer_type TEXT NOT NULL CHECK (peer_type IN ('user', 'chat', 'channel')),
+            peer_id BIGINT NOT NULL,
+            access_hash BIGINT NOT NULL DEFAULT 0,
+            resolved_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (owner_id, username)
+        );
+    """),
+    (6, "fsm_storage", """
+        -- Unfinished conversations; rows untouched for FSM_TTL_HOURS are pruned
+        CREATE TABLE fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data JSONB NOT NULL DEFAULT '{}',
+            updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX fsm_states_updated_at_idx ON fsm_states (updated_at);
+    """),
+    (7, "partitioned_logs", """
+        -- One partition per day, so retention drops whole partitions
+        ALTER TABLE logs RENAME TO logs_unpartitioned;
+        ALTER INDEX logs_pkey RENAME TO logs_unpartitioned_pkey;
+        ALTER SEQUENCE logs_id_seq AS BIGINT;
+
+        CREATE TABLE logs (
+            id BIGINT NOT NULL DEFAULT nextval('logs_id_seq'),
+            timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            level TEXT NOT NULL,
+            message TEXT NOT NULL,
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp);
+        CREATE INDEX logs_level_timestamp_idx ON logs (level, timestamp);
+        -- Catches rows of days whose partition doesn't exist yet
+        CREATE TABLE logs_default PARTITION OF logs DEFAULT;
+
+        -- Create the partition of a day, moving its rows out of logs_default
+        CREATE OR REPLACE FUNCTION create_log_partition(day DATE) RETURNS BOOLEAN AS $$
+        DECLARE
+            partition TEXT := 'logs_' || to_char(day, 'YYYYMMDD');
+        BEGIN
+            PERFORM pg_advisory_xact_lock(hashtext('create_log_partition'));
+            IF to_regclass(partition) IS NOT NULL THEN
+                RETURN FALSE;
+            END IF;
+            EXECUTE format('CREATE TABLE %I (LIKE logs INCLUDING DEFAULTS)', partition);
+            EXECUTE format(
+                'WITH moved AS (DELETE FROM logs_default WHERE timestamp >= %L AND timestamp < %L RETURNING *)
+                 INSERT INTO %I SELECT * FROM moved', day, day + 1, partition);
+            EXECUTE format('ALTER TABLE logs ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                           partition, day, day + 1);
+            RETURN TRUE;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        SELECT create_log_partition(day)
+        FROM (SELECT DISTINCT timestamp::date AS day FROM logs_unpartitioned WHERE timestamp IS NOT NULL
+              UNION SELECT CURRENT_DATE) AS days;
+        INSERT INTO logs (id, timestamp, level, message)
+        SELECT id, COALESCE(timestamp, CURRENT_TIMESTAMP), level, message FROM logs_unpartitioned;
+
+        ALTER SEQUENCE logs_id_seq OWNED BY logs.id;
+        DROP TABLE logs_unpartitioned;
+    """),
+    (8, "recipient_fields", """
+        -- Per-recipient values of the greeting template's placeholders, e.g. {"since": "1990"}
+        ALTER TABLE holiday_recipients ADD COLUMN fields JSONB NOT NULL DEFAULT '{}';
+    """),
+    (9, "lock_log_partition", """
+        -- Block inserts into logs while a day's rows move out of logs_default: one
+        -- arriving before ATTACH PARTITION would violate the default's new constraint.
+        -- Locking the parent also holds back inserts before they are routed to a partition
+        CREATE OR REPLACE FUNCTION create_log_partition(day DATE) RETURNS BOOLEAN AS $$
+        DECLARE
+            partition TEXT := 'logs_' || to_char(day, 'YYYYMMDD');
+        BEGIN
+            PERFORM pg_advisory_xact_lock(hashtext('create_log_partition'));
+            IF to_regclass(partition) IS NOT NULL THEN
+                RETURN FALSE;
+            END IF;
+            EXECUTE format('CREATE TABLE %I (LIKE logs INCLUDING DEFAULTS)', partition);
+            LOCK TABLE logs IN SHARE ROW EXCLUSIVE MODE;
+            EXECUTE format(
+                'WITH moved AS (DELETE FROM logs_default WHERE timestamp >= %L AND timestamp < %L RETURNING *)
+                 INSERT INTO %I SELECT * FROM moved', day, day + 1, partition);
+            EXECUTE format('ALTER TABLE logs ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                           partition, day, day + 1);
+            RETURN TRUE;
+        END;
+        $$ LANGUAGE plpgsql;
+    """),
+    (10, "notify_holiday_owners", """
+        -- Notify once per owner whose holidays a statement changed, with the
+        -- owner_id as payload ('' for rows without one), so listeners only drop
+        -- that owner's calendar. Transition tables need one trigger per event.
+        CREATE OR REPLACE FUNCTION notify_holidays_changed() RETURNS trigger AS $$
+        DECLARE
+            owner TEXT;
+        BEGIN
+            IF TG_OP = 'UPDATE' THEN
+                -- Updates may move holidays between owners, e.g. adopting legacy rows
+                FOR owner IN SELECT DISTINCT COALESCE(owner_id::text, '')
+                             FROM (SELECT owner_id FROM changed
+                                   UNION ALL SELECT owner_id FROM changed_before) AS owners LOOP
+                    PERFORM pg_notify('holidays_changed', owner);
+                END LOOP;
+            ELSE
+                FOR owner IN SELECT DISTINCT COALESCE(owner_id::text, '') FROM changed LOOP
+                    PERFORM pg_notify('holidays_changed', owner);
+                END LOOP;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION notify_holiday_recipients_changed() RETURNS trigger AS $$
+        DECLARE
+            owner TEXT;
+        BEGIN
+            -- Links deleted along with their holiday are notified by the holidays trigger
+            FOR owner IN SELECT DISTINCT COALESCE(h.owner_id::text, '')
+                         FROM changed c JOIN holidays h ON h.id = c.holiday_id LOOP
+                PERFORM pg_notify('holidays_changed', owner);
+            END LOOP;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER holidays_changed ON holidays;
+        DROP TRIGGER holiday_recipients_changed ON holiday_recipients;
+        CREATE TRIGGER holidays_inserted
+            AFTER INSERT ON holidays REFERENCING NEW TABLE AS changed
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_holidays_changed();
+        CREATE TRIGGER holidays_updated
+            AFTER UPDATE ON holidays REFERENCING OLD TABLE AS changed_before NEW TABLE AS changed
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_holidays_changed();
+        CREATE TRIGGER holidays_deleted
+            AFTER DELETE ON holidays REFERENCING OLD TABLE AS changed
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_holidays_changed();
+        CREATE TRIGGER holiday_recipients_inserted
+            AFTER INSERT ON holiday_recipients REFERENCING NEW TABLE AS changed
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_holiday_recipients_changed();
+        CREATE TRIGGER holiday_recipients_updated
+            AFTER UPDATE ON holiday_recipients REFERENCING NEW TABLE AS changed
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_holiday_recipients_changed();
+        CREATE TRIGGER holiday_recipients_deleted
+            AFTER DELETE ON holiday_recipients REFERENCING OLD TABLE AS changed
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_holiday_recipients_changed();
+    """),
+]
+
+
+async def apply_migrations(connection):
+    """
+    Apply every migration newer than the database's version, each in its own
+    transaction. Returns the versions that were applied.
+    """
+    applied = []
+    await connection.execute("SELECT pg_advisory_lock($1)", MIGRATIONS_LOCK_KEY)
+    try:
+        await connection.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INT PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+        current = await connection.fetchval(
+            "SELECT COALESCE(max(version), 0) FROM schema_migrations")
+        for version, name, sql in MIGRATIONS:
+            if version <= current:
+                continue
+            logger.info(f"Applying migration {version} ({name})...")
+            async with connection.transaction():
+                await connection.execute(sql)
+                await connection.execute(
+                    "INSERT INTO schema_migrations (version, name) VALUES ($1, $2)",
+                    version, name)
+            applied.append(version)
+            logger.info(f"Migration {version} ({name}) applied.")
+    finally:
+        await connection.execute("SELECT pg_advisory_unlock($1)", MIGRATIONS_LOCK_KEY)
+
+    return applied
@@ -0,0 +1,147 @@
+import asyncio
+import os
+from db_interaction import (
+    fetch_greetings_DB_async,
+    materialize_outbox_DB_async,
+    claim_outbox_DB_async,
+    mark_outbox_sent_DB_async,
+    mark_outbox_failed_DB_async,
+    next_outbox_attempt_DB_async,
+    count_pending_outbox_DB_async,
+)
+from greeting_dispatcher import GreetingDispatcher
+from greeting_templates import render_greetings
+from user_account import get_user_client
+from metrics import DEAD_LETTERS, OUTBOX_PENDING
+from custom_logging import logger
+
+
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_BACKOFF_SECONDS = float(os.getenv("OUTBOX_BACKOFF_SECONDS", "60"))
+OUTBOX_LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS", "600"))
+
+
+# Rate limits are per Telegram account, so every owner gets its own dispatcher
+_dispatchers = {}
+
+
+def _dispatcher_for(owner_id):
+    if owner_id not in _dispatchers:
+        _dispatchers[owner_id] = GreetingDispatcher.from_env()
+    return _dispatchers[owner_id]
+
+
+async def queue_greetings(send_date, holiday_ids):
+    """
+    Render the greetings of the given holidays for send_date in one batch,
+    each template parsed once, and materialise them into the outbox.
+    """
+    greetings = render_greetings(await fetch_greetings_DB_async(holiday_ids), send_date)
+    return await materialize_outbox_DB_async(send_date, greetings)
+
+
+async def _deliver_owner_rows(owner_id, rows, get_client):
+    user = get_client(owner_id)
+    # Resolved peers of the whole batch in one query instead of one API call per username
+    await user.load_peers([row['recipient'] for row in rows])
+
+    async def send(username, message, outbox_id, random_id):
+        await user.send_msg(username, message, random_id=random_id)
+        await mark_outbox_sent_DB_async(outbox_id)
+
+    async def on_failure(job, error):
+        status = await mark_outbox_failed_DB_async(
+            job[2], error, OUTBOX_MAX_ATTEMPTS, OUTBOX_BACKOFF_SECONDS)
+        if status == "dead":
+            DEAD_LETTERS.inc()
+
+    jobs = [
+        (row['recipient'], row['message'], row['id'], row['random_id'])
+        for row in rows
+    ]
+    report = await _dispatcher_for(owner_id).run(jobs, send, on_failure)
+    return report["sent"]
+
+
+async def deliver_outbox(shard=0, shards=1, get_client=get_user_client, wakeup=None):
+    """
+    Claim due outbox rows of a shard batch by batch and send them until none is due.
+    Each owner's rows go out through that owner's client in a task of its own,
+    so an owner paused by a FloodWait doesn't hold back the others: rows are
+    claimed again, skipping the busy owners, whenever an owner finishes or the
+    `wakeup` event is set. Each row is marked sent right after its message goes
+    out, so a restart only retries what is still unfinished.
+    """
+    sent = 0
+    # owner_id -> task sending that owner's claimed rows
+    deliveries = {}
+    try:
+        while True:
+            if wakeup is not None:
+                wakeup.clear()
+            rows = await claim_outbox_DB_async(
+                OUTBOX_BATCH_SIZE, OUTBOX_LEASE_SECONDS, shard, shards, skip_owners=list(deliveries))
+            rows_by_owner = {}
+            for row in rows:
+                rows_by_owner.setdefault(row['owner_id'], []).append(row)
+            for owner_id, owner_rows in rows_by_owner.items():
+                deliveries[owner_id] = asyncio.create_task(
+                    _deliver_owner_rows(owner_id, owner_rows, get_client))
+            if not deliveries:
+                return sent
+            if len(rows) == OUTBOX_BATCH_SIZE:
+                # More rows may be due for the owners that aren't busy yet
+                continue
+
+            waiting = set(deliveries.values())
+            woken = asyncio.create_task(wakeup.wait()) if wakeup is not None else None
+            if woken is not None:
+                waiting.add(woken)
+            try:
+                await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                if woken is not None:
+                    woken.cancel()
+            for owner_id, task in list(deliveries.items()):
+                if task.done():
+                    del deliveries[owner_id]
+                    sent += task.result()
+    finally:
+        for task in deliveries.values():
+            task.cancel()
+        await asyncio.gather(*deliveries.values(), return_exceptions=True)
+
+
+async def drain_outbox(shard=0, shards=1, get_client=get_user_client, wakeup=None):
+    """
+    Deliver a shard's outbox, waiting for backed-off retries, until every row
+    is either sent or dead-lettered. Setting the `wakeup` event, e.g. when new
+    greetings were queued, ends a wait for a retry early.
+    """
+    while True:
+        if wakeup is not None:
+            wakeup.clear()
+        await deliver_outbox(shard, shards, get_client, wakeup)
+        wait_time = await next_outbox_attempt_DB_async(OUTBOX_LEASE_SECONDS, shard, shards)
+        if wait_time is None:
+            return
+        wait_time = max(wait_time, 1)
+        logger.info(f"Waiting {wait_time:.0f} seconds for the next greeting retry.")
+        if wakeup is None:
+            await asyncio.sleep(wait_time)
+            continue
+        try:
+            await asyncio.wait_for(wakeup.wait(), wait_time)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def track_outbox_depth(interval=15):
+    """Keep the OUTBOX_PENDING gauge up to date, for the metrics endpoint."""
+    while True:
+        try:
+            OUTBOX_PENDING.set(await count_pending_outbox_DB_async())
+        except Exception as e:
+            logger.error(f"An error occurred while counting the outbox: {e}")
+        await asyncio.sleep(interval)
@@ -0,0 +1,225 @@
+import asyncio
+import heapq
+import os
+from datetime import date, datetime, time, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from db_interaction import fetch_schedule_DB_async, on_holidays_changed, off_holidays_changed
+from outbox import queue_greetings, drain_outbox
+from metrics import set_next_greeting
+from custom_logging import logger
+
+
+# What to do with send windows that passed while the scheduler wasn't running:
+# skip them, send the ones from earlier today, or send those missed by at most
+# GREETING_CATCH_UP_HOURS
+CATCH_UP_POLICIES = ("skip", "same_day", "window")
+
+# Upper bound of a single sleep, so wall clock jumps are noticed within the hour
+MAX_SLEEP_SECONDS = 3600
+
+# Delay before an event whose greetings could not be queued is tried again
+RETRY_SECONDS = 60
+
+
+def holiday_time_zone(holiday):
+    """The holiday's own time zone, else DEFAULT_TIME_ZONE, else TZ, else UTC."""
+    name = holiday.get('time_zone') or os.getenv("DEFAULT_TIME_ZONE") or os.getenv("TZ") or "UTC"
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        logger.error(f"Unknown time zone '{name}' of holiday {holiday.get('id')}, using UTC.")
+        return timezone.utc
+
+
+def next_send(holiday, start):
+    """
+    First send time of a holiday at or after `start` (an aware datetime).
+    Returns (send time, local send date) or None if the date never exists.
+    """
+    zone = holiday_time_zone(holiday)
+    local_start = start.astimezone(zone)
+    # 29-02 may be up to 8 years away
+    for year in range(local_start.year - 1, local_start.year + 9):
+        try:
+            send_date = date(year, holiday['month'], holiday['day'])
+        except ValueError:
+            continue
+        send_at = datetime.combine(send_date, holiday['send_time'], zone)
+        if send_at >= start:
+            return send_at, send_date
+    return None
+
+
+class GreetingScheduler:
+    """
+    Min-heap of the next send event of every holiday of one shard.
+    The loop sleeps until the earliest event, queues the greetings of all due
+    holidays in the outbox and lets a separate task deliver them. On holiday
+    changes only the holidays whose date, time or time zone changed are rescheduled.
+    """
+
+    def __init__(self, shard=0, shards=1, catch_up="same_day", catch_up_hours=6):
+        if catch_up not in CATCH_UP_POLICIES:
+            raise ValueError(f"Unknown catch-up policy '{catch_up}'")
+        self.shard = shard
+        self.shards = shards
+        self.catch_up = catch_up
+        self.catch_up_hours = catch_up_hours
+        # (send time, holiday id, send date); entries that no longer match
+        # _scheduled are stale and skipped when popped
+        self._heap = []
+        # holiday id -> (schedule key, send time, send date, holiday)
+        self._scheduled = {}
+        self._changed = asyncio.Event()
+        self._deliver = asyncio.Event()
+
+    @classmethod
+    def from_env(cls, shard=0, shards=1):
+        return cls(
+            shard, shards,
+            catch_up=os.getenv("GREETING_CATCH_UP", "same_day"),
+            catch_up_hours=float(os.getenv("GREETING_CATCH_UP_HOURS", "6")),
+        )
+
+    def holidays_changed(self, owner_id=None):
+        if owner_id is None or owner_id % self.shards == self.shard:
+            self._changed.set()
+
+    def _catch_up_start(self, holiday, now):
+        """Earliest send time that still counts as due when (re)scheduling at `now`."""
+        if self.catch_up == "skip":
+            return now
+        if self.catch_up == "window":
+            return now - timedelta(hours=self.catch_up_hours)
+        zone = holiday_time_zone(holiday)
+        return datetime.combine(now.astimezone(zone).date(), time(0), zone)
+
+    def _schedule(self, holiday, start):
+        key = (holiday['day'], holiday['month'], holiday['send_time'], holiday['time_zone'])
+        event = next_send(holiday, start)
+        if event is None:
+            logger.error(f"Holiday {holiday['id']} has a date that never occurs, not scheduled.")
+            self._scheduled.pop(holiday['id'], None)
+            return
+        send_at, send_date = event
+        self._scheduled[holiday['id']] = (key, send_at, send_date, holiday)
+        heapq.heappush(self._heap, (send_at, holiday['id'], send_date))
+
+    def _compact(self):
+        # Stale entries pile up when holidays change often
+        if len(self._heap) > 2 * len(self._scheduled) + 64:
+            self._heap = [
+                (send_at, holiday_id, send_date)
+                for holiday_id, (_, send_at, send_date, _) in self._scheduled.items()
+            ]
+            heapq.heapify(self._heap)
+
+    async def refresh(self, now):
+        """Reload the shard's schedule and reschedule added or changed holidays."""
+        holidays = await fetch_schedule_DB_async(self.shard, self.shards)
+        seen = set()
+        rescheduled = 0
+        for holiday in holidays:
+            seen.add(holiday['id'])
+            scheduled = self._scheduled.get(holiday['id'])
+            key = (holiday['day'], holiday['month'], holiday['send_time'], holiday['time_zone'])
+            if scheduled is not None and scheduled[0] == key:
+                continue
+            self._schedule(holiday, self._catch_up_start(holiday, now))
+            rescheduled += 1
+        for holiday_id in set(self._scheduled) - seen:
+            del self._scheduled[holiday_id]
+        self._compact()
+        logger.info(f"Scheduled {len(self._scheduled)} holidays ({rescheduled} rescheduled).")
+
+    def _is_current(self, entry):
+        send_at, holiday_id, _ = entry
+        scheduled = self._scheduled.get(holiday_id)
+        return scheduled is not None and scheduled[1] == send_at
+
+    def _pop_due(self, now):
+        """Pop the due events, grouped as {send date: [(holiday id, send time)]}."""
+        due = {}
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            if self._is_current(entry):
+                send_at, holiday_id, send_date = entry
+                due.setdefault(send_date, []).append((holiday_id, send_at))
+        return due
+
+    def next_wakeup(self, now):
+        """Seconds until the next event, or None when nothing is scheduled."""
+        while self._heap and not self._is_current(self._heap[0]):
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return None
+        return max((self._heap[0][0] - now).total_seconds(), 0)
+
+    async def _fire(self, now):
+        for send_date, events in self._pop_due(now).items():
+            holiday_ids = [holiday_id for holiday_id, _ in events]
+            try:
+                await queue_greetings(send_date, holiday_ids)
+            except Exception as e:
+                logger.error(f"An error occurred while queueing greetings for {send_date}: {e}")
+                # Keep the event and try again shortly instead of losing the day
+                retry_at = now + timedelta(seconds=RETRY_SECONDS)
+                for holiday_id in holiday_ids:
+                    key, _, _, holiday = self._scheduled[holiday_id]
+                    self._scheduled[holiday_id] = (key, retry_at, send_date, holiday)
+                    heapq.heappush(self._heap, (retry_at, holiday_id, send_date))
+                continue
+            for holiday_id, send_at in events:
+                self._schedule(self._scheduled[holiday_id][3], send_at + timedelta(microseconds=1))
+            self._deliver.set()
+
+    async def _deliver_loop(self):
+        while True:
+            await self._deliver.wait()
+            try:
+                # Greetings queued while it waits for a retry are delivered right away
+                await drain_outbox(self.shard, self.shards, wakeup=self._deliver)
+            except Exception as e:
+                logger.error(f"An error occurred while delivering greetings: {e}")
+                await asyncio.sleep(RETRY_SECONDS)
+                self._deliver.set()
+
+    async def run(self):
+        on_holidays_changed(self.holidays_changed)
+        # Finish greetings left unsent by a previous run
+        self._deliver.set()
+        delivery = asyncio.create_task(self._deliver_loop())
+        self._changed.set()
+        try:
+            while True:
+                now = datetime.now(timezone.utc)
+                if self._changed.is_set():
+                    self._changed.clear()
+                    try:
+                        await self.refresh(now)
+                    except Exception as e:
+                        logger.error(f"An error occurred while loading the greeting schedule: {e}")
+                        await asyncio.sleep(RETRY_SECONDS)
+                        self._changed.set()
+                        continue
+
+                await self._fire(now)
+
+                wait_time = self.next_wakeup(datetime.now(timezone.utc))
+                set_next_greeting(self.shard, self._heap[0][0].timestamp() if self._heap else None)
+                if wait_time is None:
+                    logger.info("No greetings scheduled.")
+                    wait_time = MAX_SLEEP_SECONDS
+                else:
+                    logger.info(f"Waiting {wait_time / 60:.2f} minutes until the next greetings.")
+                try:
+                    await asyncio.wait_for(
+                        self._changed.wait(), min(wait_time, MAX_SLEEP_SECONDS))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            off_holidays_changed(self.holidays_changed)
+            # Don't let the next term start while this one is still delivering
+            delivery.cancel()
+            await asyncio.gather(delivery, return_exceptions=True)
+            set_next_greeting(self.shard, None)
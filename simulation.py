@@ -0,0 +1,393 @@
+"""
+Capacity planning on a virtual clock.
+
+Replays the real holiday calendar, every owner's holidays in the DB_*
+database, over a year against a fake sender. Sends go through the
+GreetingDispatcher with the configured rate limits (GREETING_RATE,
+GREETING_BURST, GREETING_CONCURRENCY, GREETING_PACING), in OUTBOX_BATCH_SIZE
+batches with the outbox retries, on GREETING_WORKERS shards like the bot.
+Time only passes on the event loop's clock, so a year takes seconds.
+Reports the greetings per day, how long the peak day takes and the days
+whose greetings arrive more than --window-minutes after their send time.
+
+    python simulation.py
+    python simulation.py --start 2026-12-01 --days 60 --rate 0.5 --send-latency 1 --json plan.json
+    python simulation.py --check-clock
+
+The database is only read.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import threading
+from collections import deque
+from datetime import date, datetime, time, timedelta, timezone
+from pyrogram.errors import FloodWait
+from db_interaction import wait_for_DB_async, fetch_calendar_DB_async, close_pool
+from greeting_dispatcher import GreetingDispatcher
+from outbox import OUTBOX_BATCH_SIZE, OUTBOX_MAX_ATTEMPTS, OUTBOX_BACKOFF_SECONDS
+from scheduler import next_send
+
+
+class _VirtualSelector:
+    """Selector that moves the loop's clock to the next timer instead of waiting for it."""
+
+    def __init__(self, selector, loop):
+        self._selector = selector
+        self._loop = loop
+
+    def select(self, timeout=None):
+        events = self._selector.select(0)
+        if events or timeout == 0:
+            return events
+        if timeout is None:
+            # Nothing scheduled, only another thread can wake the loop up
+            return self._selector.select(None)
+        self._loop.advance(timeout)
+        return []
+
+    def __getattr__(self, name):
+        return getattr(self._selector, name)
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    """Event loop whose clock jumps to the next timer when there's nothing to run."""
+
+    # A timer is due when it's less than the clock resolution ahead, and 1e-9
+    # is below the float precision of the clock after about 194 virtual days
+    CLOCK_RESOLUTION = 1e-6
+
+    def __init__(self):
+        super().__init__()
+        self._virtual_time = 0.0
+        self._clock_resolution = self.CLOCK_RESOLUTION
+        self._selector = _VirtualSelector(self._selector, self)
+
+    def time(self):
+        return self._virtual_time
+
+    def advance(self, seconds):
+        target = self._virtual_time + seconds
+        # Land exactly on the next timer instead of a rounding error before it
+        if self._scheduled and self._scheduled[0].when() <= target + self._clock_resolution:
+            target = self._scheduled[0].when()
+        self._virtual_time = max(self._virtual_time, target)
+
+
+def check_clock(days=365, wall_seconds=60):
+    """
+    Sleep through `days` virtual days, each timer a fraction of a second after
+    the previous one, and fail unless the loop's clock gets to the end within
+    `wall_seconds` of real time.
+    """
+    async def sleep_through():
+        for _ in range(days):
+            await asyncio.sleep(86400 - 0.3)
+            await asyncio.sleep(0.3)
+        return asyncio.get_running_loop().time()
+
+    with asyncio.Runner(loop_factory=VirtualClockLoop) as runner:
+        loop = runner.get_loop()
+        task = loop.create_task(sleep_through())
+        # A stuck clock never fires a virtual timeout, so watch it from another thread
+        watchdog = threading.Timer(wall_seconds, loop.call_soon_threadsafe, (task.cancel,))
+        watchdog.start()
+        try:
+            elapsed = loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            raise AssertionError(f"The virtual clock got stuck at {loop.time()}s") from None
+        finally:
+            watchdog.cancel()
+    if elapsed != days * 86400:
+        raise AssertionError(f"The virtual clock stopped at {elapsed}s instead of {days * 86400}s")
+
+
+class _Greeting:
+    __slots__ = ("holiday_id", "owner_id", "send_at", "send_date", "attempts")
+
+    def __init__(self, holiday, send_at, send_date):
+        self.holiday_id = holiday['id']
+        self.owner_id = holiday['owner_id']
+        self.send_at = send_at
+        self.send_date = send_date
+        self.attempts = 0
+
+
+class _Shard:
+    def __init__(self):
+        self.pending = deque()
+        self.wakeup = asyncio.Event()
+        self.drained = asyncio.Event()
+        # Greetings neither sent nor dead-lettered yet
+        self.outstanding = 0
+
+    def add(self, greetings):
+        self.outstanding += len(greetings)
+        self.drained.clear()
+        self.requeue(greetings)
+
+    def requeue(self, greetings):
+        # Retried greetings stay outstanding while they back off
+        self.pending.extend(greetings)
+        self.wakeup.set()
+
+    def finish(self):
+        """Count a greeting as sent or dead-lettered, the only way `outstanding` drops."""
+        self.outstanding -= 1
+        if not self.outstanding:
+            self.drained.set()
+
+
+class Simulation:
+    """
+    Schedules the send events of `calendar` (rows of fetch_calendar_DB_async)
+    from `start` for `days` days and delivers them through a fake sender that
+    takes `send_latency` seconds per greeting and answers a share `flood_rate`
+    of them with a FloodWait of `flood_wait` seconds. Must run on a VirtualClockLoop.
+    """
+
+    def __init__(self, calendar, start, days=365, shards=1, send_latency=0.5,
+                 flood_rate=0.0, flood_wait=30, window=timedelta(hours=1)):
+        self.calendar = calendar
+        self.start = start
+        self.days = days
+        self.shards = max(shards, 1)
+        self.send_latency = send_latency
+        self.flood_rate = flood_rate
+        self.flood_wait = flood_wait
+        self.window = window
+        # send date -> statistics of the greetings of that (local) date
+        self.stats = {}
+        # Rate limits are per Telegram account, like in outbox.py
+        self._dispatchers = {}
+        self._origin = None
+
+    def now(self):
+        return self.start + timedelta(seconds=asyncio.get_running_loop().time() - self._origin)
+
+    def events(self):
+        """(send time, holiday id, send date, holiday) of every send in the period, in order."""
+        end = self.start + timedelta(days=self.days)
+        events = []
+        for holiday in self.calendar:
+            if not holiday['recipients']:
+                continue
+            at = self.start
+            while (event := next_send(holiday, at)) is not None and event[0] < end:
+                events.append((event[0], holiday['id'], event[1], holiday))
+                at = event[0] + timedelta(microseconds=1)
+        events.sort(key=lambda event: event[:2])
+        return events
+
+    def _day(self, send_date):
+        return self.stats.setdefault(send_date, {
+            "greetings": 0, "failed": 0, "late": 0,
+            "first_send_at": None, "last_delivered_at": None, "max_delay": timedelta(0),
+        })
+
+    def _delivered(self, greeting):
+        day = self._day(greeting.send_date)
+        now = self.now()
+        delay = now - greeting.send_at
+        day["greetings"] += 1
+        day["late"] += delay > self.window
+        day["max_delay"] = max(day["max_delay"], delay)
+        day["last_delivered_at"] = max(day["last_delivered_at"] or now, now)
+
+    async def _send(self, username, message, greeting):
+        await asyncio.sleep(self.send_latency)
+        if self.flood_rate and random.random() < self.flood_rate:
+            raise FloodWait(value=self.flood_wait)
+        self._delivered(greeting)
+
+    async def _deliver_owner(self, shard, owner_id, greetings):
+        loop = asyncio.get_running_loop()
+
+        async def send(username, message, greeting):
+            await self._send(username, message, greeting)
+            shard.finish()
+
+        async def on_failure(job, error):
+            greeting = job[2]
+            if greeting.attempts >= OUTBOX_MAX_ATTEMPTS:
+                self._day(greeting.send_date)["failed"] += 1
+                shard.finish()
+                return
+            loop.call_later(OUTBOX_BACKOFF_SECONDS * 2 ** (greeting.attempts - 1),
+                            shard.requeue, [greeting])
+
+        for greeting in greetings:
+            greeting.attempts += 1
+        if owner_id not in self._dispatchers:
+            self._dispatchers[owner_id] = GreetingDispatcher.from_env()
+        jobs = [(f"@holiday{greeting.holiday_id}", "", greeting) for greeting in greetings]
+        await self._dispatchers[owner_id].run(jobs, send, on_failure)
+
+    async def _deliver(self, shard):
+        # Claims batches like outbox.deliver_outbox: every owner in a task of its
+        # own, whose greetings the claims skip while it's busy
+        deliveries = {}
+        try:
+            while True:
+                shard.wakeup.clear()
+                batch, skipped = [], []
+                while shard.pending and len(batch) < OUTBOX_BATCH_SIZE:
+                    greeting = shard.pending.popleft()
+                    (skipped if greeting.owner_id in deliveries else batch).append(greeting)
+                shard.pending.extendleft(reversed(skipped))
+                by_owner = {}
+                for greeting in batch:
+                    by_owner.setdefault(greeting.owner_id, []).append(greeting)
+                for owner_id, greetings in by_owner.items():
+                    deliveries[owner_id] = asyncio.create_task(
+                        self._deliver_owner(shard, owner_id, greetings))
+                if len(batch) == OUTBOX_BATCH_SIZE:
+                    continue
+
+                woken = asyncio.create_task(shard.wakeup.wait())
+                try:
+                    await asyncio.wait({woken, *deliveries.values()}, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    woken.cancel()
+                for owner_id, task in list(deliveries.items()):
+                    if task.done():
+                        del deliveries[owner_id]
+                        task.result()
+        finally:
+            for task in deliveries.values():
+                task.cancel()
+
+    async def _run_shard(self, events):
+        shard = _Shard()
+        delivery = asyncio.create_task(self._deliver(shard))
+        try:
+            for send_at, _, send_date, holiday in events:
+                delay = (send_at - self.now()).total_seconds()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                day = self._day(send_date)
+                day["first_send_at"] = min(day["first_send_at"] or send_at, send_at)
+                shard.add([_Greeting(holiday, send_at, send_date)
+                           for _ in range(holiday['recipients'])])
+            if shard.outstanding:
+                await shard.drained.wait()
+        finally:
+            delivery.cancel()
+
+    async def run(self):
+        """Simulate the period and return the report."""
+        self._origin = asyncio.get_running_loop().time()
+        events = self.events()
+        await asyncio.gather(*(
+            self._run_shard([event for event in events if event[3]['owner_id'] % self.shards == shard])
+            for shard in range(self.shards)
+        ))
+        return self.report()
+
+    def report(self):
+        days = {}
+        for send_date, day in sorted(self.stats.items()):
+            duration = day["last_delivered_at"] - day["first_send_at"] if day["last_delivered_at"] else None
+            days[send_date.isoformat()] = {
+                "greetings": day["greetings"],
+                "failed": day["failed"],
+                "late": day["late"],
+                "seconds": duration.total_seconds() if duration is not None else None,
+                "max_delay_seconds": day["max_delay"].total_seconds(),
+            }
+        peak = max(days, key=lambda name: days[name]["greetings"], default=None)
+        return {
+            "start": self.start.isoformat(),
+            "days": self.days,
+            "window_seconds": self.window.total_seconds(),
+            "greetings": sum(day["greetings"] for day in days.values()),
+            "failed": sum(day["failed"] for day in days.values()),
+            "per_day": days,
+            "peak_day": peak,
+            "late_days": [name for name, day in days.items() if day["late"] or day["failed"]],
+        }
+
+
+def _duration(seconds):
+    return "-" if seconds is None else str(timedelta(seconds=round(seconds)))
+
+
+def print_report(report, limits):
+    print(f"Simulated {report['days']} days from {report['start'][:10]} with {limits}: "
+          f"{report['greetings']} greetings on {len(report['per_day'])} days, "
+          f"{report['failed']} failed.\n")
+    print(f"{'date':<12}{'greetings':>10}{'failed':>8}{'late':>8}{'span':>11}{'max delay':>11}")
+    for name, day in report["per_day"].items():
+        print(f"{name:<12}{day['greetings']:>10}{day['failed']:>8}{day['late']:>8}"
+              f"{_duration(day['seconds']):>11}{_duration(day['max_delay_seconds']):>11}")
+    if report["peak_day"] is not None:
+        peak = report["per_day"][report["peak_day"]]
+        print(f"\nPeak day {report['peak_day']}: {peak['greetings']} greetings, "
+              f"the last delivered {_duration(peak['seconds'])} after the first send time.")
+    window = _duration(report["window_seconds"])
+    if report["late_days"]:
+        print(f"Days missing the {window} delivery window: " + ", ".join(
+            f"{name} ({report['per_day'][name]['late']} late, {report['per_day'][name]['failed']} failed)"
+            for name in report["late_days"]))
+    else:
+        print(f"Every greeting is delivered within {window} of its send time.")
+
+
+async def load_calendar():
+    try:
+        await wait_for_DB_async()
+        return await fetch_calendar_DB_async()
+    finally:
+        await close_pool()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate a year of greetings on a virtual clock.")
+    parser.add_argument("--start", type=date.fromisoformat, default=date.today(),
+                        help="first simulated day (UTC), default today")
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--window-minutes", type=float, default=60,
+                        help="greetings delivered later than this after their send time are late")
+    parser.add_argument("--send-latency", type=float, default=0.5, help="seconds per sent greeting")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="share of sends answered with FloodWait")
+    parser.add_argument("--flood-wait", type=int, default=30, help="FloodWait length in seconds")
+    parser.add_argument("--rate", type=float, help="GREETING_RATE")
+    parser.add_argument("--burst", type=int, help="GREETING_BURST")
+    parser.add_argument("--concurrency", type=int, help="GREETING_CONCURRENCY")
+    parser.add_argument("--workers", type=int, help="GREETING_WORKERS, the number of shards")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.add_argument("--check-clock", action="store_true",
+                        help="only check that the virtual clock runs through --days days, without the database")
+    args = parser.parse_args()
+
+    if args.check_clock:
+        check_clock(args.days)
+        print(f"The virtual clock ran through {args.days} days.")
+        raise SystemExit
+
+    # The dispatchers and shards read the limits when the simulation starts
+    for name, value in (("GREETING_RATE", args.rate), ("GREETING_BURST", args.burst),
+                        ("GREETING_CONCURRENCY", args.concurrency), ("GREETING_WORKERS", args.workers)):
+        if value is not None:
+            os.environ[name] = str(value)
+    random.seed(args.seed)
+
+    calendar = asyncio.run(load_calendar())
+    simulation = Simulation(
+        calendar, datetime.combine(args.start, time(0), timezone.utc), args.days,
+        shards=int(os.getenv("GREETING_WORKERS", "0")), send_latency=args.send_latency,
+        flood_rate=args.flood_rate, flood_wait=args.flood_wait,
+        window=timedelta(minutes=args.window_minutes))
+    with asyncio.Runner(loop_factory=VirtualClockLoop) as runner:
+        report = runner.run(simulation.run())
+    limits = (f"GREETING_RATE={os.getenv('GREETING_RATE', '1')}, "
+              f"GREETING_BURST={os.getenv('GREETING_BURST', '5')}, "
+              f"GREETING_CONCURRENCY={os.getenv('GREETING_CONCURRENCY', '4')}, "
+              f"GREETING_PACING={os.getenv('GREETING_PACING', 'none')}")
+    print_report(report, limits)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(report, file, indent=2)
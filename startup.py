@@ -0,0 +1,93 @@
+import os
+import time
+from contextlib import contextmanager
+from aiohttp import web
+from metrics import metrics_view
+from custom_logging import logger
+
+
+class StartupReport:
+    """Durations of the startup steps and whether the bot accepts updates yet."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        # (step, seconds) in the order they ran
+        self.steps = []
+        self.ready_after = None
+
+    def mark(self, name):
+        """Record the time since the report was created, e.g. the imports."""
+        self.steps.append((name, time.monotonic() - self.started))
+
+    @contextmanager
+    def step(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.steps.append((name, time.monotonic() - started))
+
+    @property
+    def ready(self):
+        return self.ready_after is not None
+
+    def set_ready(self):
+        self.ready_after = time.monotonic() - self.started
+        logger.info(f"Ready after {self.ready_after:.2f}s: {self.format()}.")
+
+    def set_not_ready(self):
+        self.ready_after = None
+
+    def format(self):
+        return ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.steps)
+
+    def as_dict(self):
+        return {
+            "ready": self.ready,
+            "ready_after_seconds": self.ready_after,
+            "steps": {name: round(seconds, 4) for name, seconds in self.steps},
+        }
+
+
+startup_report = StartupReport()
+
+
+async def health(request):
+    return web.json_response({"status": "ok"})
+
+
+async def ready(request):
+    report = request.app["report"]
+    return web.json_response(report.as_dict(), status=200 if report.ready else 503)
+
+
+def create_health_app(report=startup_report, webhook=None):
+    """
+    aiohttp app with /health (the process is up), /ready (it accepts updates),
+    /metrics and, given a WebhookEndpoint, the Telegram webhook.
+    """
+    app = web.Application()
+    app["report"] = report
+    app.router.add_get("/health", health)
+    app.router.add_get("/ready", ready)
+    app.router.add_get("/metrics", metrics_view)
+    if webhook is not None:
+        app.router.add_post(webhook.path, webhook.handle)
+    return app
+
+
+async def start_health_server(port=None, report=startup_report, webhook=None):
+    """
+    Serve the probes on HEALTH_PORT (default 8080) from the running event loop;
+    a port of 0 disables it. Returns the runner to clean up, or None.
+    """
+    port = int(os.getenv("HEALTH_PORT", "8080")) if port is None else port
+    if not port:
+        if webhook is not None:
+            raise ValueError("Webhook mode needs a HEALTH_PORT to receive updates on")
+        return None
+    runner = web.AppRunner(create_health_app(report, webhook), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, port=port).start()
+    logger.info(f"Health probes served on port {port}.")
+    return runner
@@ -0,0 +1,207 @@
+import cProfile
+import io
+import os
+import pstats
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.fsm.storage.base import BaseStorage
+from custom_logging import logger
+
+
+# Updates slower than this are kept in the ring buffer
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "500"))
+
+# Trace of the update being handled by the current task
+current_trace = ContextVar("current_trace", default=None)
+
+# The slowest recent updates, newest last
+slow_traces = deque(maxlen=int(os.getenv("TRACE_BUFFER_SIZE", "50")))
+
+PROFILERS = ("off", "cprofile", "pyinstrument")
+# Profiler that captures every update, switched at runtime by the admin
+profiler_mode = "off"
+_profiling = False
+
+
+class Trace:
+    """Timings of one update: its nested DB, Bot API and FSM storage spans."""
+
+    def __init__(self, label, user_id):
+        self.label = label
+        self.user_id = user_id
+        self.received_at = datetime.now()
+        self.started = time.perf_counter()
+        # (category, name, offset ms, duration ms)
+        self.spans = []
+        self.duration = None
+        self.profile = None
+
+    def finish(self):
+        self.duration = (time.perf_counter() - self.started) * 1000
+
+    def format(self):
+        totals = {}
+        for category, _, _, duration in self.spans:
+            totals[category] = totals.get(category, 0) + duration
+        lines = [
+            f"{self.received_at:%Y-%m-%d %H:%M:%S} {self.label} from {self.user_id}: "
+            f"{self.duration:.1f} ms ("
+            + ", ".join(f"{category} {total:.1f} ms" for category, total in sorted(totals.items()))
+            + ")"
+        ]
+        lines += [
+            f"  +{offset:7.1f} ms {category:<4} {name} {duration:.1f} ms"
+            for category, name, offset, duration in self.spans
+        ]
+        if self.profile:
+            lines.append(self.profile)
+        return "\n".join(lines)
+
+
+@contextmanager
+def span(category, name):
+    """Time a block as a span of the current update, if there is one."""
+    trace = current_trace.get()
+    if trace is None or trace.duration is not None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        finished = time.perf_counter()
+        trace.spans.append((category, name, (started - trace.started) * 1000,
+                            (finished - started) * 1000))
+
+
+def set_profiler(mode):
+    """Switch the per-update profiler: off, cprofile or pyinstrument."""
+    global profiler_mode
+    if mode not in PROFILERS:
+        raise ValueError(f"Unknown profiler '{mode}'")
+    if mode == "pyinstrument":
+        # Optional dependency, only needed for this mode
+        import pyinstrument  # noqa: F401
+    profiler_mode = mode
+    logger.info(f"Update profiler set to {mode}.")
+
+
+def _label(update):
+    # Only commands and callback prefixes, message texts may hold passwords
+    if update.message is not None:
+        text = update.message.text or ""
+        return f"message {text.split()[0]}" if text.startswith("/") else "message"
+    if update.callback_query is not None:
+        return f"callback {(update.callback_query.data or '').split(':')[0]}"
+    return update.event_type
+
+
+def _user_id(update):
+    event = update.message or update.callback_query
+    return event.from_user.id if event is not None and event.from_user else None
+
+
+class TracingMiddleware(BaseMiddleware):
+    """
+    Outer update middleware: opens a trace per update and keeps the slow
+    ones, and every profiled one, in slow_traces.
+    """
+
+    async def __call__(self, handler, event, data):
+        trace = Trace(_label(event), _user_id(event))
+        token = current_trace.set(trace)
+        global _profiling
+        # Only one profiler can run at a time, concurrent updates go unprofiled
+        mode = profiler_mode if not _profiling else "off"
+        _profiling = mode != "off"
+        profiler = None
+        if mode == "cprofile":
+            profiler = cProfile.Profile()
+            profiler.enable()
+        elif mode == "pyinstrument":
+            from pyinstrument import Profiler
+            profiler = Profiler(async_mode="enabled")
+            profiler.start()
+        try:
+            return await handler(event, data)
+        finally:
+            trace.finish()
+            current_trace.reset(token)
+            if mode == "cprofile":
+                profiler.disable()
+                output = io.StringIO()
+                pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(20)
+                trace.profile = output.getvalue()
+            elif mode == "pyinstrument":
+                profiler.stop()
+                trace.profile = profiler.output_text()
+            if profiler is not None:
+                _profiling = False
+            if profiler is not None or trace.duration >= TRACE_SLOW_MS:
+                slow_traces.append(trace)
+
+
+class TracingRequestMiddleware(BaseRequestMiddleware):
+    """Bot session middleware timing every Bot API call as a span."""
+
+    async def __call__(self, make_request, bot, method):
+        with span("api", type(method).__name__):
+            return await make_request(bot, method)
+
+
+class TracedStorage(BaseStorage):
+    """FSM storage wrapper that times every storage call as a span."""
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    async def set_state(self, key, state=None):
+        with span("fsm", "set_state"):
+            return await self.storage.set_state(key, state)
+
+    async def get_state(self, key):
+        with span("fsm", "get_state"):
+            return await self.storage.get_state(key)
+
+    async def set_data(self, key, data):
+        with span("fsm", "set_data"):
+            return await self.storage.set_data(key, data)
+
+    async def get_data(self, key):
+        with span("fsm", "get_data"):
+            return await self.storage.get_data(key)
+
+    async def get_value(self, key, dict_key, default=None):
+        with span("fsm", "get_value"):
+            return await self.storage.get_value(key, dict_key, default)
+
+    async def update_data(self, key, data):
+        with span("fsm", "update_data"):
+            return await self.storage.update_data(key, data)
+
+    async def close(self):
+        await self.storage.close()
+
+
+def install_tracing(dp):
+    """
+    Trace every update of `dp`. The tracing middleware goes first, so the FSM
+    state lookup of aiogram's own middlewares is traced too. Bot API calls are
+    traced by adding TracingRequestMiddleware to the bot's session.
+    """
+    builtin = list(dp.update.outer_middleware)
+    for middleware in builtin:
+        dp.update.outer_middleware.unregister(middleware)
+    dp.update.outer_middleware.register(TracingMiddleware())
+    for middleware in builtin:
+        dp.update.outer_middleware.register(middleware)
+
+
+def dump_traces():
+    """Slow and profiled updates, newest first, as text."""
+    return "\n\n".join(trace.format() for trace in reversed(slow_traces))
@@ -1,10 +1,72 @@
 import os
 import asyncio
-from pyrogram import Client
+import sqlite3
+import time
+from metrics import SEND_SECONDS
+from pyrogram import Client, raw, utils
+from pyrogram.errors import (
+    ChannelInvalid,
+    ChannelPrivate,
+    PeerIdInvalid,
+    RandomIdDuplicate,
+    SessionPasswordNeeded,
+    UsernameInvalid,
+    UsernameNotOccupied,
+)
+from pyrogram.raw import functions
+from db_interaction import fetch_peers_DB_async, save_peers_DB_async, delete_peer_DB_async
 from custom_logging import logger
 
 
+# How long a resolved username is trusted before it's looked up again.
+# Pyrogram's own session cache forgets usernames after 8 hours.
+PEER_CACHE_TTL = float(os.getenv("PEER_CACHE_TTL_HOURS", "168")) * 3600
+
+# A cached peer that fails with one of these is resolved again
+STALE_PEER_ERRORS = (PeerIdInvalid, ChannelInvalid, ChannelPrivate)
+# The username doesn't exist
+INVALID_USERNAME_ERRORS = (UsernameInvalid, UsernameNotOccupied)
+
+
+def is_username(receiver_id):
+    return isinstance(receiver_id, str) and receiver_id.startswith("@")
+
+
+def normalize_username(username):
+    # Usernames are case-insensitive
+    return username.lstrip("@").lower()
+
+
+def _peer_from_resolved(resolved):
+    if isinstance(resolved.peer, raw.types.PeerUser):
+        user = next(user for user in resolved.users if user.id == resolved.peer.user_id)
+        return raw.types.InputPeerUser(user_id=user.id, access_hash=user.access_hash)
+    channel = next(chat for chat in resolved.chats if chat.id == resolved.peer.channel_id)
+    return raw.types.InputPeerChannel(channel_id=channel.id, access_hash=channel.access_hash)
+
+
+def _peer_to_row(peer):
+    if isinstance(peer, raw.types.InputPeerUser):
+        return "user", peer.user_id, peer.access_hash
+    if isinstance(peer, raw.types.InputPeerChannel):
+        return "channel", peer.channel_id, peer.access_hash
+    return "chat", peer.chat_id, 0
+
+
+def _peer_from_row(row):
+    if row['peer_type'] == "user":
+        return raw.types.InputPeerUser(user_id=row['peer_id'], access_hash=row['access_hash'])
+    if row['peer_type'] == "channel":
+        return raw.types.InputPeerChannel(channel_id=row['peer_id'], access_hash=row['access_hash'])
+    return raw.types.InputPeerChat(chat_id=row['peer_id'])
+
+
 class UserPyrogram:
+    """
+    Long-lived Pyrogram client: started once, reused for every message and
+    restarted when the MTProto connection drops.
+    """
+
     def __init__(self, user_id):
         # Load API credentials from environment variables
         api_id = int(os.getenv("API_ID"))
@@ -12,24 +74,270 @@ class UserPyrogram:
 
         # Ensure sessions directory exists
         os.makedirs("sessions", exist_ok=True)
-        session_name = f"sessions/{user_id}"
+        session_name = _session_copy(user_id) if _session_suffix else f"sessions/{user_id}"
 
         # Initialize the Pyrogram client
+        self.user_id = user_id
         self.app = Client(
             session_name,  # Use forward slashes for cross-platform compatibility
             api_id=int(api_id),
             api_hash=api_hash
         )
+        self._lock = asyncio.Lock()
+        # normalized username -> (input peer, resolved at)
+        self._peers = {}
+
+    async def start(self):
+        """Connect and authorize the session unless it's already running."""
+        async with self._lock:
+            if not self.app.is_connected:
+                await self.app.start()
+                logger.info(f"Pyrogram client for {self.user_id} started.")
+
+    async def stop(self):
+        async with self._lock:
+            if self.app.is_connected:
+                await self.app.stop()
+                logger.info(f"Pyrogram client for {self.user_id} stopped.")
+
+    async def restart(self):
+        async with self._lock:
+            if self.app.is_connected:
+                try:
+                    await self.app.stop()
+                except Exception as error:
+                    logger.error(
+                        f"Error while stopping Pyrogram client for {self.user_id}: {error}")
+            await self.app.start()
+            logger.info(f"Pyrogram client for {self.user_id} reconnected.")
+
+    def _cached_peer(self, key):
+        cached = self._peers.get(key)
+        if cached is not None and time.time() - cached[1] < PEER_CACHE_TTL:
+            return cached[0]
+        return None
+
+    async def load_peers(self, usernames):
+        """Load the stored peers of usernames that aren't in memory yet, in one query."""
+        keys = {normalize_username(username) for username in usernames if is_username(username)}
+        missing = [key for key in keys if self._cached_peer(key) is None]
+        if not missing:
+            return
+        try:
+            rows = await fetch_peers_DB_async(int(self.user_id), missing, PEER_CACHE_TTL)
+        except Exception as error:
+            logger.error(f"An error occurred while loading resolved peers: {error}")
+            return
+        now = time.time()
+        for row in rows:
+            self._peers[row['username']] = (_peer_from_row(row), now - row['age'])
+
+    async def resolve(self, receiver_id, refresh=False):
+        """
+        Resolve a receiver to an input peer. Usernames come from memory or
+        Postgres and only hit Telegram when unknown, expired or refreshed.
+        """
+        if not is_username(receiver_id):
+            return await self.app.resolve_peer(receiver_id)
+        key = normalize_username(receiver_id)
+        if not refresh:
+            peer = self._cached_peer(key)
+            if peer is None:
+                await self.load_peers([receiver_id])
+                peer = self._cached_peer(key)
+            if peer is not None:
+                return peer
 
-    async def send_msg(self, receiver_id, message):
-        """Send a message to a receiver."""
-        async with self.app:
+        await self.start()
+        try:
+            resolved = await self.app.invoke(functions.contacts.ResolveUsername(username=key))
+        except INVALID_USERNAME_ERRORS:
+            self._peers.pop(key, None)
+            await delete_peer_DB_async(int(self.user_id), key)
+            raise
+        peer = _peer_from_resolved(resolved)
+        self._peers[key] = (peer, time.time())
+        try:
+            await save_peers_DB_async(int(self.user_id), [(key, *_peer_to_row(peer))])
+        except Exception as error:
+            logger.error(f"An error occurred while saving the peer of {receiver_id}: {error}")
+        logger.info(f"Resolved {receiver_id}.")
+        return peer
+
+    async def find_invalid_usernames(self, usernames):
+        """
+        Resolve and cache usernames ahead of sending, returning the ones that don't exist.
+        """
+        await self.load_peers(usernames)
+        invalid = []
+        for username in usernames:
+            try:
+                await self.resolve(username)
+            except INVALID_USERNAME_ERRORS:
+                invalid.append(username)
+        return invalid
+
+    async def _send(self, receiver_id, message, random_id):
+        text, entities = (await utils.parse_text_entities(
+            self.app, message, None, None)).values()
+
+        async def send(peer):
+            await self.app.invoke(functions.messages.SendMessage(
+                peer=peer,
+                message=text,
+                entities=entities,
+                # A fixed random_id makes Telegram drop a resend of the same message
+                random_id=self.app.rnd_id() if random_id is None else random_id,
+            ))
+
+        try:
             try:
-                await self.app.send_message(receiver_id, message)
-                logger.info(f"Message sent to {receiver_id}: {message}")
-            except Exception as error:
+                await send(await self.resolve(receiver_id))
+            except STALE_PEER_ERRORS:
+                if not is_username(receiver_id):
+                    raise
+                logger.info(f"Cached peer of {receiver_id} is stale, resolving it again.")
+                await send(await self.resolve(receiver_id, refresh=True))
+        except RandomIdDuplicate:
+            logger.info(f"Message to {receiver_id} was already delivered.")
+
+    async def send_msg(self, receiver_id, message, random_id=None):
+        """
+        Send a message to a receiver, reconnecting once if the connection is lost.
+        Resending with the same random_id lets Telegram drop the duplicate.
+        """
+        await self.start()
+        started = time.perf_counter()
+        try:
+            try:
+                await self._send(receiver_id, message, random_id)
+            except (ConnectionError, OSError) as error:
                 logger.error(
-                    f"An error occurred while sending the message: {error}")
+                    f"Connection lost while sending the message, reconnecting: {error}")
+                await self.restart()
+                await self._send(receiver_id, message, random_id)
+            logger.info(f"Message sent to {receiver_id}: {message}")
+        except Exception as error:
+            SEND_SECONDS.labels(type(error).__name__).observe(time.perf_counter() - started)
+            logger.error(
+                f"An error occurred while sending the message: {error}")
+            raise
+        SEND_SECONDS.labels("sent").observe(time.perf_counter() - started)
+
+
+# Set in greeting worker processes, which open their own copy of each session
+_session_suffix = None
+
+
+def use_session_copies(suffix):
+    """
+    Open every client of this process on a copy of its session,
+    sessions/<user_id>.<suffix>.session, so processes don't lock each other's SQLite file.
+    """
+    global _session_suffix
+    _session_suffix = suffix
+
+
+def _session_copy(user_id):
+    name = f"sessions/{user_id}.{_session_suffix}"
+    source = f"sessions/{user_id}.session"
+    # Refreshed on every client creation, e.g. after the owner logged in again
+    if os.path.exists(source):
+        src, dst = sqlite3.connect(source), sqlite3.connect(f"{name}.session")
+        try:
+            # The backup API copies consistently even while the bot has the source open
+            src.backup(dst)
+        finally:
+            src.close()
+            dst.close()
+    return name
+
+
+# Shared clients, one per Telegram account
+_clients = {}
+
+
+def get_user_client(user_id):
+    """Return the shared client of a Telegram account, creating it on first use."""
+    user_id = str(user_id)
+    if user_id not in _clients:
+        _clients[user_id] = UserPyrogram(user_id)
+    return _clients[user_id]
+
+
+async def stop_all_clients():
+    for client in list(_clients.values()):
+        try:
+            await client.stop()
+        except Exception as error:
+            logger.error(
+                f"Error while stopping Pyrogram client for {client.user_id}: {error}")
+    _clients.clear()
+
+
+# Logins of new owners waiting for their confirmation code, by Telegram id
+_pending_logins = {}
+
+
+async def start_login(user_id, phone_number):
+    """Request a login code for a new session of user_id's account."""
+    await cancel_login(user_id)
+    os.makedirs("sessions", exist_ok=True)
+    client = Client(
+        f"sessions/{user_id}",
+        api_id=int(os.getenv("API_ID")),
+        api_hash=os.getenv("API_HASH")
+    )
+    await client.connect()
+    try:
+        sent_code = await client.send_code(phone_number)
+    except Exception:
+        await client.disconnect()
+        raise
+    _pending_logins[user_id] = (client, phone_number, sent_code.phone_code_hash)
+    logger.info(f"Login code requested for {user_id}.")
+
+
+async def finish_login(user_id, code):
+    """
+    Sign in with the received code.
+    Returns False if the account also needs its two-step verification password.
+    """
+    client, phone_number, phone_code_hash = _pending_logins[user_id]
+    try:
+        await client.sign_in(phone_number, phone_code_hash, code)
+    except SessionPasswordNeeded:
+        return False
+    await _complete_login(user_id)
+    return True
+
+
+async def finish_login_password(user_id, password):
+    client, _, _ = _pending_logins[user_id]
+    await client.check_password(password)
+    await _complete_login(user_id)
+
+
+async def _complete_login(user_id):
+    client, _, _ = _pending_logins.pop(user_id)
+    try:
+        me = await client.get_me()
+    finally:
+        await client.disconnect()
+    # The session is stored under the bot user's id, so it must be their own account
+    if me.id != int(user_id):
+        os.remove(f"sessions/{user_id}.session")
+        raise ValueError("The logged in account doesn't belong to this Telegram user")
+    logger.info(f"Session for {user_id} created.")
+
+
+async def cancel_login(user_id):
+    pending = _pending_logins.pop(user_id, None)
+    if pending is not None:
+        try:
+            await pending[0].disconnect()
+        except Exception as error:
+            logger.error(f"Error while cancelling the login of {user_id}: {error}")
 
 
 if __name__ == "__main__":
@@ -38,9 +346,12 @@ if __name__ == "__main__":
     message = "Hello, World!"
     receiver_id = "@BotFather"
 
-    # Create a User instance
-    user = UserPyrogram(user_id)
+    async def send_once():
+        # Create a User instance
+        user = get_user_client(user_id)
+        try:
+            await user.send_msg(receiver_id, message)
+        finally:
+            await stop_all_clients()
 
-    # Use the existing event loop
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(user.send_msg(receiver_id, message))
+    asyncio.run(send_once())
@@ -0,0 +1,59 @@
+import asyncio
+import os
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from custom_logging import logger
+
+
+# How updates reach the bot: getUpdates long polling or a Telegram webhook.
+# Telegram refuses getUpdates while a webhook is set, so a deployment uses one.
+UPDATE_MODES = ("polling", "webhook")
+
+
+def update_mode():
+    mode = os.getenv("UPDATE_MODE", "polling")
+    if mode not in UPDATE_MODES:
+        raise ValueError(f"Unknown update mode '{mode}'")
+    return mode
+
+
+class WebhookEndpoint:
+    """
+    POST route receiving the updates pushed by Telegram. The route is served
+    from startup on, but answers 503, so Telegram retries, until attach().
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.getenv("WEBHOOK_PATH", "/webhook")
+        self.handler = None
+
+    def attach(self, dp, bot, secret_token):
+        # Requests without the X-Telegram-Bot-Api-Secret-Token header get 401
+        self.handler = SimpleRequestHandler(dp, bot, secret_token=secret_token)
+
+    async def handle(self, request):
+        if self.handler is None:
+            return web.Response(status=503, text="Not ready")
+        return await self.handler.handle(request)
+
+
+async def run_webhook(dp, bot, endpoint):
+    """
+    Register WEBHOOK_URL + the endpoint's path with Telegram and handle the
+    pushed updates until cancelled. Every replica behind the load balancer
+    registers the same URL, so the webhook is left in place on shutdown.
+    """
+    url = os.getenv("WEBHOOK_URL")
+    secret_token = os.getenv("WEBHOOK_SECRET")
+    if not url or not secret_token:
+        raise ValueError("Webhook mode needs WEBHOOK_URL and WEBHOOK_SECRET")
+    endpoint.attach(dp, bot, secret_token)
+    await bot.set_webhook(url.rstrip("/") + endpoint.path, secret_token=secret_token,
+                          allowed_updates=dp.resolve_used_update_types())
+    logger.info(f"Webhook set, receiving updates on {endpoint.path}.")
+    await dp.emit_startup(bot=bot)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()